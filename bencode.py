@@ -1,3 +1,5 @@
+import mmap
+
 from errors import BTFailure
 from collections import OrderedDict
 
@@ -62,6 +64,313 @@ def bdecode(x):
     return r
 
 
+VIEW_THRESHOLD = 1024  # strings at least this long come back as memoryview slices
+_MAX_HEADER = 32       # longest int or string-length token accepted
+
+_INT = ord('i')
+_LIST = ord('l')
+_DICT = ord('d')
+_END = ord('e')
+_ZERO = ord('0')
+_NINE = ord('9')
+
+
+def _parse_int_token(s):
+    """Validates the digits of an int token the way the spec wants them."""
+    negative = s[:1] == b'-'
+    digits = s[1:] if negative else s
+    if not digits.isdigit():
+        raise ValueError
+    if digits[:1] == b'0' and (len(digits) > 1 or negative):
+        raise ValueError
+    return int(s)
+
+
+def _parse_length_token(s):
+    if not s.isdigit() or (s[:1] == b'0' and len(s) > 1):
+        raise ValueError
+    return int(s)
+
+
+class ViewDecoder(object):
+    """
+    Decodes bencoded data in place, without copying the input first.
+
+    Accepts anything exposing the buffer protocol (bytes, bytearray, mmap,
+    memoryview). Strings shorter than `view_threshold` are returned as bytes,
+    longer ones as memoryview slices of the input, so a multi-megabyte
+    `pieces` value costs nothing to decode. The input must not be resized
+    or closed while such views are alive.
+
+    `only` restricts which dictionary entries are built: it maps a key to the
+    spec of its value (None for the whole value), or is a set of keys whose
+    values are built in full. Entries not asked for are skipped without
+    creating any objects. A spec given for a list applies to its elements.
+
+    Instance Variables:
+        self._view      -- Byte-wise memoryview over the whole input.
+        self._raw       -- The input itself when it has find(), for fast delimiter search.
+        self._threshold -- Minimal length of a string returned as a view.
+        self._span_keys -- Keys of the top-level dictionary whose value spans are recorded.
+        self.spans      -- {key: (begin, end)} byte span of each recorded value in the input.
+        self._decoders  -- Dispatch table from the first byte of a value to its decoder.
+    """
+    def __init__(self, data, view_threshold=VIEW_THRESHOLD, span_keys=()):
+        view = memoryview(data)
+        if view.format != 'B' or view.ndim != 1:
+            view = view.cast('B')
+        self._view = view
+        self._raw = data if isinstance(data, (bytes, bytearray, mmap.mmap)) else None
+        self._threshold = view_threshold
+        self._span_keys = span_keys
+        self.spans = {}
+
+        self._decoders = {_INT: self.decode_int, _LIST: self.decode_list, _DICT: self.decode_dict}
+        for digit in range(_ZERO, _NINE + 1):
+            self._decoders[digit] = self.decode_string
+
+    def __len__(self):
+        return len(self._view)
+
+    def _find(self, sub, start):
+        # Tokens are short, so never look further than _MAX_HEADER bytes ahead.
+        if self._raw is not None:
+            pos = self._raw.find(sub, start, start + _MAX_HEADER)
+        else:
+            pos = bytes(self._view[start:start + _MAX_HEADER]).find(sub)
+            if pos >= 0:
+                pos += start
+        if pos < 0:
+            raise ValueError
+        return pos
+
+    def decode(self, f=0, spec=None):
+        """Decodes the value starting at `f`, returns (value, end)."""
+        if self._span_keys and self._view[f] == _DICT:
+            return self.decode_dict(f, spec, self._span_keys)
+        return self._decoders[self._view[f]](f, spec)
+
+    def decode_int(self, f, spec=None):
+        f += 1
+        newf = self._find(b'e', f)
+        return _parse_int_token(bytes(self._view[f:newf])), newf + 1
+
+    def decode_string(self, f, spec=None):
+        colon = self._find(b':', f)
+        n = _parse_length_token(bytes(self._view[f:colon]))
+        colon += 1
+        end = colon + n
+        if end > len(self._view):
+            raise ValueError
+        if n >= self._threshold:
+            return self._view[colon:end], end
+        return bytes(self._view[colon:end]), end
+
+    def decode_key(self, f):
+        colon = self._find(b':', f)
+        n = _parse_length_token(bytes(self._view[f:colon]))
+        colon += 1
+        if colon + n > len(self._view):
+            raise ValueError
+        return bytes(self._view[colon:colon + n]), colon + n
+
+    def decode_list(self, f, spec=None):
+        view, decoders, r = self._view, self._decoders, []
+        f += 1
+        while view[f] != _END:
+            v, f = decoders[view[f]](f, spec)
+            r.append(v)
+        return r, f + 1
+
+    def decode_dict(self, f, spec=None, span_keys=()):
+        view, decoders, r = self._view, self._decoders, {}
+        f += 1
+        while view[f] != _END:
+            k, f = self.decode_key(f)
+            begin = f
+            if spec is None:
+                r[k], f = decoders[view[f]](f, None)
+            elif k in spec:
+                sub_spec = spec[k] if isinstance(spec, dict) else None
+                r[k], f = decoders[view[f]](f, sub_spec)
+            else:
+                f = self.skip(f)
+            if k in span_keys:
+                self.spans[k] = (begin, f)
+        return r, f + 1
+
+    def skip(self, f):
+        """Returns the end of the value starting at `f` without building it."""
+        view = self._view
+        depth = 0
+        while True:
+            c = view[f]
+            if c == _LIST or c == _DICT:
+                depth += 1
+                f += 1
+                continue
+            if c == _END:
+                if depth == 0:
+                    raise ValueError
+                depth -= 1
+                f += 1
+            elif c == _INT:
+                f = self._find(b'e', f + 1) + 1
+            elif _ZERO <= c <= _NINE:
+                colon = self._find(b':', f)
+                f = colon + 1 + _parse_length_token(bytes(view[f:colon]))
+                if f > len(view):
+                    raise ValueError
+            else:
+                raise ValueError
+            if depth == 0:
+                return f
+
+
+def bdecode_prefix(x, f=0, view_threshold=VIEW_THRESHOLD, only=None):
+    """
+    Decodes the bencoded value starting at `f` and returns (value, end),
+    leaving whatever follows it alone (e.g. the payload of a ut_metadata message).
+    """
+    decoder = ViewDecoder(x, view_threshold)
+    try:
+        return decoder.decode(f, only)
+    except (IndexError, KeyError, ValueError):
+        raise BTFailure("not a valid bencoded string")
+
+
+def bdecode_view(x, view_threshold=VIEW_THRESHOLD, only=None):
+    """Zero-copy counterpart of bdecode, see ViewDecoder."""
+    return bdecode_spans(x, (), view_threshold, only)[0]
+
+
+def bdecode_spans(x, span_keys, view_threshold=VIEW_THRESHOLD, only=None):
+    """
+    Like bdecode_view, also returns {key: (begin, end)} for the values of
+    `span_keys` in the top-level dictionary, so they can be hashed as stored.
+    """
+    decoder = ViewDecoder(x, view_threshold, span_keys)
+    try:
+        r, l = decoder.decode(0, only)
+    except (IndexError, KeyError, ValueError):
+        raise BTFailure("not a valid bencoded string")
+    if l != len(decoder):
+        raise BTFailure("invalid bencoded value (data after valid prefix)")
+    return r, decoder.spans
+
+
+class IncrementalDecoder(object):
+    """
+    Decodes a stream of concatenated bencoded values fed in arbitrary chunks,
+    e.g. straight off a socket.
+
+    Only the newly fed bytes are scanned on each call: the scanner keeps its
+    nesting depth and the number of string bytes still to come, so a large
+    value arriving in many small reads costs one pass, not one per read. Once
+    a value is complete it is decoded with ViewDecoder over a single snapshot
+    of its bytes.
+
+    Instance Variables:
+        self._buffer   -- Bytes received and not yet decoded.
+        self._pos      -- Scan position inside self._buffer.
+        self._depth    -- Nesting depth at self._pos.
+        self._pending  -- Bytes of the current string body not received yet.
+        self._max_size -- Upper bound for one value, guards against hostile peers.
+    """
+    def __init__(self, view_threshold=VIEW_THRESHOLD, only=None, max_size=None):
+        self._view_threshold = view_threshold
+        self._only = only
+        self._max_size = max_size
+
+        self._buffer = bytearray()
+        self._pos = 0
+        self._depth = 0
+        self._pending = 0
+
+    @property
+    def buffered(self):
+        return len(self._buffer)
+
+    def feed(self, data):
+        """Adds `data`, returns the list of values completed by it."""
+        self._buffer += data
+        values = []
+        while True:
+            end = self._scan()
+            if end is None:
+                break
+            if end == len(self._buffer):
+                chunk = bytes(self._buffer)
+                self._buffer.clear()
+            else:
+                chunk = bytes(self._buffer[:end])
+                del self._buffer[:end]
+            values.append(bdecode_view(chunk, self._view_threshold, self._only))
+
+        if self._max_size is not None and len(self._buffer) > self._max_size:
+            raise BTFailure("bencoded value exceeds %d bytes" % self._max_size)
+        return values
+
+    def _scan(self):
+        """Returns the end of the first complete value, or None if more bytes are needed."""
+        buf, f, n = self._buffer, self._pos, len(self._buffer)
+        depth, pending = self._depth, self._pending
+        while True:
+            if pending:
+                step = min(pending, n - f)
+                f += step
+                pending -= step
+                if pending:
+                    break
+                if depth == 0:
+                    return self._complete(f)
+                continue
+
+            if f >= n:
+                break
+            c = buf[f]
+            if c == _LIST or c == _DICT:
+                depth += 1
+                f += 1
+                continue
+            if c == _END:
+                if depth == 0:
+                    raise BTFailure("not a valid bencoded string")
+                depth -= 1
+                f += 1
+            elif c == _INT:
+                end = buf.find(b'e', f + 1, f + 1 + _MAX_HEADER)
+                if end < 0:
+                    if n - f > _MAX_HEADER:
+                        raise BTFailure("not a valid bencoded string")
+                    break
+                f = end + 1
+            elif _ZERO <= c <= _NINE:
+                colon = buf.find(b':', f, f + _MAX_HEADER)
+                if colon < 0:
+                    if n - f > _MAX_HEADER:
+                        raise BTFailure("not a valid bencoded string")
+                    break
+                try:
+                    pending = _parse_length_token(bytes(buf[f:colon]))
+                except ValueError:
+                    raise BTFailure("not a valid bencoded string")
+                f = colon + 1
+                if pending:
+                    continue
+            else:
+                raise BTFailure("not a valid bencoded string")
+
+            if depth == 0:
+                return self._complete(f)
+
+        self._pos, self._depth, self._pending = f, depth, pending
+        return None
+
+    def _complete(self, end):
+        self._pos, self._depth, self._pending = 0, 0, 0
+        return end
+
 
 class Bencached(object):
 
@@ -74,16 +383,13 @@ def encode_bencached(x,r):
     r.append(x.bencoded)
 
 def encode_int(x, r):
-    r.extend((b'i', str(x).encode(), b'e'))
+    r.append(b'i%de' % x)
 
 def encode_bool(x, r):
-    if x:
-        encode_int(1, r)
-    else:
-        encode_int(0, r)
-        
+    r.append(b'i1e' if x else b'i0e')
+
 def encode_string(x, r):
-    r.extend((str(len(x)).encode(), b':', x))
+    r.extend((b'%d:' % len(x), x))
 
 def encode_list(x, r):
     r.append(b'l')
@@ -91,29 +397,35 @@ def encode_list(x, r):
         encode_func[type(i)](i, r)
     r.append(b'e')
 
-def encode_dict(x,r):
+def encode_dict(x, r):
     r.append(b'd')
-    ilist = list(x.items())
-    ilist.sort()
-    for k, v in ilist:
-        r.extend((str(len(k)).encode(), b':', k))
+    # Decoded and hand-built dicts are nearly always in key order already,
+    # only sort when they are not.
+    keys = x.keys()
+    last = None
+    for k in keys:
+        if last is not None and k < last:
+            keys = sorted(keys)
+            break
+        last = k
+    for k in keys:
+        v = x[k]
+        r.extend((b'%d:' % len(k), k))
         encode_func[type(v)](v, r)
     r.append(b'e')
 
 encode_func = {}
 encode_func[Bencached] = encode_bencached
 encode_func[int] = encode_int
+encode_func[bool] = encode_bool
 encode_func[bytes] = encode_string
+encode_func[bytearray] = encode_string
+encode_func[memoryview] = encode_string
 encode_func[list] = encode_list
 encode_func[tuple] = encode_list
+encode_func[dict] = encode_dict
 encode_func[OrderedDict] = encode_dict
 
-try:
-    from types import BooleanType
-    encode_func[BooleanType] = encode_bool
-except ImportError:
-    pass
-
 def bencode(x):
     r = []
     encode_func[type(x)](x, r)
@@ -0,0 +1,80 @@
+import logging
+
+MEMORY_BUDGET = 256 * 2 ** 20
+
+# The stages holding piece data, in the order pieces go through them
+PIECES = 'pieces'   # partially assembled from blocks
+HASH = 'hash'       # complete, queued for or being verified
+DISK = 'disk'       # verified, queued for or in the write cache of the file writer
+STAGES = (PIECES, HASH, DISK)
+
+
+class MemoryBudget(object):
+    """
+    Bytes of piece data held in memory, shared by every stage of the download.
+
+    A piece is charged its full length when it is started, moves from stage
+    to stage and is released once written to disk. New pieces are started
+    only while the budget allows it, so a slow disk holds up the requests to
+    peers instead of growing the queues without limit.
+
+    Instance Variables:
+        self.limit      -- The budget in bytes.
+        self.usage      -- {stage: bytes held by the stage}.
+        self.used       -- The bytes held by all stages.
+        self.blocked    -- Whether a try_acquire() failed since the last release.
+        self._listeners -- Callbacks called when memory is released after a failed try_acquire().
+    """
+    def __init__(self, limit=MEMORY_BUDGET):
+        self.limit = limit
+        self.usage = {stage: 0 for stage in STAGES}
+        self.used = 0
+        self.blocked = False
+        self._listeners = []
+
+    @property
+    def available(self):
+        return max(0, self.limit - self.used)
+
+    def add_listener(self, callback):
+        self._listeners.append(callback)
+
+    def remove_listener(self, callback):
+        self._listeners.remove(callback)
+
+    def acquire(self, stage, size):
+        """
+        Charges `size` bytes to `stage` even if that goes over the budget.
+        """
+        self.usage[stage] += size
+        self.used += size
+
+    def try_acquire(self, stage, size):
+        """
+        Charges `size` bytes to `stage` if they fit in the budget, returns whether they did.
+        When nothing is held the charge always succeeds, so pieces larger than the budget
+        are still downloaded one at a time.
+        """
+        if self.used and self.used + size > self.limit:
+            self.blocked = True
+            return False
+        self.acquire(stage, size)
+        return True
+
+    def move(self, from_stage, to_stage, size):
+        self.usage[from_stage] -= size
+        self.usage[to_stage] += size
+
+    def release(self, stage, size):
+        self.usage[stage] -= size
+        self.used -= size
+        if self.usage[stage] < 0:
+            logging.error("Released more memory than held in stage %s" % stage)
+        if self.blocked and self.used < self.limit:
+            self.blocked = False
+            for callback in list(self._listeners):
+                callback()
+
+    def __repr__(self):
+        return 'MemoryBudget(%s/%s: %s)' % (self.used, self.limit,
+                                            ', '.join('%s=%s' % (stage, self.usage[stage]) for stage in STAGES))
@@ -0,0 +1,123 @@
+import asyncio
+import logging
+import random
+import time
+
+# Peers unchoked for their rate, besides the optimistic one
+UPLOAD_SLOTS = 4
+UNCHOKE_INTERVAL = 10
+# The optimistic unchoke moves on every third round
+OPTIMISTIC_ROUNDS = 3
+# A peer that unchoked us but sent nothing requested for this long is snubbing us
+SNUB_TIMEOUT = 60
+# Peers connected for less than this are three times as likely to get the optimistic unchoke
+NEW_PEER_TIME = UNCHOKE_INTERVAL * OPTIMISTIC_ROUNDS * 3
+
+
+class Choker(object):
+    """
+    Decides which interested peers of a torrent we upload to (tit-for-tat).
+
+    Every UNCHOKE_INTERVAL seconds the interested peers are ranked and the
+    best `slots` of them are unchoked. While downloading they are ranked by
+    the rate they send to us, and peers snubbing us get no regular slot.
+    Once the torrent is complete they are ranked by the rate we send to
+    them, which keeps the upload to the peers that can take it. One more
+    peer is unchoked optimistically, whatever its rate, so that new peers
+    get a chance to reciprocate; it changes every OPTIMISTIC_ROUNDS rounds.
+
+    Instance Variables:
+        self.swarm      -- The Swarm whose sessions are choked and unchoked.
+        self.slots      -- How many peers are unchoked for their rate.
+        self.interval   -- Seconds between the rounds.
+        self.optimistic -- The session unchoked optimistically, None for none.
+        self._unchoked  -- The sessions unchoked for their rate.
+        self._round     -- Rounds run so far, for the optimistic rotation.
+        self._task      -- The task running the rounds, once started.
+    """
+    def __init__(self, swarm, slots=UPLOAD_SLOTS, interval=UNCHOKE_INTERVAL):
+        self.swarm = swarm
+        self.slots = slots
+        self.interval = interval
+        self.optimistic = None
+        self._unchoked = set()
+        self._round = 0
+        self._task = None
+
+    @property
+    def seeding(self):
+        return self.swarm.picker.complete
+
+    def start(self):
+        if self._task is None:
+            self._task = asyncio.ensure_future(self._run())
+
+    async def _run(self):
+        while True:
+            try:
+                self.rechoke()
+            except Exception as e:
+                logging.exception("Choking round failed: %r" % e)
+            await asyncio.sleep(self.interval)
+
+    def _rate(self, session):
+        return session.upload_rate if self.seeding else session.download_rate
+
+    def rechoke(self):
+        """
+        Runs one round: ranks the interested peers and chokes or unchokes every session to match.
+        """
+        now = time.time()
+        sessions = [session for session in self.swarm.sessions if session.connected]
+        for session in sessions:
+            session.update_rates(now)
+
+        candidates = [session for session in sessions if session.peer.peer_interested]
+        if not self.seeding:
+            candidates = [session for session in candidates if not session.snubbed]
+        candidates.sort(key=self._rate, reverse=True)
+        self._unchoked = set(candidates[:self.slots])
+
+        if self._round % OPTIMISTIC_ROUNDS == 0 or self.optimistic not in self.swarm.sessions:
+            self.optimistic = self._pick_optimistic(sessions, now)
+        elif self.optimistic in self._unchoked:
+            # It earned a regular slot, give the optimistic one to someone else
+            self.optimistic = self._pick_optimistic(sessions, now)
+        self._round += 1
+
+        for session in sessions:
+            if session in self._unchoked or session is self.optimistic:
+                session.unchoke()
+            else:
+                session.choke()
+
+    def _pick_optimistic(self, sessions, now):
+        choices = []
+        for session in sessions:
+            if session in self._unchoked or not session.peer.peer_interested:
+                continue
+            new = now - session.connected_at < NEW_PEER_TIME
+            choices.extend([session] * (3 if new else 1))
+        return random.choice(choices) if choices else None
+
+    def interested(self, session):
+        """
+        The peer of `session` became interested: it gets a slot right away if one is free.
+        """
+        if len(self._unchoked) < self.slots and session not in self._unchoked:
+            self._unchoked.add(session)
+            session.unchoke()
+
+    def not_interested(self, session):
+        self._unchoked.discard(session)
+
+    def session_closed(self, session):
+        self._unchoked.discard(session)
+        if session is self.optimistic:
+            self.optimistic = None
+
+    async def close(self):
+        if self._task is not None:
+            self._task.cancel()
+            await asyncio.gather(self._task, return_exceptions=True)
+            self._task = None
@@ -0,0 +1,220 @@
+import asyncio
+import heapq
+import itertools
+import logging
+
+from peer import Peer
+
+MAX_CONNECTIONS = 500
+MAX_CONNECTIONS_PER_TORRENT = 50
+# Connects that did not finish the handshake yet, over all torrents
+MAX_HALF_OPEN = 20
+# A peer that failed n times in a row is tried again after RETRY_DELAY * 2 ** (n - 1) seconds
+RETRY_DELAY = 30
+MAX_RETRY_DELAY = 3600
+MAX_FAILURES = 6
+# A peer whose connection ended after the handshake is tried again after this
+RECONNECT_DELAY = 60
+
+
+class ConnectionManager(object):
+    """
+    The connection limits shared by every torrent.
+
+    Instance Variables:
+        self.max_connections -- The connections allowed over all torrents.
+        self.connections    -- The connections open or being opened.
+        self.half_open      -- Semaphore bounding the connects not through the handshake yet.
+        self._pools         -- The PeerPools sharing the limits, offered the slots freed in turn.
+    """
+    def __init__(self, max_connections=MAX_CONNECTIONS, max_half_open=MAX_HALF_OPEN):
+        self.max_connections = max_connections
+        self.connections = 0
+        self.half_open = asyncio.Semaphore(max_half_open)
+        self._pools = []
+
+    def add_pool(self, pool):
+        self._pools.append(pool)
+
+    def remove_pool(self, pool):
+        self._pools.remove(pool)
+
+    def acquire(self):
+        """
+        Takes a connection slot if one is free.
+        """
+        if self.connections >= self.max_connections:
+            return False
+        self.connections += 1
+        return True
+
+    def release(self):
+        self.connections -= 1
+        # Each pool in turn gets the first chance at the free slot
+        if self._pools:
+            self._pools.append(self._pools.pop(0))
+        for pool in list(self._pools):
+            if self.connections >= self.max_connections:
+                break
+            pool.fill()
+
+
+class Candidate(object):
+    """
+    A peer to connect to and its history.
+    """
+    __slots__ = ('peer', 'failures', 'next_attempt')
+
+    def __init__(self, peer: Peer):
+        self.peer = peer
+        self.failures = 0
+        self.next_attempt = 0
+
+
+class PeerPool(object):
+    """
+    The candidate peers of one torrent and the connections to them.
+
+    Candidates from every source are deduplicated by Peer equality and
+    queued by the time they may be tried. While the torrent and the manager
+    have free slots the ready candidates are connected to, so a dropped
+    connection is replaced as soon as it is gone. Peers that fail are tried
+    again with an exponential backoff and forgotten after MAX_FAILURES
+    failures in a row, peers that break the protocol are never tried again.
+
+    Connections the peers open count against the same limits. They are
+    refused when a connection to the same address is open already.
+
+    Instance Variables:
+        self._manager       -- The ConnectionManager of the global limits.
+        self._session_factory -- Callable making the session of a peer. Its download(half_open)
+                                 coroutine connects once and returns whether the handshake succeeded,
+                                 its accept(reader, writer, peer_id) coroutine serves an incoming connection.
+        self.max_connections -- The connections allowed for this torrent.
+        self._candidates    -- {Peer: Candidate} of the peers known.
+        self._queue         -- Heap of (next attempt, sequence, Peer) of the candidates not connected.
+        self._active        -- {Peer: task} of the connections open or being opened.
+        self._banned        -- The peers never to connect to again.
+        self._timer         -- Handle of the call to fill() when the next candidate is ready.
+    """
+    def __init__(self, manager: ConnectionManager, session_factory, max_connections=MAX_CONNECTIONS_PER_TORRENT):
+        self._manager = manager
+        self._session_factory = session_factory
+        self.max_connections = max_connections
+        self._candidates = {}
+        self._queue = []
+        self._sequence = itertools.count()
+        self._active = {}
+        self._banned = set()
+        self._timer = None
+        self._closed = False
+        manager.add_pool(self)
+
+    @property
+    def connections(self):
+        return len(self._active)
+
+    @property
+    def candidates(self):
+        return len(self._candidates)
+
+    def add_peers(self, peers):
+        for peer in peers:
+            if peer in self._candidates or peer in self._banned:
+                continue
+            self._candidates[peer] = Candidate(peer)
+            self._push(self._candidates[peer])
+        self.fill()
+
+    def _push(self, candidate: Candidate):
+        heapq.heappush(self._queue, (candidate.next_attempt, next(self._sequence), candidate.peer))
+
+    def fill(self):
+        """
+        Connects to the ready candidates while there are free slots.
+        """
+        if self._closed:
+            return
+        loop = asyncio.get_event_loop()
+        now = loop.time()
+        while len(self._active) < self.max_connections and self._queue and self._queue[0][0] <= now:
+            if not self._manager.acquire():
+                return  # the manager calls fill() again when a slot frees
+            _, _, peer = heapq.heappop(self._queue)
+            candidate = self._candidates[peer]
+            self._active[peer] = asyncio.ensure_future(self._connect(candidate))
+
+        if self._timer is not None:
+            self._timer.cancel()
+            self._timer = None
+        if self._queue and len(self._active) < self.max_connections:
+            self._timer = loop.call_at(self._queue[0][0], self.fill)
+
+    async def _connect(self, candidate: Candidate):
+        loop = asyncio.get_event_loop()
+        session = self._session_factory(candidate.peer)
+        try:
+            handshaked = await session.download(self._manager.half_open)
+        except asyncio.CancelledError:
+            raise
+        except Exception as e:
+            logging.exception("Session with %s failed: %r" % (candidate.peer, e))
+            handshaked = False
+        finally:
+            del self._active[candidate.peer]
+            self._manager.release()
+
+        if session.misbehaved:
+            logging.info("Ban peer %s" % candidate.peer)
+            del self._candidates[candidate.peer]
+            self._banned.add(candidate.peer)
+        elif handshaked:
+            candidate.failures = 0
+            candidate.next_attempt = loop.time() + RECONNECT_DELAY
+            self._push(candidate)
+        else:
+            candidate.failures += 1
+            if candidate.failures >= MAX_FAILURES:
+                del self._candidates[candidate.peer]
+            else:
+                candidate.next_attempt = loop.time() + min(MAX_RETRY_DELAY,
+                                                           RETRY_DELAY * 2 ** (candidate.failures - 1))
+                self._push(candidate)
+        self.fill()
+
+    def add_incoming(self, peer: Peer, reader, writer, peer_id):
+        """
+        Serves a connection opened by `peer`, whose handshake was read already.
+        Returns False if it was refused and closed.
+        """
+        if (self._closed or peer in self._active or peer in self._banned or
+                len(self._active) >= self.max_connections or not self._manager.acquire()):
+            writer.close()
+            return False
+        self._active[peer] = asyncio.ensure_future(self._serve(peer, reader, writer, peer_id))
+        return True
+
+    async def _serve(self, peer: Peer, reader, writer, peer_id):
+        session = self._session_factory(peer)
+        try:
+            await session.accept(reader, writer, peer_id)
+        except asyncio.CancelledError:
+            raise
+        except Exception as e:
+            logging.exception("Session with %s failed: %r" % (peer, e))
+        finally:
+            del self._active[peer]
+            self._manager.release()
+        # Its address has an ephemeral port, not one to connect or ban, it is not kept as a candidate
+        self.fill()
+
+    async def close(self):
+        self._closed = True
+        if self._timer is not None:
+            self._timer.cancel()
+        tasks = list(self._active.values())
+        for task in tasks:
+            task.cancel()
+        if tasks:
+            await asyncio.gather(*tasks, return_exceptions=True)
+        self._manager.remove_pool(self)
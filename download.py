@@ -1,108 +1,1120 @@
 import asyncio
 import logging
-import struct
+import os
 import time
 
-from hashlib import sha1
+from collections import deque
+from functools import partial
+from math import ceil
 
+from bitarray import bitarray
+
+from errors import PeerError
 from torrent import TorrentInfo, DownloadInfo
 from tracker import Tracker
 from peer import Peer
+from budget import MemoryBudget, PIECES, HASH, DISK
+from choker import Choker, SNUB_TIMEOUT
+from connection_manager import ConnectionManager, PeerPool
 from file_saver import FileSaver
+from hasher import PieceVerifier
+import metrics
+import resume
+from resume import resume_path, RESUME_DIR_NAME, RESUME_SAVE_INTERVAL
+from storage import Storage
+from verify import check_existing
+from piece import BLOCK_SIZE
+from peer_protocol import PeerProtocol, BLOCK_RECEIVED
+from piece_picker import PiecePicker, RAREST_FIRST
+from ratelimit import TokenBucket
+from process_msg import (MessageWriter, pack_handshake, pack_piece_header, read_handshake, read_message,
+                         CHOKE, UNCHOKE, INTERESTED, NOT_INTERESTED, HAVE, BITFIELD, REQUEST, PIECE, CANCEL,
+                         INDEX, BLOCK, PIECE_BLOCK)
+from upload import BlockReader, sendfile_supported
+from util import RateMeter
 
+CONNECT_TIMEOUT = 10
+HANDSHAKE_TIMEOUT = 10
+KEEP_ALIVE_INTERVAL = 90
+# Peers are expected to send something at least every two minutes
+PEER_TIMEOUT = 150
 
-async def download(torrent_file, download_path):
-    torrent_info = TorrentInfo.from_file(torrent_file, download_dir=download_path)
-    download_info: DownloadInfo = torrent_info.download_info
-    tracker = Tracker(torrent_info)
+# Bounds of the per-peer window of outstanding block requests
+MIN_PENDING_REQUESTS = 2
+MAX_PENDING_REQUESTS = 256
+# The window is sized to WINDOW_GAIN times the bandwidth-delay product, the
+# headroom lets the measured rate grow while the window is the bottleneck.
+WINDOW_GAIN = 2
+RATE_INTERVAL = 1.0
+RTT_WINDOW = 10.0
 
-    files = [download_info.files[0], ] # download first file
+# In the endgame a block may be requested from this many peers besides the first one
+ENDGAME_MAX_DUPLICATES = 2
+# Delay before trying the next address of a peer resolving to several
+HAPPY_EYEBALLS_DELAY = 0.25
+# The trackers are asked for more peers when fewer than this are connected
+REANNOUNCE_PEERS = 10
+# Requests of a peer queued for upload, the ones past it are dropped
+MAX_UPLOAD_REQUESTS = 256
 
-    received_pieces_queue = asyncio.Queue()
-    download_info.select_files(files)
-    file_writer = FileSaver(torrent_info, files[0], received_pieces_queue)
 
-    peers_info = await tracker.request_peers()
+async def download(torrent_file, download_path, policy=RAREST_FIRST, resume_dir=None, manager=None):
+    torrent = TorrentDownload(TorrentInfo.from_file(torrent_file, download_dir=download_path), policy,
+                              resume_dir=resume_dir, manager=manager)
+    await torrent.start()
+    try:
+        # Peers are queued as the trackers answer, slow or failing trackers are retried in the background
+        await torrent.swarm.done.wait()
+    finally:
+        await torrent.close()
 
-    sessions = list()
-    for peer in peers_info:
-        session = DownloadSession(torrent_info, received_pieces_queue, peer)
-        sessions.append(session)
 
-    await asyncio.gather(*[session.download() for session in sessions])
+class TorrentDownload(object):
+    """
+    One torrent and everything running for it: the storage, the swarm, the
+    trackers and the connections.
 
+    The connection limits, memory budget, hashing threads, disk thread and
+    tracker clients may be shared with other torrents, see session.Session;
+    the ones not given are made for this torrent alone. Pausing stops the
+    trackers and connections only, the pieces downloaded so far stay.
 
-class DownloadSession(object):
-    def __init__(self, torrent: TorrentInfo, received_pieces_queue, peer: Peer):
+    Instance Variables:
+        self.torrent_info   -- The TorrentInfo of the torrent.
+        self.policy         -- The piece picking policy.
+        self.resume_file    -- The path of the resume data.
+        self.manager        -- The ConnectionManager of the connection limits.
+        self.budget         -- The MemoryBudget of the piece data.
+        self.port           -- The port announced to the trackers.
+        self.upload_limit   -- The TokenBucket of the torrent upload, under the session bucket if any.
+        self.download_limit -- The TokenBucket of the torrent download, under the session bucket if any.
+        self.buffered_protocol -- Whether the connections we open receive the blocks in place, see PeerProtocol.
+        self.storage        -- The Storage of the files, once started.
+        self.file_writer    -- The FileSaver writing the verified pieces, once started.
+        self.swarm          -- The Swarm of the sessions, once started.
+        self.tracker        -- The Tracker, while running.
+        self.pool           -- The PeerPool of the connections, while running.
+    """
+    def __init__(self, torrent_info: TorrentInfo, policy=RAREST_FIRST, resume_dir=None, manager=None, budget=None,
+                 verifier=None, executor=None, http_session=None, udp=None, port=6881,
+                 upload_limit=None, download_limit=None, upload_rate=0, download_rate=0, buffered_protocol=False):
+        self.torrent_info = torrent_info
+        self.policy = policy
+        download_info = torrent_info.download_info
+        if resume_dir is None:
+            resume_dir = os.path.join(torrent_info.download_dir, RESUME_DIR_NAME)
+        self.resume_file = resume_path(resume_dir, download_info.info_hash)
+        self.manager = manager if manager is not None else ConnectionManager()
+        self.budget = budget if budget is not None else MemoryBudget()
+        self._verifier = verifier
+        self._executor = executor
+        self._http_session = http_session
+        self._udp = udp
+        self.port = port
+        self.upload_limit = TokenBucket(upload_rate, parent=upload_limit)
+        self.download_limit = TokenBucket(download_rate, parent=download_limit)
+        self.buffered_protocol = buffered_protocol
+
+        self.storage = None
+        self.file_writer = None
+        self.swarm = None
+        self.tracker = None
+        self.pool = None
+        self._reader = None
+        self._saver = None
+
+    @property
+    def info_hash(self):
+        return self.torrent_info.download_info.info_hash
+
+    @property
+    def paused(self):
+        return self.torrent_info.paused
+
+    @property
+    def running(self):
+        return self.pool is not None
+
+    async def start(self):
+        """
+        Sets up the storage, checking the files already there, then runs unless paused.
+        """
+        download_info: DownloadInfo = self.torrent_info.download_info
+        download_info.select_files(download_info.files)
+        self.storage = Storage(download_info, self.torrent_info.download_dir, executor=self._executor)
+
+        if (not await resume.restore(download_info, self.storage, self.resume_file) and
+                any(map(os.path.exists, self.storage.paths))):
+            logging.info("No resume data, verify existing files")
+            passed = await check_existing(download_info, self.storage)
+            logging.info("%s of %s pieces already downloaded" % (passed, len(download_info.pieces)))
+
+        budget = self.budget
+        self.file_writer = FileSaver(self.storage, asyncio.Queue(), bitarray(download_info.pieces.downloaded),
+                                     budget=budget)
+        self._reader = BlockReader(download_info, self.storage, self.file_writer)
+        # The pieces go through the FileSaver, so peers can be served them before they are written
+        self.swarm = Swarm(self.torrent_info, self.file_writer,
+                           PiecePicker(download_info.pieces, self.policy, budget=budget),
+                           verifier=self._verifier, budget=budget, reader=self._reader,
+                           upload_limit=self.upload_limit, download_limit=self.download_limit,
+                           buffered_protocol=self.buffered_protocol)
+        self.swarm.choker = Choker(self.swarm)
+        self.file_writer.add_listener(self.swarm.piece_write_failed)
+        self._saver = asyncio.ensure_future(_save_resume_periodically(download_info, self.storage,
+                                                                      self.file_writer, self.resume_file))
+        if not self.paused:
+            self._run()
+
+    def _run(self):
+        swarm = self.swarm
+        self.tracker = Tracker(self.torrent_info, session=self._http_session, udp=self._udp,
+                               stats=swarm.tracker_stats, port=self.port)
+        swarm.tracker = self.tracker
+        self.pool = PeerPool(self.manager, lambda peer: DownloadSession(swarm, peer))
+        self.tracker.add_listener(self.pool.add_peers)
+        self.tracker.start()
+        swarm.choker.start()
+
+    async def _stop(self):
+        if not self.running:
+            return
+        pool, tracker, self.pool, self.tracker = self.pool, self.tracker, None, None
+        # No re-announce for the connections closed below
+        self.swarm.tracker = None
+        await self.swarm.choker.close()
+        await pool.close()
+        await tracker.close()
+
+    def add_incoming(self, peer: Peer, reader, writer, peer_id):
+        """
+        Serves a connection opened by a peer for this torrent, returns False if it was refused.
+        """
+        if not self.running:
+            writer.close()
+            return False
+        return self.pool.add_incoming(peer, reader, writer, peer_id)
+
+    async def pause(self):
+        self.torrent_info.paused = True
+        await self._stop()
+        await resume.save(self.torrent_info.download_info, self.storage, self.file_writer.written,
+                          self.resume_file)
+
+    def resume(self):
+        self.torrent_info.paused = False
+        if self.swarm is not None and not self.running:
+            self._run()
+
+    async def close(self):
+        """
+        Stops the torrent, writes what is left and saves the resume data.
+        """
+        if self.swarm is None:
+            return
+        await self._stop()
+        self.swarm.close()
+        self._saver.cancel()
+        await self.file_writer.close()
+        self._reader.close()
+        await resume.save(self.torrent_info.download_info, self.storage, self.file_writer.written,
+                          self.resume_file)
+        await self.storage.close_async()
+        self.swarm = None
+
+
+async def _save_resume_periodically(download_info, storage, file_writer, resume_file):
+    while True:
+        await asyncio.sleep(RESUME_SAVE_INTERVAL)
+        await resume.save(download_info, storage, file_writer.written, resume_file)
+
+
+class Endgame(object):
+    """
+    Tracks the sessions that requested each outstanding block. Once every
+    block left is requested (PiecePicker.all_requested) sessions with free
+    slots request those blocks again from their peers, and when a copy
+    arrives the other requesters send cancel.
+
+    Instance Variables:
+        self.max_duplicates -- Requests allowed for one block besides the first one.
+        self._requesters    -- {(index, begin): (length, [sessions])} of the outstanding blocks.
+        self.duplicate_requests -- The number of duplicate requests sent.
+        self.cancels_sent   -- The number of cancel messages sent.
+        self.wasted_bytes   -- Bytes received for blocks we already had.
+    """
+    def __init__(self, max_duplicates=ENDGAME_MAX_DUPLICATES):
+        self.max_duplicates = max_duplicates
+        self._requesters = {}
+
+        self.duplicate_requests = 0
+        self.cancels_sent = 0
+        self.wasted_bytes = 0
+
+    def add(self, index, begin, length, session):
+        entry = self._requesters.get((index, begin))
+        if entry is None:
+            self._requesters[(index, begin)] = (length, [session])
+        else:
+            entry[1].append(session)
+            self.duplicate_requests += 1
+
+    def remove(self, index, begin, session):
+        """
+        Forgets the request of `session`, returns whether another session still requests the block.
+        """
+        entry = self._requesters.get((index, begin))
+        if entry is None:
+            return False
+        sessions = entry[1]
+        if session in sessions:
+            sessions.remove(session)
+        if not sessions:
+            del self._requesters[(index, begin)]
+            return False
+        return True
+
+    def block_received(self, index, begin, session):
+        """
+        Returns the other sessions that requested the block, they should cancel.
+        """
+        entry = self._requesters.pop((index, begin), None)
+        if entry is None:
+            return []
+        return [other for other in entry[1] if other is not session]
+
+    def pick(self, session, piece_owned, count, receiving=()):
+        """
+        Returns up to `count` outstanding blocks to request again from the peer of `session`,
+        but the blocks in `receiving`: a copy of them would be dropped.
+        """
+        blocks = []
+        limit = 1 + self.max_duplicates
+        for (index, begin), (length, sessions) in self._requesters.items():
+            if len(sessions) < limit and piece_owned[index] and session not in sessions and \
+                    (index, begin) not in receiving:
+                blocks.append((index, begin, length))
+                if len(blocks) == count:
+                    break
+        return blocks
+
+
+class Swarm(object):
+    """
+    Runtime state shared by the sessions downloading one torrent.
+
+    Instance Variables:
+        self.torrent        -- The torrent downloaded (TorrentInfo).
+        self.received_pieces_queue -- Queue of the verified pieces for the file writer.
+        self.picker         -- The PiecePicker choosing the blocks to request.
+        self.endgame        -- The Endgame tracking who requested each block.
+        self.verifier       -- The PieceVerifier checking completed pieces.
+        self.budget         -- The MemoryBudget of the piece data, None for no limit.
+        self.reader         -- The BlockReader serving the blocks peers request, None to upload nothing.
+        self.upload_limit   -- The TokenBucket of the torrent upload, parent of the peer buckets.
+        self.download_limit -- The TokenBucket of the torrent download, parent of the peer buckets.
+        self.peer_upload_rate -- The upload limit of each peer, bytes per second, 0 for none.
+        self.peer_download_rate -- The download limit of each peer, bytes per second, 0 for none.
+        self.buffered_protocol -- Whether the connections we open use PeerProtocol, receiving blocks in place.
+        self.receiving      -- The (index, begin) of the blocks being received in place, by any session.
+        self.tracker        -- The Tracker told about peers lost and completion, None for none.
+        self.choker         -- The Choker deciding who we upload to, None to unchoke nobody.
+        self.sessions       -- The connected DownloadSessions.
+        self.downloaded     -- The bytes of blocks received, for the trackers.
+        self.uploaded       -- The bytes of blocks sent, for the trackers.
+        self.label          -- The torrent label of the metrics, the info hash in hex.
+        self.done           -- Event set once every piece wanted is downloaded.
+        self.closed         -- Whether the torrent was removed, pieces verified after are dropped.
+        self._hashing       -- The indexes of the pieces being verified.
+    """
+    def __init__(self, torrent: TorrentInfo, received_pieces_queue, picker: PiecePicker, endgame=None,
+                 verifier=None, budget=None, reader=None, upload_limit=None, download_limit=None,
+                 buffered_protocol=False):
         self.torrent = torrent
+        self.received_pieces_queue = received_pieces_queue
+        self.picker = picker
+        self.endgame = endgame if endgame is not None else Endgame()
+        self.verifier = verifier if verifier is not None else PieceVerifier()
+        self.budget = budget
+        self.reader = reader
+        self.upload_limit = upload_limit if upload_limit is not None else TokenBucket()
+        self.download_limit = download_limit if download_limit is not None else TokenBucket()
+        self.peer_upload_rate = 0
+        self.peer_download_rate = 0
+        self.buffered_protocol = buffered_protocol
+        self.receiving = set()
+        self.tracker = None
+        self.choker = None
+        self.sessions = set()
+        self.downloaded = 0
+        self.uploaded = 0
+        self.label = torrent.download_info.info_hash.hex()
+        self._downloaded_metric = metrics.DOWNLOADED_BYTES.labels(torrent=self.label)
+        self._uploaded_metric = metrics.UPLOADED_BYTES.labels(torrent=self.label)
+        self._wasted_metric = metrics.WASTED_BYTES.labels(torrent=self.label)
+        self.done = asyncio.Event()
+        self.closed = False
+        self._hashing = set()
+        if picker.complete:
+            self.done.set()
+        if budget is not None:
+            budget.add_listener(self._memory_released)
+
+    def add_downloaded(self, size):
+        self.downloaded += size
+        self._downloaded_metric.inc(size)
+
+    def add_uploaded(self, size):
+        self.uploaded += size
+        self._uploaded_metric.inc(size)
+
+    def add_wasted(self, size):
+        """
+        Accounts the bytes of a block received for nothing.
+        """
+        self.endgame.wasted_bytes += size
+        self._wasted_metric.inc(size)
+
+    def tracker_stats(self):
+        return self.uploaded, self.downloaded, self.torrent.download_info.bytes_left
+
+    def set_peer_rates(self, upload, download):
+        """
+        Limits the rates of every peer, now and for the peers connected later.
+        """
+        self.peer_upload_rate = upload
+        self.peer_download_rate = download
+        for session in self.sessions:
+            session.upload_limit.set_rate(upload)
+            session.download_limit.set_rate(download)
+
+    def connected_to(self, peer_id):
+        return any(session.remote_peer_id == peer_id for session in self.sessions)
+
+    def session_closed(self, session):
+        self.sessions.discard(session)
+        if self.choker is not None:
+            self.choker.session_closed(session)
+        if self.tracker is not None and len(self.sessions) < REANNOUNCE_PEERS:
+            self.tracker.reannounce()
+
+    def _memory_released(self):
+        for session in self.sessions:
+            session.request_blocks()
+
+    async def verify_piece(self, piece):
+        if self.budget is not None:
+            self.budget.move(PIECES, HASH, piece.length)
+        self._hashing.add(piece.index)
+        try:
+            await self.verifier.submit(piece.index, piece.data, piece.piece_hash, self._piece_verified)
+        except BaseException:
+            # Not queued, so _piece_verified never runs for it
+            self._hashing.discard(piece.index)
+            if self.closed:
+                if self.budget is not None:
+                    self.budget.release(HASH, piece.length)
+                raise
+            if self.budget is not None:
+                self.budget.move(HASH, PIECES, piece.length)
+            # Like a piece failing the check, it is downloaded again
+            piece.flush()
+            self.picker.piece_failed(piece.index)
+            for session in self.sessions:
+                session.request_blocks()
+            raise
+
+    def _piece_verified(self, index, data, passed):
+        self._hashing.discard(index)
+        if self.closed:
+            if self.budget is not None:
+                self.budget.release(HASH, len(data))
+            return
+        pieces = self.torrent.download_info.pieces
+        metrics.PIECES_VERIFIED.labels(torrent=self.label, result='passed' if passed else 'failed').inc()
+        if not passed:
+            logging.error("Hash of piece %s is wrong" % index)
+            piece = pieces.get_active(index)
+            if piece is not None:
+                piece.flush()
+            if self.budget is not None:
+                self.budget.move(HASH, PIECES, len(data))
+            self.picker.piece_failed(index)
+            # Request it again right away, the sessions may all be idle
+            for session in self.sessions:
+                session.request_blocks()
+            return
+
+        pieces.mark_as_downloaded(index)
+        self.picker.piece_done(index)
+        if self.budget is not None:
+            self.budget.move(HASH, DISK, len(data))
+        if self.picker.complete:
+            self.done.set()
+            if self.tracker is not None and self.torrent.download_info.bytes_left == 0:
+                self.tracker.completed()
+        self.received_pieces_queue.put_nowait((index * self.torrent.download_info.piece_length, data))
+        for session in self.sessions:
+            session.piece_downloaded(index)
+
+    def piece_write_failed(self, index):
+        """
+        Downloads again a verified piece that could not be written.
+        """
+        logging.error("Piece %s could not be written, downloading it again" % index)
+        self.torrent.download_info.pieces.mark_as_missing(index)
+        self.picker.piece_lost(index)
+        self.done.clear()
+        for session in self.sessions:
+            session.piece_lost(index)
+
+    def close(self):
+        """
+        Stops taking pieces, once the sessions are gone, and gives back the memory budget of the pieces left.
+        """
+        self.closed = True
+        metrics.REGISTRY.remove(torrent=self.label)
+        if self.budget is None:
+            return
+        self.budget.remove_listener(self._memory_released)
+        pieces = self.torrent.download_info.pieces
+        # The pieces being verified give theirs back when the verifier is done
+        for index in self.picker.started - self._hashing:
+            self.budget.release(PIECES, pieces.piece_length(index))
+
+
+class DownloadSession(object):
+    """
+    The connection with one peer.
+
+    Instance Variables:
+        self.swarm          -- The Swarm of the torrent.
+        self.torrent        -- The torrent downloaded (TorrentInfo).
+        self.peer           -- The remote peer (Peer).
+        self._picker        -- The PiecePicker of the swarm.
+        self._endgame       -- The Endgame of the swarm.
+        self._queue         -- Queue of the verified pieces for the file writer.
+        self._messages      -- MessageWriter of the connection, None when not connected.
+        self._writer        -- StreamWriter of the connection, None when not connected.
+        self._outstanding   -- {(index, begin): (length, time sent)} of the requests not answered yet.
+        self._window        -- How many requests to keep outstanding, sized from the bandwidth-delay product.
+        self._download_meter -- RateMeter of the blocks received.
+        self._receiving     -- The (index, begin) of the blocks being received in place.
+        self._upload_meter  -- RateMeter of the blocks sent.
+        self._downloaded_metric -- The series of the bytes received from the peer, while connected.
+        self._uploaded_metric -- The series of the bytes sent to the peer, while connected.
+        self.upload_limit   -- The TokenBucket of the upload to the peer, under the torrent bucket.
+        self.download_limit -- The TokenBucket of the download from the peer, under the torrent bucket.
+        self._upload_queue  -- Deque of the (index, begin, length) requested by the peer and not sent yet.
+        self._upload_task   -- Task sending the requested blocks, None when idle.
+        self._use_sendfile  -- Whether blocks on disk are sent with sendfile(), cleared if the transport cannot.
+        self._min_rtt       -- Lowest block round trip time seen over the last RTT_WINDOW seconds.
+        self._handlers      -- Dispatch table from message id to handler.
+        self._last_message_time -- Loop time of the last message received, for the idle check.
+        self.connected_at   -- Time the connection was set up, newer peers are favoured by the optimistic unchoke.
+        self.remote_peer_id -- The peer id the peer sent in its handshake, None before it.
+        self.handshaked     -- Whether the handshake with the peer succeeded.
+        self.misbehaved     -- Whether the peer broke the protocol and should not be connected to again.
+    """
+    def __init__(self, swarm: Swarm, peer: Peer,
+                 min_requests=MIN_PENDING_REQUESTS, max_requests=MAX_PENDING_REQUESTS):
+        self.swarm = swarm
+        self.torrent = swarm.torrent
         self.peer = peer
-        self._queue = received_pieces_queue
+        self._picker = swarm.picker
+        self._endgame = swarm.endgame
+        self._queue = swarm.received_pieces_queue
+
+        self._messages = None
+        self._writer = None
+        self._receiving = set()
+        self._outstanding = {}
+        self._upload_queue = deque()
+        self._upload_task = None
+        self._use_sendfile = sendfile_supported()
+        self._last_message_time = 0
+        self.connected_at = 0
+        self.remote_peer_id = None
+        self.handshaked = False
+        self.misbehaved = False
+
+        self._min_requests = min_requests
+        self._max_requests = max_requests
+        self._window = min_requests
+
+        self._handlers = {
+            CHOKE: self._on_choke,
+            UNCHOKE: self._on_unchoke,
+            INTERESTED: self._on_interested,
+            NOT_INTERESTED: self._on_not_interested,
+            HAVE: self._on_have,
+            BITFIELD: self._on_bitfield,
+            REQUEST: self._on_request,
+            PIECE: self._on_piece,
+            CANCEL: self._on_cancel,
+            BLOCK_RECEIVED: self._on_block_received,
+        }
 
-        self._total_downloaded = 0
         self._last_download_time = time.time()
+        self._downloaded_metric = None
+        self._uploaded_metric = None
+
+        self._download_meter = RateMeter(RATE_INTERVAL)
+        self._upload_meter = RateMeter(RATE_INTERVAL)
+        self.upload_limit = TokenBucket(swarm.peer_upload_rate, parent=swarm.upload_limit)
+        self.download_limit = TokenBucket(swarm.peer_download_rate, parent=swarm.download_limit)
+        self._min_rtt = None
+        self._window_min_rtt = None
+        self._rtt_window_start = self._last_download_time
 
     @property
     def handshake_msg(self):
-        return struct.pack(
-            '>B19s8x20s20s',
-            19,
-            b'BitTorrent protocol',
-            self.torrent.download_info.info_hash,
-            self.torrent.my_peer_id.encode()
-        )
+        return pack_handshake(self.torrent.download_info.info_hash, self.torrent.my_peer_id.encode())
 
-    def save_block_received(self, piece_idx, begin, data):
-        piece = self.torrent.download_info.pieces[piece_idx]
-        piece.save_block(begin, data)
+    async def save_block_received(self, piece_idx, begin, data, length=None):
+        """
+        Saves a block to its piece. `data` is None for a block of `length` bytes
+        received in place, already in the piece buffer.
+        """
+        download_info = self.torrent.download_info
+        size = len(data) if data is not None else length
+        if download_info.pieces.downloaded[piece_idx] or \
+                (data is not None and (piece_idx, begin) in self.swarm.receiving):
+            # A copy of a block received in place elsewhere must not write over it
+            self.swarm.add_wasted(size)
+            return
+        piece = download_info.pieces[piece_idx]
+        try:
+            saved = piece.save_block(begin, data) if data is not None else piece.block_received(begin)
+            if not saved:
+                logging.debug("Duplicate block %s of piece %s from %s" % (begin, piece_idx, self.peer))
+                self.swarm.add_wasted(size)
+                return
+        except ValueError as e:
+            raise PeerError(str(e))
 
-        if not piece.is_complete():
+        if not piece.is_complete:
             return
 
-        #get the whole piece data
-        piece_data = piece.data
+        # Hashed on the verifier pool, the swarm queues it for the writer if it passes
+        await self.swarm.verify_piece(piece)
 
-        #check the hash value
-        hash_recv = sha1(piece_data).digest()
-        if hash_recv != piece.piece_hash:
-            logging.error("Hash of piece %s is wrong" % piece_idx)
-            piece.flush()
+    async def download(self, half_open=None):
+        """
+        Connects to the peer once and downloads until the connection ends. The
+        connect and handshake hold the `half_open` semaphore if given.
+        Returns whether the handshake succeeded.
+        """
+        return await self._guard(self._download(half_open))
+
+    async def accept(self, reader, writer, peer_id):
+        """
+        Serves a connection the peer opened, whose handshake was read already.
+        """
+        try:
+            writer.write(self.handshake_msg)
+            self.handshaked = True
+        except BaseException:
+            writer.close()
+            raise
+        return await self._guard(self._run(reader, writer, peer_id))
+
+    async def _guard(self, coro):
+        try:
+            await coro
+        except asyncio.TimeoutError:
+            logging.error('Time out connecting with %s', self.peer)
+        except (asyncio.IncompleteReadError, ConnectionError) as e:
+            logging.info('Connection with %s lost: %r', self.peer, e)
+        except OSError as e:
+            logging.error('Failed to connect to peer %s: %s', self.peer, e)
+        except PeerError as e:
+            logging.error('Peer %s: %s', self.peer, e)
+            self.misbehaved = True
+        return self.handshaked
+
+    async def _open_connection(self):
+        # Peers given by name may resolve to IPv4 and IPv6 addresses, both are raced (RFC 8305)
+        if not self.swarm.buffered_protocol:
+            return await asyncio.open_connection(self.peer.host, self.peer.port,
+                                                 happy_eyeballs_delay=HAPPY_EYEBALLS_DELAY)
+        loop = asyncio.get_event_loop()
+        _, protocol = await loop.create_connection(PeerProtocol, self.peer.host, self.peer.port,
+                                                   happy_eyeballs_delay=HAPPY_EYEBALLS_DELAY)
+        return protocol, protocol
+
+    async def _connect(self):
+        connecting = metrics.CONNECTIONS.labels(state='connecting')
+        connecting.inc()
+        try:
+            return await self._handshake()
+        finally:
+            connecting.dec()
+
+    async def _handshake(self):
+        reader, writer = await asyncio.wait_for(self._open_connection(), timeout = CONNECT_TIMEOUT)
+        try:
+            logging.info("Send handshake to peer %s" % self.peer)
+            writer.write(self.handshake_msg)
+            await writer.drain()
+
+            _, _, peer_id = await asyncio.wait_for(read_handshake(reader, self.torrent.download_info.info_hash),
+                                                   timeout=HANDSHAKE_TIMEOUT)
+        except BaseException:
+            writer.close()
+            raise
+        return reader, writer, peer_id
+
+    async def _download(self, half_open=None):
+        if half_open is None:
+            reader, writer, peer_id = await self._connect()
+        else:
+            async with half_open:
+                reader, writer, peer_id = await self._connect()
+        self.handshaked = True
+        await self._run(reader, writer, peer_id)
+
+    async def _run(self, reader, writer, peer_id):
+        if peer_id == self.torrent.my_peer_id.encode() or self.swarm.connected_to(peer_id):
+            logging.info('Already connected with %s as %s' % (peer_id, self.peer))
+            writer.close()
             return
+        self.remote_peer_id = peer_id
 
-        self._queue.put_nowait(piece_idx * self.torrent.download_info.piece_length, piece_data)
+        if isinstance(reader, PeerProtocol):
+            reader.start_messages(self._block_buffer)
 
-    async def download(self):
-        retries = 0
-        while retries < 5:
-            retries += 1
-            try:
-                await self._download()
-            except asyncio.TimeoutError:
-                logging.error('Time out connecting with %s', self.peer)
+        keep_alive = None
+        try:
+            self._start_connection(writer)
+            keep_alive = asyncio.ensure_future(self._keep_alive(writer))
+            await self._receive(reader)
+        finally:
+            if keep_alive is not None:
+                keep_alive.cancel()
+            self._close_connection()
+            writer.close()
+
+    def _start_connection(self, writer):
+        self._messages = MessageWriter(writer)
+        self._writer = writer
+        self._last_message_time = asyncio.get_event_loop().time()
+        self.connected_at = time.time()
+        self.swarm.sessions.add(self)
+        self._downloaded_metric = metrics.PEER_DOWNLOADED_BYTES.labels(torrent=self.swarm.label, peer=self.peer)
+        self._uploaded_metric = metrics.PEER_UPLOADED_BYTES.labels(torrent=self.swarm.label, peer=self.peer)
+        metrics.CONNECTIONS.labels(state='connected').inc()
+
+        self.peer.connected = True
+        self.peer.am_choking = True
+        self.peer.am_interested = False
+        self.peer.peer_choking = True
+        self.peer.peer_interested = False
+        self.peer.piece_owned = None
+
+        downloaded = self.torrent.download_info.pieces.downloaded
+        if self.swarm.reader is not None and downloaded.any():
+            self._messages.bitfield(downloaded.tobytes())
+
+    def _close_connection(self):
+        self.swarm.session_closed(self)
+        metrics.CONNECTIONS.labels(state='connected').dec()
+        metrics.PEER_DOWNLOADED_BYTES.remove(torrent=self.swarm.label, peer=self.peer)
+        metrics.PEER_UPLOADED_BYTES.remove(torrent=self.swarm.label, peer=self.peer)
+        self._abort_requests()
+        if self._upload_task is not None:
+            self._upload_task.cancel()
+            self._upload_task = None
+        self._upload_queue.clear()
+        self.swarm.receiving.difference_update(self._receiving)
+        self._receiving.clear()
+        if self.peer.piece_owned is not None:
+            self._picker.remove_peer(self.peer.piece_owned)
+            self.peer.piece_owned = None
+        self._messages = None
+        self._writer = None
+        self.peer.connected = False
+
+    async def _receive(self, reader):
+        """
+        The message loop: reads frames and dispatches them through self._handlers.
+        """
+        loop = asyncio.get_event_loop()
+        handlers = self._handlers
+        read = reader.read_message if isinstance(reader, PeerProtocol) else partial(read_message, reader)
+        while True:
+            msg_id, payload = await read()
+            self._last_message_time = loop.time()
+            if msg_id is None:  # keep-alive
+                continue
+            handler = handlers.get(msg_id)
+            if handler is None:
+                logging.debug('Ignore message %s from %s' % (msg_id, self.peer))
+                continue
+            result = handler(payload)
+            if result is not None:  # handlers that may wait, e.g. for the verifier
+                await result
+
+    async def _keep_alive(self, writer):
+        loop = asyncio.get_event_loop()
+        while True:
+            await asyncio.sleep(KEEP_ALIVE_INTERVAL)
+            if loop.time() - self._last_message_time > PEER_TIMEOUT:
+                logging.info('Peer %s is idle, disconnecting' % self.peer)
+                writer.close()
+                return
+            self._messages.keep_alive()
+
+    def _on_choke(self, payload):
+        self.peer.peer_choking = True
+        # A choking peer discards our pending requests, not the blocks it is sending already
+        self._abort_requests(keep=self._receiving)
+
+    def _on_unchoke(self, payload):
+        if self.peer.peer_choking:
+            # The snubbing check counts from here, not from the last block before the choke
+            self._last_download_time = time.time()
+        self.peer.peer_choking = False
+        self._request_blocks()
+
+    def _on_interested(self, payload):
+        self.peer.peer_interested = True
+        if self.swarm.choker is not None:
+            self.swarm.choker.interested(self)
+
+    def _on_not_interested(self, payload):
+        self.peer.peer_interested = False
+        if self.swarm.choker is not None:
+            self.swarm.choker.not_interested(self)
+
+    def _on_have(self, payload):
+        index, = INDEX.unpack(payload)
+        pieces = self.torrent.download_info.pieces
+        if index >= len(pieces):
+            raise PeerError('Invalid piece index %s in have' % index)
+        if self.peer.piece_owned is None:
+            self.peer.piece_owned = bitarray(len(pieces))
+            self.peer.piece_owned.setall(False)
+        if self.peer.piece_owned[index]:
+            return
+        self.peer.piece_owned[index] = True
+        self._picker.add_have(index, self.peer.piece_owned)
+        if not self.peer.am_interested and self._picker.is_wanted(index):
+            self._update_interest()
+
+    def _on_bitfield(self, payload):
+        piece_count = len(self.torrent.download_info.pieces)
+        if len(payload) != ceil(piece_count / 8):
+            raise PeerError('Invalid bitfield length %s' % len(payload))
+        owned = bitarray(endian='big')
+        owned.frombytes(bytes(payload))
+        if owned[piece_count:].any():
+            raise PeerError('Spare bits set in bitfield')
+        del owned[piece_count:]
+        if self.peer.piece_owned is not None:
+            self._picker.remove_peer(self.peer.piece_owned)
+        self.peer.piece_owned = owned
+        self._picker.add_peer(owned)
+        self._update_interest()
+
+    async def _on_piece(self, payload):
+        index, begin = PIECE_BLOCK.unpack_from(payload)
+        block = payload[PIECE_BLOCK.size:]
+        await self._on_block(index, begin, len(block), block)
+
+    def _block_buffer(self, index, begin, length):
+        """
+        Where PeerProtocol receives a block: its place in the piece buffer if we
+        requested it and nobody else is receiving it in place, else None.
+        """
+        request = self._outstanding.get((index, begin))
+        pieces = self.torrent.download_info.pieces
+        if request is None or request[0] != length or pieces.downloaded[index] or \
+                (index, begin) in self.swarm.receiving:
+            return None
+        try:
+            view = pieces[index].block_buffer(begin, length)
+        except ValueError:
+            return None
+        if view is not None:
+            self._receiving.add((index, begin))
+            self.swarm.receiving.add((index, begin))
+        return view
+
+    async def _on_block_received(self, block):
+        index, begin, length = block
+        self.swarm.receiving.discard((index, begin))
+        self._receiving.discard((index, begin))
+        await self._on_block(index, begin, length, None)
+
+    async def _on_block(self, index, begin, length, data):
+        """
+        Block `begin` of piece `index` arrived, `data` is None if it was received in place.
+        """
+        request = self._outstanding.get((index, begin))
+        if request is None:
+            # Most likely sent before our cancel arrived
+            logging.debug('Unrequested block %s of piece %s from %s' % (begin, index, self.peer))
+            self.swarm.add_wasted(length)
+            return
+        if length != request[0]:
+            # Still outstanding, so closing the connection gives the block back to the picker
+            raise PeerError('Block %s of piece %s is %s bytes, %s were requested' % (begin, index, length, request[0]))
+        del self._outstanding[(index, begin)]
+        if data is not None and (index, begin) in self.swarm.receiving:
+            # Another connection is receiving it into the piece buffer, its request stands even
+            # through a choke and the block is requested again if that connection fails.
+            # Without any request left the block goes back to the picker.
+            if not self._endgame.remove(index, begin, self):
+                self._picker.abort_block(index, begin)
+            self.swarm.add_wasted(length)
+            self._request_blocks()
+            return
+        delay = self.add_downloaded(length, time.time() - request[1])
+        self.swarm.add_downloaded(length)
+        for other in self._endgame.block_received(index, begin, self):
+            other.cancel_request(index, begin)
+        await self.save_block_received(index, begin, data, length)
+        if delay > 0:
+            # Not reading makes the peer's TCP send slower, and the request window shrinks with the rate
+            await asyncio.sleep(delay)
+        self._request_blocks()
+
+    def _on_request(self, payload):
+        index, begin, length = BLOCK.unpack(payload)
+        reader = self.swarm.reader
+        if reader is None or self.peer.am_choking:
+            return  # requests while choked are dropped, the peer asks again after the unchoke
+        try:
+            have = reader.check_request(index, begin, length)
+        except ValueError as e:
+            raise PeerError(str(e))
+        if not have:
+            logging.debug('Request for missing piece %s from %s' % (index, self.peer))
+            return
+        if len(self._upload_queue) >= MAX_UPLOAD_REQUESTS:
+            logging.debug('Too many requests from %s' % self.peer)
+            return
+        self._upload_queue.append((index, begin, length))
+        if self._upload_task is None:
+            self._upload_task = asyncio.ensure_future(self._upload())
+
+    def _on_cancel(self, payload):
+        request = BLOCK.unpack(payload)
+        try:
+            self._upload_queue.remove(request)
+        except ValueError:
+            pass  # sent already
 
-    async def _download(self):
+    async def _upload(self):
+        """
+        Sends the requested blocks in order until the queue is empty.
+        """
         try:
-            reader, writer = await asyncio.wait_for(
-                asyncio.open_connection(self.peer.host, self.peer.port),
-                timeout = 10
-            )
-        except ConnectionError:
-            logging.error('Failed to connect to peer %s' % self.peer)
+            while self._upload_queue and self._messages is not None:
+                index, begin, length = self._upload_queue.popleft()
+                await self.upload_limit.consume(length)
+                if self._messages is None or self.peer.am_choking:
+                    break  # the peer discarded its requests meanwhile
+                if not self.torrent.download_info.pieces.downloaded[index]:
+                    continue  # failed to be written, it is downloaded again
+                await self._send_block(index, begin, length)
+                self._upload_meter.add(length)
+                self.swarm.add_uploaded(length)
+                self._uploaded_metric.inc(length)
+        except OSError as e:
+            logging.error('Failed to send a block to %s: %s' % (self.peer, e))
+            if self._writer is not None:
+                self._writer.close()
+        finally:
+            if self._upload_task is asyncio.current_task():
+                self._upload_task = None
+
+    async def _send_block(self, index, begin, length):
+        reader = self.swarm.reader
+        messages = self._messages
+        header = pack_piece_header(index, begin, length)
+        # Verified but not written yet
+        view = reader.cached(index, begin, length)
+        if view is not None:
+            messages.send_now(header, view)
+            await self._writer.drain()
             return
 
-        logging.info("Send handshake to peer %s" % self.peer)
-        writer.write(self.handshake_msg)
-        await writer.drain()
+        transport = self._writer.transport
+        if self._use_sendfile:
+            messages.hold()
+            try:
+                transport.write(header)
+                await reader.sendfile(transport, index, begin, length)
+                return
+            except asyncio.SendfileNotAvailableError:
+                # Nothing of the block went out yet, only the header
+                logging.info('No sendfile() for %s, reading the blocks instead' % self.peer)
+                self._use_sendfile = False
+                header = b''
+            finally:
+                messages.release()
 
-        handshake = await reader.read(68)
-        # TODO: Validate handshake
+        buffer, view = await reader.read(index, begin, length)
+        if self._messages is not messages:
+            return  # closed while reading
+        messages.send_now(header, view)
+        # The transport may keep a reference to the data it could not send yet
+        if transport.get_write_buffer_size() == 0:
+            reader.release(buffer)
+        await self._writer.drain()
 
-        # TODO: Receive packets
+    def cancel_request(self, index, begin):
+        """
+        Another peer sent the block first, cancel our request for it.
+        """
+        request = self._outstanding.pop((index, begin), None)
+        if request is None or self._messages is None:
+            return
+        self._messages.cancel(index, begin, request[0])
+        self._endgame.cancels_sent += 1
+        self._request_blocks()
 
+    def piece_downloaded(self, index):
+        """
+        Piece `index` passed the hash check.
+        """
+        if self.swarm.reader is not None and self._messages is not None and \
+                (self.peer.piece_owned is None or not self.peer.piece_owned[index]):
+            self._messages.have(index)
+        if self.peer.am_interested and self.peer.piece_owned is not None and self.peer.piece_owned[index]:
+            self._update_interest()
 
+    def piece_lost(self, index):
+        """
+        Piece `index` is wanted again after it was downloaded.
+        """
+        if not self.peer.am_interested and self.peer.piece_owned is not None and self.peer.piece_owned[index]:
+            self._update_interest()
+        self.request_blocks()
 
-    def add_downloaded(self, size: int):
-        """ For speed testing"""
-        self._last_download_time = time.time()
-        self._total_downloaded += size
+    def request_blocks(self):
+        if self._messages is not None:
+            self._request_blocks()
+
+    @property
+    def connected(self):
+        return self._messages is not None
+
+    @property
+    def snubbed(self):
+        """
+        Whether the peer unchoked us but sent none of the blocks requested for SNUB_TIMEOUT seconds.
+        """
+        return (not self.peer.peer_choking and bool(self._outstanding) and
+                time.time() - self._last_download_time > SNUB_TIMEOUT)
+
+    def choke(self):
+        if self._messages is None or self.peer.am_choking:
+            return
+        self.peer.am_choking = True
+        self._messages.choke()
+        # The peer discards its requests when choked, the block being sent still goes out
+        self._upload_queue.clear()
+
+    def unchoke(self):
+        if self._messages is None or not self.peer.am_choking or self.swarm.reader is None:
+            return
+        self.peer.am_choking = False
+        self._messages.unchoke()
+
+    def _update_interest(self):
+        if self._messages is None:
+            return
+        interested = self.peer.piece_owned is not None and self._picker.is_interesting(self.peer.piece_owned)
+        if interested != self.peer.am_interested:
+            self.peer.am_interested = interested
+            if interested:
+                self._messages.interested()
+            else:
+                self._messages.not_interested()
+
+    def _request_blocks(self):
+        """
+        Tops the outstanding requests up to the window.
+        """
+        if self.peer.peer_choking or self.peer.piece_owned is None:
+            return
+        free_slots = self._window - len(self._outstanding)
+        if free_slots <= 0:
+            return
+
+        blocks = self._picker.pick(self.peer.piece_owned, free_slots)
+        if len(blocks) < free_slots and self._picker.all_requested:
+            blocks += self._endgame.pick(self, self.peer.piece_owned, free_slots - len(blocks), self.swarm.receiving)
+
+        now = time.time()
+        for index, begin, length in blocks:
+            self._outstanding[(index, begin)] = (length, now)
+            self._endgame.add(index, begin, length, self)
+            self._messages.request(index, begin, length)
+
+    def _abort_requests(self, keep=()):
+        """
+        Gives the outstanding requests back, but those of the blocks in `keep`.
+        """
+        kept = {}
+        for (index, begin), request in self._outstanding.items():
+            if (index, begin) in keep:
+                kept[(index, begin)] = request
+            # In the endgame another peer may still be asked for the block
+            elif not self._endgame.remove(index, begin, self):
+                self._picker.abort_block(index, begin)
+        self._outstanding = kept
+
+    def _update_window(self):
+        if not self._download_meter.rate or self._min_rtt is None:
+            return
+        bdp = self._download_meter.rate * self._min_rtt / BLOCK_SIZE
+        self._window = max(self._min_requests, min(self._max_requests, ceil(bdp * WINDOW_GAIN) + 1))
+
+    @property
+    def window(self):
+        return self._window
+
+    @property
+    def download_rate(self):
+        return self._download_meter.rate
+
+    @property
+    def upload_rate(self):
+        return self._upload_meter.rate
+
+    def update_rates(self, now=None):
+        """
+        Lets the rates fall for a peer that stopped sending or requesting.
+        """
+        self._download_meter.update(now)
+        self._upload_meter.update(now)
+
+    def add_downloaded(self, size: int, rtt=None):
+        """
+        For speed testing: accounts a received block and its round trip time,
+        and resizes the request window from them. Returns the seconds to wait
+        before reading on, to keep under the download limits.
+        """
+        now = time.time()
+        self._last_download_time = now
+        if self._downloaded_metric is not None:
+            self._downloaded_metric.inc(size)
 
+        if rtt is not None:
+            if self._window_min_rtt is None or rtt < self._window_min_rtt:
+                self._window_min_rtt = rtt
+            if self._min_rtt is None or rtt < self._min_rtt:
+                self._min_rtt = rtt
+            # Let the minimum follow a path whose latency went up
+            if now - self._rtt_window_start >= RTT_WINDOW:
+                self._min_rtt = self._window_min_rtt
+                self._window_min_rtt = None
+                self._rtt_window_start = now
 
+        if self._download_meter.add(size, now):
+            self._update_window()
+        return self.download_limit.charge(size)
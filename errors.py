@@ -3,3 +3,6 @@ class BTFailure(Exception):
 
 class TrackerError(Exception):
     pass
+
+class PeerError(Exception):
+    pass
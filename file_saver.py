@@ -1,32 +1,211 @@
 import asyncio
-import os
+import bisect
 import logging
+import time
+
+from bitarray import bitarray
+
+import metrics
+from budget import DISK
+from storage import Storage
+
+WRITE_CACHE_SIZE = 64 * 2 ** 20
+# Pieces are written at the latest this many seconds after they were verified
+WRITE_CACHE_DELAY = 5
+
+
+class WriteCache(object):
+    """
+    Verified pieces waiting to be written, kept by offset so that neighbours
+    are written together as one contiguous run.
+
+    Instance Variables:
+        self._offsets   -- The sorted offsets of the pieces cached.
+        self._pieces    -- {offset: data} of the pieces cached.
+        self.size       -- The number of bytes cached.
+        self.oldest     -- When the oldest piece cached was added, None if empty.
+    """
+    def __init__(self):
+        self._offsets = []
+        self._pieces = {}
+        self.size = 0
+        self.oldest = None
+
+    def __len__(self):
+        return len(self._pieces)
+
+    def add(self, offset, data):
+        if offset in self._pieces:
+            return
+        bisect.insort(self._offsets, offset)
+        self._pieces[offset] = data
+        self.size += len(data)
+        metrics.DISK_QUEUE.inc(len(data))
+        if self.oldest is None:
+            self.oldest = time.monotonic()
+
+    @property
+    def offsets(self):
+        return self._offsets
+
+    def get(self, offset):
+        """
+        The data of the piece at `offset`, None if it is not cached.
+        """
+        return self._pieces.get(offset)
+
+    def runs(self):
+        """
+        Returns the pieces cached as a list of (offset, [data...]) of contiguous runs, by offset.
+        """
+        runs = []
+        end = None
+        for offset in self._offsets:
+            data = self._pieces[offset]
+            if offset == end:
+                runs[-1][1].append(data)
+            else:
+                runs.append((offset, [data]))
+            end = offset + len(data)
+        return runs
+
+    def clear(self):
+        metrics.DISK_QUEUE.dec(self.size)
+        self._offsets = []
+        self._pieces = {}
+        self.size = 0
+        self.oldest = None
+
+
+def _write_runs(storage: Storage, runs):
+    """
+    Writes the runs of pieces, returns the offsets of the pieces written. Runs on the disk thread.
+    """
+    written = []
+    for offset, buffers in runs:
+        try:
+            storage.writev(offset, buffers)
+        except OSError as e:
+            logging.error('Failed to write at %s: %s' % (offset, e))
+            continue
+        for data in buffers:
+            written.append(offset)
+            offset += len(data)
+    return written
 
-from torrent import TorrentInfo, FileInfo
 
 class FileSaver(object):
-    def __init__(self, torrent: TorrentInfo, file: FileInfo, received_blocks_queue):
-        self.download_dir = os.path.join(torrent.download_dir, torrent.download_info.suggested_name)
-        self.dir_path = self.download_dir + '/' + '/'.join(file.path[:-2])
-        os.makedirs(self.dir_path, exist_ok=True)
-        self.file_path = self.dir_path + '/' + file.path[-1]
-        self.fd = os.open(self.file_path, os.O_RDWR | os.O_CREAT)
+    """
+    Writes the verified pieces from the queue to the storage, on the disk thread.
+
+    The swarm can use the FileSaver itself as its queue: pieces given to
+    put_nowait() can be read with cached_piece() until they are written.
+
+    Pieces go through a write-back cache first. It is flushed, with one
+    vectored write per contiguous run, when it holds `cache_size` bytes, when
+    its oldest piece waited `max_delay` seconds, when the memory budget is
+    used up, and on close. The memory of the pieces is released once written.
+    Pieces that fail to be written are dropped and reported to the listeners,
+    which download them again.
+
+    Instance Variables:
+        self.written    -- Bitmap of the pieces on disk, for the resume data.
+        self.cache      -- The WriteCache of the pieces not written yet.
+        self._queued    -- {offset: data} of the pieces put in the queue and not taken out yet.
+        self._flushing  -- The WriteCache being written, its pieces can still be read.
+        self._budget    -- The MemoryBudget of the piece data, None for no limit.
+        self._listeners -- Callbacks called with the index of each piece that could not be written.
+    """
+    def __init__(self, storage: Storage, received_blocks_queue, written: bitarray,
+                 cache_size=WRITE_CACHE_SIZE, max_delay=WRITE_CACHE_DELAY, budget=None):
+        self._storage = storage
         self._received_blocks_queue = received_blocks_queue
-        asyncio.ensure_future(self.start())
+        self.written = written
+        self.cache = WriteCache()
+        self._queued = {}
+        self._flushing = None
+        self.cache_size = cache_size
+        self.max_delay = max_delay
+        self._budget = budget
+        self._listeners = []
+        self._task = asyncio.ensure_future(self.start())
+
+    def add_listener(self, callback):
+        self._listeners.append(callback)
 
     @property
     def received_blocks_queue(self):
         return self._received_blocks_queue
 
+    def put_nowait(self, block):
+        self._queued[block[0]] = block[1]
+        self.received_blocks_queue.put_nowait(block)
+
+    def cached_piece(self, offset):
+        """
+        The data of the verified piece at `offset` if it is not on disk yet, else None.
+        """
+        data = self._queued.get(offset)
+        if data is None:
+            data = self.cache.get(offset)
+        if data is None and self._flushing is not None:
+            data = self._flushing.get(offset)
+        return data
+
     async def start(self):
+        loop = asyncio.get_event_loop()
+        await loop.run_in_executor(self._storage.executor, self._storage.create_empty_files)
         while True:
-            block = await self.received_blocks_queue.get()
+            timeout = None
+            if self.cache.oldest is not None:
+                timeout = max(0, self.cache.oldest + self.max_delay - time.monotonic())
+            try:
+                block = await asyncio.wait_for(self.received_blocks_queue.get(), timeout)
+            except asyncio.TimeoutError:
+                await self.flush()
+                continue
             if not block:
                 logging.info('Received poison pill.Exiting')
+                await self.flush()
+                return
 
             block_abs_location, block_data = block
-            os.lseek(self.fd, block_abs_location, os.SEEK_SET)
-            os.write(self.fd, block_data)
+            self.cache.add(block_abs_location, block_data)
+            self._queued.pop(block_abs_location, None)
+            if self.cache.size >= self.cache_size or (self._budget is not None and self._budget.blocked):
+                await self.flush()
+
+    async def flush(self):
+        """
+        Writes the cached pieces and marks them as written.
+        """
+        if not len(self.cache):
+            return
+        self._flushing, self.cache = self.cache, WriteCache()
+        offsets = self._flushing.offsets
+        loop = asyncio.get_event_loop()
+        try:
+            with metrics.Timer(metrics.DISK_LATENCY.labels(op='write')):
+                written = await loop.run_in_executor(self._storage.executor, _write_runs,
+                                                     self._storage, self._flushing.runs())
+        finally:
+            size, self._flushing = self._flushing.size, None
+            metrics.DISK_QUEUE.dec(size)
+            if self._budget is not None:
+                self._budget.release(DISK, size)
+        for offset in written:
+            self.written[offset // self._storage.piece_length] = True
+        if len(written) < len(offsets):
+            written = set(written)
+            for offset in offsets:
+                if offset not in written:
+                    for callback in list(self._listeners):
+                        callback(offset // self._storage.piece_length)
+
+    async def close(self):
+        """Writes what is queued and stops."""
+        self.received_blocks_queue.put_nowait(None)
+        await self._task
 
     def closefile(self):
-        os.close(self.fd)
+        self._storage.close()
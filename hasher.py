@@ -0,0 +1,63 @@
+import asyncio
+import logging
+import os
+
+from concurrent.futures import ThreadPoolExecutor
+from hashlib import sha1
+
+import metrics
+
+# hashlib releases the GIL while hashing large buffers, threads use every core
+HASH_WORKERS = min(8, os.cpu_count() or 2)
+MAX_PENDING_HASHES = 32
+
+
+def _digest(data):
+    return sha1(data).digest()
+
+
+class PieceVerifier(object):
+    """
+    Checks the SHA1 of completed pieces on a thread pool instead of the event loop.
+
+    At most `max_pending` pieces are queued or being hashed: submit() waits for
+    a free slot, which holds up the caller's message loop and therefore the peer.
+
+    Instance Variables:
+        self._executor  -- The pool of hashing threads.
+        self._slots     -- Semaphore bounding the pieces queued or being hashed.
+        self.pending    -- The number of pieces queued or being hashed.
+    """
+    def __init__(self, workers=HASH_WORKERS, max_pending=MAX_PENDING_HASHES):
+        self._executor = ThreadPoolExecutor(max_workers=workers, thread_name_prefix='hasher')
+        self._slots = asyncio.Semaphore(max_pending)
+        self.max_pending = max_pending
+        self.pending = 0
+
+    async def submit(self, index, data, piece_hash, callback):
+        """
+        Queues the check of piece `index`. Returns once it is queued,
+        callback(index, data, passed) is called on the loop when it is done.
+        """
+        await self._slots.acquire()
+        self.pending += 1
+        metrics.HASH_QUEUE.inc()
+        loop = asyncio.get_event_loop()
+        future = loop.run_in_executor(self._executor, _digest, data)
+        future.add_done_callback(lambda f: self._done(f, index, data, piece_hash, callback))
+
+    def _done(self, future, index, data, piece_hash, callback):
+        self.pending -= 1
+        metrics.HASH_QUEUE.dec()
+        self._slots.release()
+        if future.cancelled():
+            return
+        if future.exception() is not None:
+            logging.error("Failed to hash piece %s: %s" % (index, future.exception()))
+            passed = False
+        else:
+            passed = future.result() == piece_hash
+        callback(index, data, passed)
+
+    def shutdown(self):
+        self._executor.shutdown(wait=False)
@@ -1,10 +1,19 @@
-from download import download
+from session import Session
 
 import asyncio
+import sys
 
-if __name__ == "__main__":
-    torrentFile = '3DMGAME-Ra2.v1.001.CHT.Green.rar.torrent'
-    loop = asyncio.get_event_loop()
-    loop.run_until_complete(download(torrentFile, '.'))
-    loop.close()
 
+async def main(torrent_files, download_dir):
+    session = Session(download_dir)
+    await session.start()
+    try:
+        torrents = [await session.add(torrent_file) for torrent_file in torrent_files]
+        await asyncio.gather(*[torrent.swarm.done.wait() for torrent in torrents])
+    finally:
+        await session.close()
+
+
+if __name__ == "__main__":
+    torrentFiles = sys.argv[1:] or ['3DMGAME-Ra2.v1.001.CHT.Green.rar.torrent']
+    asyncio.run(main(torrentFiles, '.'))
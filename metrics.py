@@ -0,0 +1,296 @@
+import asyncio
+import logging
+import math
+import time
+
+from bisect import bisect_left
+
+METRICS_PORT = 9881
+CONTENT_TYPE = 'text/plain; version=0.0.4; charset=utf-8'
+# Histogram buckets, in seconds
+LATENCY_BUCKETS = (0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30)
+LOOP_LAG_INTERVAL = 1.0
+
+
+class _Value(object):
+    __slots__ = ('value', '_function')
+
+    def __init__(self):
+        self.value = 0
+        self._function = None
+
+    def inc(self, amount=1):
+        self.value += amount
+
+    def dec(self, amount=1):
+        self.value -= amount
+
+    def set(self, value):
+        self.value = value
+
+    def set_function(self, function):
+        """
+        Reads the value from `function` when collected, for values kept elsewhere.
+        """
+        self._function = function
+
+    def get(self):
+        return self._function() if self._function is not None else self.value
+
+
+class _HistogramValue(object):
+    __slots__ = ('buckets', 'counts', 'sum', 'count')
+
+    def __init__(self, buckets):
+        self.buckets = buckets
+        self.counts = [0] * (len(buckets) + 1)
+        self.sum = 0.0
+        self.count = 0
+
+    def observe(self, value):
+        self.counts[bisect_left(self.buckets, value)] += 1
+        self.sum += value
+        self.count += 1
+
+    def cumulative(self):
+        """
+        [(upper bound, observations up to it)], as Prometheus buckets are.
+        """
+        total = 0
+        buckets = []
+        for bound, count in zip(self.buckets + (math.inf,), self.counts):
+            total += count
+            buckets.append((bound, total))
+        return buckets
+
+    def get(self):
+        return {'count': self.count, 'sum': self.sum, 'buckets': dict(self.cumulative())}
+
+
+class Metric(object):
+    """
+    A metric and its series, one per combination of label values.
+
+    labels() returns the series of some label values, made on first use;
+    callers on hot paths keep it rather than looking it up each time. A
+    metric without labels is its own only series: inc(), set(), observe()
+    and the like go to it.
+
+    Instance Variables:
+        self.name       -- The metric name.
+        self.documentation -- The help text.
+        self.labelnames -- The names of the labels.
+        self._series    -- {label values: value} of the series.
+    """
+    type = None
+
+    def __init__(self, name, documentation, labelnames=(), registry=None):
+        self.name = name
+        self.documentation = documentation
+        self.labelnames = tuple(labelnames)
+        self._series = {}
+        (registry if registry is not None else REGISTRY).register(self)
+
+    def _new_value(self):
+        return _Value()
+
+    def labels(self, **labels):
+        key = tuple(str(labels[name]) for name in self.labelnames)
+        value = self._series.get(key)
+        if value is None:
+            value = self._series[key] = self._new_value()
+        return value
+
+    def remove(self, **labels):
+        """
+        Drops the series whose labels match `labels`, e.g. every series of a peer gone.
+        """
+        positions = [(self.labelnames.index(name), str(value)) for name, value in labels.items()]
+        for key in [key for key in self._series if all(key[i] == value for i, value in positions)]:
+            del self._series[key]
+
+    def __getattr__(self, name):
+        # inc(), set(), observe()... of a metric without labels
+        if name.startswith('_') or self.labelnames:
+            raise AttributeError(name)
+        return getattr(self.labels(), name)
+
+    def collect(self):
+        """
+        {((label name, value), ...): value} of the series.
+        """
+        return {tuple(zip(self.labelnames, key)): value.get() for key, value in self._series.items()}
+
+    def render(self):
+        lines = ['# HELP %s %s' % (self.name, self.documentation.replace('\\', r'\\').replace('\n', r'\n')),
+                 '# TYPE %s %s' % (self.name, self.type)]
+        for key, value in self._series.items():
+            labels = list(zip(self.labelnames, key))
+            lines.extend(self._render_series(labels, value))
+        return lines
+
+    def _render_series(self, labels, value):
+        yield '%s%s %s' % (self.name, _format_labels(labels), _format_value(value.get()))
+
+
+class Counter(Metric):
+    type = 'counter'
+
+
+class Gauge(Metric):
+    type = 'gauge'
+
+
+class Histogram(Metric):
+    type = 'histogram'
+
+    def __init__(self, name, documentation, labelnames=(), buckets=LATENCY_BUCKETS, registry=None):
+        self.buckets = tuple(sorted(buckets))
+        super().__init__(name, documentation, labelnames, registry)
+
+    def _new_value(self):
+        return _HistogramValue(self.buckets)
+
+    def _render_series(self, labels, value):
+        for bound, cumulative in value.cumulative():
+            yield '%s_bucket%s %s' % (self.name, _format_labels(labels + [('le', _format_value(bound))]),
+                                      cumulative)
+        yield '%s_sum%s %s' % (self.name, _format_labels(labels), _format_value(value.sum))
+        yield '%s_count%s %s' % (self.name, _format_labels(labels), value.count)
+
+
+def _format_labels(labels):
+    if not labels:
+        return ''
+    return '{%s}' % ','.join('%s="%s"' % (name, value.replace('\\', r'\\').replace('"', r'\"').replace('\n', r'\n'))
+                             for name, value in labels)
+
+
+def _format_value(value):
+    if value == math.inf:
+        return '+Inf'
+    if value == -math.inf:
+        return '-Inf'
+    if isinstance(value, float) and value.is_integer():
+        return '%d.0' % value
+    return repr(value)
+
+
+class Registry(object):
+    """
+    The metrics of the process, rendered in the Prometheus text format or read from Python.
+
+    Instance Variables:
+        self._metrics   -- {name: Metric}.
+    """
+    def __init__(self):
+        self._metrics = {}
+
+    def register(self, metric: Metric):
+        if metric.name in self._metrics:
+            raise ValueError('Metric %s is registered already' % metric.name)
+        self._metrics[metric.name] = metric
+
+    def get(self, name):
+        return self._metrics[name]
+
+    def collect(self):
+        """
+        {metric name: {labels: value}}, a histogram value being a dict of its count, sum and cumulative buckets.
+        """
+        return {name: metric.collect() for name, metric in self._metrics.items()}
+
+    def remove(self, **labels):
+        """
+        Drops the series matching `labels` from every metric having those labels.
+        """
+        for metric in self._metrics.values():
+            if all(name in metric.labelnames for name in labels):
+                metric.remove(**labels)
+
+    def render(self):
+        lines = []
+        for metric in self._metrics.values():
+            lines.extend(metric.render())
+        return '\n'.join(lines) + '\n'
+
+
+REGISTRY = Registry()
+
+DOWNLOADED_BYTES = Counter('bittorrent_downloaded_bytes_total', 'Bytes of blocks received.', ['torrent'])
+UPLOADED_BYTES = Counter('bittorrent_uploaded_bytes_total', 'Bytes of blocks sent.', ['torrent'])
+PEER_DOWNLOADED_BYTES = Counter('bittorrent_peer_downloaded_bytes_total', 'Bytes of blocks received from each peer.',
+                                ['torrent', 'peer'])
+PEER_UPLOADED_BYTES = Counter('bittorrent_peer_uploaded_bytes_total', 'Bytes of blocks sent to each peer.',
+                              ['torrent', 'peer'])
+WASTED_BYTES = Counter('bittorrent_wasted_bytes_total',
+                       'Bytes of blocks received for nothing: duplicates, mostly from the endgame, or not requested.',
+                       ['torrent'])
+PIECES_VERIFIED = Counter('bittorrent_pieces_verified_total', 'Pieces hash checked, by result.',
+                          ['torrent', 'result'])
+HASH_QUEUE = Gauge('bittorrent_hash_queue_pieces', 'Pieces queued or being hashed.')
+DISK_QUEUE = Gauge('bittorrent_disk_queue_bytes', 'Bytes of verified pieces not written yet.')
+DISK_LATENCY = Histogram('bittorrent_disk_seconds', 'Time of the disk operations: block reads, cache flushes.',
+                         ['op'])
+TRACKER_LATENCY = Histogram('bittorrent_tracker_announce_seconds', 'Time of the tracker announces.',
+                            ['protocol', 'result'])
+CONNECTIONS = Gauge('bittorrent_connections', 'Peer connections, by state.', ['state'])
+LOOP_LAG = Histogram('bittorrent_event_loop_lag_seconds', 'Delay of the event loop running a timer past its time.')
+
+
+async def monitor_loop_lag(interval=LOOP_LAG_INTERVAL):
+    """
+    Measures how late the event loop wakes up a sleep, into LOOP_LAG.
+    """
+    loop = asyncio.get_event_loop()
+    while True:
+        expected = loop.time() + interval
+        await asyncio.sleep(interval)
+        LOOP_LAG.observe(max(0.0, loop.time() - expected))
+
+
+class Timer(object):
+    """
+    Context manager observing the time it ran into a histogram series.
+    """
+    __slots__ = ('_series', '_start')
+
+    def __init__(self, series):
+        self._series = series
+
+    def __enter__(self):
+        self._start = time.monotonic()
+        return self
+
+    def __exit__(self, exc_type, exc, traceback):
+        self._series.observe(time.monotonic() - self._start)
+
+
+async def start_http_server(host='127.0.0.1', port=METRICS_PORT, registry=None):
+    """
+    Serves the metrics at http://host:port/metrics. Returns the asyncio server.
+    """
+    registry = registry if registry is not None else REGISTRY
+
+    async def handle(reader, writer):
+        try:
+            request = await asyncio.wait_for(reader.readuntil(b'\r\n\r\n'), 10)
+            method, path = request.split(b' ', 2)[:2]
+            if method != b'GET':
+                status, body = '405 Method Not Allowed', b''
+            elif path.split(b'?')[0] not in (b'/', b'/metrics'):
+                status, body = '404 Not Found', b''
+            else:
+                status, body = '200 OK', registry.render().encode()
+            writer.write(('HTTP/1.1 %s\r\nContent-Type: %s\r\nContent-Length: %s\r\nConnection: close\r\n\r\n'
+                          % (status, CONTENT_TYPE, len(body))).encode() + body)
+            await writer.drain()
+        except (asyncio.TimeoutError, asyncio.IncompleteReadError, asyncio.LimitOverrunError,
+                ValueError, ConnectionError) as e:
+            logging.debug("Metrics request failed: %r" % e)
+        finally:
+            writer.close()
+
+    server = await asyncio.start_server(handle, host, port)
+    logging.info("Metrics at http://%s:%s/metrics" % (host, server.sockets[0].getsockname()[1]))
+    return server
@@ -4,11 +4,31 @@ import socket
 from bencode import bdecode, bencode
 
 
+COMPACT_IPV4 = struct.Struct('!4sH')
+COMPACT_IPV6 = struct.Struct('!16sH')
+
+
 def read_torrent_file(torrent_file):
     with open(torrent_file, 'rb') as file:
         return bdecode(file.read())
 
+
+def parse_compact_peers(data, ipv6=False):
+    """
+    Parses a compact peer list: 6 bytes per IPv4 peer, or 18 bytes per IPv6 peer (BEP 7).
+    """
+    record, family = (COMPACT_IPV6, socket.AF_INET6) if ipv6 else (COMPACT_IPV4, socket.AF_INET)
+    view = memoryview(data)
+    if len(view) % record.size != 0:
+        raise ValueError('Invalid length of a compact representation of peers')
+    ntop = socket.inet_ntop
+    return [Peer(ntop(family, ip), port) for ip, port in record.iter_unpack(view)]
+
+
 class Peer:
+    __slots__ = ('_host', '_port', '_hash', '_piece_owned', '_am_choking', '_am_interested',
+                 '_peer_choking', '_peer_interested', '_connected')
+
     def __init__(self, host, port, peer_id=None):
         self._host = host
         self._port = port
@@ -30,9 +50,15 @@ class Peer:
 
     @classmethod
     def from_compact_form(cls, data):
-        ip, port = struct.unpack('!4sH', data)
-        host = socket.inet_ntoa(ip)
-        return cls(host, port)
+        if len(data) == COMPACT_IPV6.size:
+            ip, port = COMPACT_IPV6.unpack(data)
+            return cls(socket.inet_ntop(socket.AF_INET6, ip), port)
+        ip, port = COMPACT_IPV4.unpack(data)
+        return cls(socket.inet_ntoa(ip), port)
+
+    @property
+    def is_ipv6(self):
+        return ':' in self._host
 
     @property
     def host(self) -> str:
@@ -42,6 +68,55 @@ class Peer:
     def port(self) -> int:
         return self._port
 
+    @property
+    def piece_owned(self):
+        """The bitmap of pieces the peer announced, None before its bitfield."""
+        return self._piece_owned
+
+    @piece_owned.setter
+    def piece_owned(self, value):
+        self._piece_owned = value
+
+    @property
+    def am_choking(self):
+        return self._am_choking
+
+    @am_choking.setter
+    def am_choking(self, value):
+        self._am_choking = value
+
+    @property
+    def am_interested(self):
+        return self._am_interested
+
+    @am_interested.setter
+    def am_interested(self, value):
+        self._am_interested = value
+
+    @property
+    def peer_choking(self):
+        return self._peer_choking
+
+    @peer_choking.setter
+    def peer_choking(self, value):
+        self._peer_choking = value
+
+    @property
+    def peer_interested(self):
+        return self._peer_interested
+
+    @peer_interested.setter
+    def peer_interested(self, value):
+        self._peer_interested = value
+
+    @property
+    def connected(self):
+        return self._connected
+
+    @connected.setter
+    def connected(self, value):
+        self._connected = value
+
     def __eq__(self, other):
         if not isinstance(other, Peer):
             return False
@@ -51,6 +126,8 @@ class Peer:
         return self._hash
 
     def __repr__(self):
+        if self.is_ipv6:
+            return '[{}]:{}'.format(self._host, self._port)
         return '{}:{}'.format(self._host, self._port)
 
 
@@ -0,0 +1,292 @@
+import asyncio
+import struct
+
+from collections import deque
+
+from errors import PeerError
+from process_msg import MAX_MESSAGE_LENGTH, PIECE, PIECE_BLOCK
+
+READ_BUFFER_SIZE = 2 ** 16
+# Length prefix, message id, index and begin of a piece message
+PIECE_HEADER_SIZE = 13
+# Pseudo message id of a block received in place, its payload is (index, begin, length)
+BLOCK_RECEIVED = -1
+# Reading pauses while this many messages wait for the session
+MAX_QUEUED_MESSAGES = 64
+
+_LENGTH = struct.Struct('>I')
+
+
+class PeerProtocol(asyncio.BufferedProtocol):
+    """
+    A peer connection receiving with recv_into(), so that block payloads
+    are read straight into the piece buffers.
+
+    Until start_messages() the protocol is read with readexactly(), for the
+    handshake. Then it parses the length-prefixed messages from the read
+    buffer. Once the header of a piece message is in, the `block_buffer`
+    callback may give the place of the block in its piece: the part of the
+    payload read with the header is copied there, the rest is received
+    there directly, and the message comes out as
+    (BLOCK_RECEIVED, (index, begin, length)). Other messages come out of
+    read_message() like from process_msg.read_message().
+
+    Reading no further than each piece header would receive every payload
+    in place, but costs a second recv_into() per block, which is dearer in
+    Python than copying what was read ahead.
+
+    It also stands in for the StreamWriter: write(), drain(), close(),
+    is_closing() and self.transport.
+
+    Instance Variables:
+        self.transport      -- The transport of the connection.
+        self._buffer        -- The read buffer, replaced by a larger one for the messages larger than it.
+        self._filled        -- The bytes received in self._buffer and not parsed yet.
+        self._framing       -- Whether the messages are parsed, after the handshake.
+        self._block_buffer  -- Callable(index, begin, length) returning the memoryview to receive a block in, or None.
+        self._declined      -- Whether the callback declined the piece message at the start of the buffer.
+        self._target        -- The memoryview the block being received goes to, None for none.
+        self._target_filled -- The bytes of the block received so far.
+        self._block         -- The (index, begin, length) of the block being received.
+        self._messages      -- Deque of the (message id, payload) not read yet.
+        self._waiter        -- Future of the reader waiting for data.
+        self._exception     -- The exception ending the connection, raised to the reader.
+        self._eof           -- Whether the peer closed its side.
+        self._reading_paused -- Whether reading is paused because the messages pile up.
+        self._write_paused  -- Whether the transport asked to stop writing, drain() waits then.
+        self._drain_waiter  -- Future of drain() while the transport buffer is full.
+    """
+    def __init__(self, client_connected_cb=None):
+        self.transport = None
+        self._buffer = bytearray(READ_BUFFER_SIZE)
+        self._filled = 0
+        self._framing = False
+        self._block_buffer = None
+        self._declined = False
+        self._target = None
+        self._target_filled = 0
+        self._block = None
+        self._messages = deque()
+        self._waiter = None
+        self._exception = None
+        self._eof = False
+        self._reading_paused = False
+        self._write_paused = False
+        self._drain_waiter = None
+        self._client_connected_cb = client_connected_cb
+        self._task = None
+
+    def connection_made(self, transport):
+        self.transport = transport
+        if self._client_connected_cb is not None:
+            # Like asyncio.start_server(), the protocol is both the reader and the writer
+            self._task = asyncio.ensure_future(self._client_connected_cb(self, self))
+
+    def connection_lost(self, exc):
+        if exc is not None:
+            self._exception = exc
+        self._eof = True
+        self._wake()
+        if self._drain_waiter is not None and not self._drain_waiter.done():
+            self._drain_waiter.set_exception(ConnectionResetError('Connection lost'))
+
+    def eof_received(self):
+        self._eof = True
+        self._wake()
+        return False
+
+    def pause_writing(self):
+        self._write_paused = True
+
+    def resume_writing(self):
+        self._write_paused = False
+        if self._drain_waiter is not None and not self._drain_waiter.done():
+            self._drain_waiter.set_result(None)
+
+    def _wake(self):
+        if self._waiter is not None and not self._waiter.done():
+            self._waiter.set_result(None)
+
+    def _fail(self, exc):
+        self._exception = exc
+        self._wake()
+        self.transport.close()
+
+    def _frame_limit(self):
+        """
+        How far the buffer is filled: at least to the end of the message starting it.
+        """
+        if self._filled < 4:
+            return len(self._buffer)
+        length, = _LENGTH.unpack_from(self._buffer)
+        return max(4 + length, len(self._buffer))
+
+    def get_buffer(self, sizehint):
+        if self._target is not None:
+            return self._target[self._target_filled:]
+        limit = self._frame_limit() if self._framing else len(self._buffer)
+        if limit > len(self._buffer):
+            # A message larger than the buffer, e.g. a big bitfield. Replaced, not resized, as
+            # the transport still holds a view of the old one.
+            buffer = bytearray(limit)
+            buffer[:self._filled] = self._buffer[:self._filled]
+            self._buffer = buffer
+        return memoryview(self._buffer)[self._filled:limit]
+
+    def buffer_updated(self, nbytes):
+        if self._target is not None:
+            self._target_filled += nbytes
+            if self._target_filled == len(self._target):
+                self._target = None
+                self._push((BLOCK_RECEIVED, self._block))
+            return
+        self._filled += nbytes
+        if self._framing:
+            try:
+                self._parse()
+            except PeerError as e:
+                self._fail(e)
+        else:
+            if self._filled == len(self._buffer):
+                # The peer sends messages before we are through the handshake
+                self._pause_reading()
+            self._wake()
+
+    def _parse(self):
+        buffer = self._buffer
+        start = 0
+        filled = self._filled
+        while filled - start >= 4:
+            length, = _LENGTH.unpack_from(buffer, start)
+            if length == 0:
+                self._push((None, b''))
+                start += 4
+                continue
+            if length > MAX_MESSAGE_LENGTH:
+                raise PeerError('Message of %s bytes is too long' % length)
+            if filled - start < 5:
+                break
+            if buffer[start + 4] == PIECE and self._block_buffer is not None and not self._declined:
+                if length < 1 + PIECE_BLOCK.size:
+                    raise PeerError('Piece message of %s bytes is too short' % length)
+                if filled - start < PIECE_HEADER_SIZE:
+                    break
+                index, begin = PIECE_BLOCK.unpack_from(buffer, start + 5)
+                size = length - 1 - PIECE_BLOCK.size
+                target = self._block_buffer(index, begin, size)
+                if target is not None:
+                    start += PIECE_HEADER_SIZE
+                    received = min(filled - start, size)
+                    target[:received] = buffer[start:start + received]
+                    start += received
+                    if received == size:
+                        self._push((BLOCK_RECEIVED, (index, begin, size)))
+                        continue
+                    self._target, self._target_filled, self._block = target, received, (index, begin, size)
+                    break
+                # Read with the other messages and copied, e.g. a block we did not ask for
+                self._declined = True
+            if filled - start < 4 + length:
+                break
+            self._declined = False
+            self._push((buffer[start + 4], memoryview(bytes(buffer[start + 5:start + 4 + length]))))
+            start += 4 + length
+
+        if start:
+            buffer[:filled - start] = buffer[start:filled]
+            self._filled = filled - start
+        if not self._filled and len(buffer) > READ_BUFFER_SIZE:
+            self._buffer = bytearray(READ_BUFFER_SIZE)
+
+    def _push(self, message):
+        self._messages.append(message)
+        self._wake()
+        if len(self._messages) >= MAX_QUEUED_MESSAGES:
+            self._pause_reading()
+
+    def _pause_reading(self):
+        if not self._reading_paused:
+            self._reading_paused = True
+            self.transport.pause_reading()
+
+    def _resume_reading(self):
+        if self._reading_paused:
+            self._reading_paused = False
+            self.transport.resume_reading()
+
+    async def _wait(self):
+        self._waiter = asyncio.get_event_loop().create_future()
+        try:
+            await self._waiter
+        finally:
+            self._waiter = None
+
+    async def readexactly(self, n):
+        """
+        Reads `n` bytes before start_messages(), e.g. the handshake.
+        """
+        while self._filled < n:
+            if self._exception is not None:
+                raise self._exception
+            if self._eof:
+                raise asyncio.IncompleteReadError(bytes(self._buffer[:self._filled]), n)
+            await self._wait()
+        data = bytes(self._buffer[:n])
+        self._buffer[:self._filled - n] = self._buffer[n:self._filled]
+        self._filled -= n
+        return data
+
+    def start_messages(self, block_buffer=None):
+        """
+        Starts parsing messages, receiving the blocks where `block_buffer` says if given.
+        """
+        self._framing = True
+        self._block_buffer = block_buffer
+        try:
+            self._parse()
+        except PeerError as e:
+            self._fail(e)
+        if len(self._messages) < MAX_QUEUED_MESSAGES:
+            self._resume_reading()
+
+    async def read_message(self):
+        """
+        Returns the next (message id, payload); (None, b'') for a keep-alive.
+        """
+        while not self._messages:
+            if self._exception is not None:
+                raise self._exception
+            if self._eof:
+                raise asyncio.IncompleteReadError(b'', None)
+            await self._wait()
+        message = self._messages.popleft()
+        if len(self._messages) < MAX_QUEUED_MESSAGES // 2:
+            self._resume_reading()
+        return message
+
+    def write(self, data):
+        self.transport.write(data)
+
+    def is_closing(self):
+        return self.transport.is_closing()
+
+    def close(self):
+        self.transport.close()
+
+    def get_extra_info(self, name, default=None):
+        return self.transport.get_extra_info(name, default)
+
+    async def drain(self):
+        if self._exception is not None:
+            raise ConnectionResetError('Connection lost')
+        if self.transport.is_closing():
+            # Lets connection_lost() run, like StreamWriter.drain()
+            await asyncio.sleep(0)
+            raise ConnectionResetError('Connection lost')
+        if not self._write_paused:
+            return
+        self._drain_waiter = asyncio.get_event_loop().create_future()
+        try:
+            await self._drain_waiter
+        finally:
+            self._drain_waiter = None
@@ -2,66 +2,239 @@ from math import ceil
 from bitarray import bitarray
 
 BLOCK_SIZE = 2 ** 14
+SHA1_DIGEST_LEN = 20
+
+
+class PieceTable:
+    """
+    Per-piece state of the whole torrent, kept in flat bitmaps and one hash
+    buffer so that its footprint does not grow by Python objects per piece.
+    A PieceInfo is only created for pieces currently in flight.
+
+    Instance Variables:
+        self._hashes        -- All piece hashes in one contiguous buffer, SHA1_DIGEST_LEN bytes each.
+        self._count         -- The number of pieces.
+        self._piece_length  -- The length of each piece beside the last one.
+        self._last_length   -- The length of the last piece.
+        self.selected       -- Bitmap of the pieces covering selected files.
+        self.downloaded     -- Bitmap of the pieces already downloaded and verified.
+        self._active        -- {index: PieceInfo} of the pieces in flight.
+    """
+    def __init__(self, piece_hashes, piece_length, total_size):
+        self._hashes = memoryview(piece_hashes)
+        self._count = len(self._hashes) // SHA1_DIGEST_LEN
+        self._piece_length = piece_length
+        self._last_length = total_size - (self._count - 1) * piece_length
+
+        self.selected = bitarray(self._count)
+        self.selected.setall(False)
+        self.downloaded = bitarray(self._count)
+        self.downloaded.setall(False)
+
+        self._active = {}
+
+    def __len__(self):
+        return self._count
+
+    def __getitem__(self, index):
+        """
+        Returns the PieceInfo of piece `index`, creating it if it is not in flight yet.
+        """
+        piece = self._active.get(index)
+        if piece is None:
+            if not 0 <= index < self._count:
+                raise IndexError('Piece index %s out of range' % index)
+            piece = self._active[index] = PieceInfo(self, index)
+        return piece
+
+    def get_active(self, index):
+        return self._active.get(index)
+
+    @property
+    def active(self):
+        return self._active.values()
+
+    def release(self, index):
+        """
+        Forgets the in-flight state of piece `index`.
+        """
+        self._active.pop(index, None)
+
+    def piece_hash(self, index):
+        begin = index * SHA1_DIGEST_LEN
+        return bytes(self._hashes[begin:begin + SHA1_DIGEST_LEN])
+
+    def piece_length(self, index):
+        if index == self._count - 1:
+            return self._last_length
+        return self._piece_length
+
+    def mark_as_downloaded(self, index):
+        if self.downloaded[index]:
+            raise ValueError('The piece is already downloaded')
+        self.downloaded[index] = True
+        self.release(index)
+
+    def mark_as_missing(self, index):
+        """
+        Forgets that piece `index` was downloaded, e.g. when it could not be written.
+        """
+        self.downloaded[index] = False
+
+    @property
+    def downloaded_count(self):
+        return self.downloaded.count()
 
 
 class PieceInfo:
     """
+    Lightweight view of a piece in flight, created by PieceTable.
+
     Instance Variables:
+        self._table         -- The PieceTable owning the piece.
         self._index         -- Unique piece ID.
-        self._piece_hash    -- The hash from torrent.
         self._length        -- The length of the piece, same for all piece beside the last one.
         self._num_blocks    -- The number of  blocks to download.
         self._blocks_downloaded -- The number of  blocks already downloaded. (bitmap)
-        self.blocks         -- The list of blocks.
+        self._blocks_requested  -- The blocks requested from some peer and not received yet. (bitmap)
+        self._blocks_saved  -- The blocks written to disk with the resume state. (bitmap)
+        self._buffer        -- The piece data, allocated on the first block and assembled in place.
+        self._view          -- memoryview over self._buffer.
     """
-    def __init__(self, index, piece_hash, length):
-        self._index = index
-        self._piece_hash = piece_hash
-        self._length = length
-        self._num_blocks = ceil(length / BLOCK_SIZE)
-        self._blocks_downloaded = bitarray('0' * int(self._num_blocks))
+    __slots__ = ('_table', '_index', '_length', '_num_blocks', '_blocks_downloaded', '_blocks_requested',
+                 '_blocks_saved', '_buffer', '_view', '_best_peer')
 
-        self.blocks = self.into_blocks()
+    def __init__(self, table, index):
+        self._table = table
+        self._index = index
+        self._length = table.piece_length(index)
+        self._num_blocks = ceil(self._length / BLOCK_SIZE)
+        self._blocks_downloaded = bitarray(self._num_blocks)
+        self._blocks_downloaded.setall(False)
+        self._blocks_requested = bitarray(self._num_blocks)
+        self._blocks_requested.setall(False)
+        self._blocks_saved = bitarray(self._num_blocks)
+        self._blocks_saved.setall(False)
+        self._buffer = None
+        self._view = None
 
-        self.selected = False
         self._best_peer = None
-        self._downloaded = False
 
-    def into_blocks(self):
-        blocks = []
-        for block_idx in range(self._num_blocks - 1):
-            blocks.append(BlockInfo(self._index, BLOCK_SIZE * block_idx, BLOCK_SIZE))
-        blocks.append(BlockInfo(self._index, (self._num_blocks - 1) * BLOCK_SIZE,\
-                                self._length - BLOCK_SIZE * (self._num_blocks - 1)))
-        return blocks
+    def block_length(self, block_idx):
+        if block_idx == self._num_blocks - 1:
+            return self._length - BLOCK_SIZE * block_idx
+        return BLOCK_SIZE
+
+    @property
+    def blocks(self):
+        """
+        The blocks of the piece, derived on demand.
+        """
+        return [BlockInfo(self._index, BLOCK_SIZE * block_idx, self.block_length(block_idx))
+                for block_idx in range(self._num_blocks)]
+
+    def next_block(self):
+        """
+        Marks the first block neither received nor requested as requested.
+        Returns its (begin, length), None if there is no such block.
+        """
+        block_idx = (self._blocks_downloaded | self._blocks_requested).find(0)
+        if block_idx < 0:
+            return None
+        self._blocks_requested[block_idx] = True
+        return block_idx * BLOCK_SIZE, self.block_length(block_idx)
+
+    def abort_block(self, begin):
+        """
+        Makes a requested block available again, e.g. when the peer choked us.
+        """
+        self._blocks_requested[begin // BLOCK_SIZE] = False
 
     def save_block(self, begin, data):
         """
-        Writes block 'data' into block object
+        Copies block 'data' to its offset in the piece buffer.
+        Returns False if the block was already received.
+        """
+        view = self.block_buffer(begin, len(data))
+        if view is None:
+            return False
+        view[:] = data
+        self.block_received(begin)
+        return True
+
+    def block_buffer(self, begin, length):
+        """
+        The memoryview of the piece buffer where block `begin` goes, to receive it
+        in place. None if the block was already received.
+        """
+        block_idx, remainder = divmod(begin, BLOCK_SIZE)
+        if remainder or not 0 <= block_idx < self._num_blocks:
+            raise ValueError('Invalid block offset %s in piece %s' % (begin, self._index))
+        if length != self.block_length(block_idx):
+            raise ValueError('Invalid length %s of block %s in piece %s' % (length, begin, self._index))
+        if self._blocks_downloaded[block_idx]:
+            return None
+
+        if self._buffer is None:
+            self._buffer = bytearray(self._length)
+            self._view = memoryview(self._buffer)
+        return self._view[begin:begin + length]
+
+    def block_received(self, begin):
+        """
+        Marks block `begin` as received, once its data is in the buffer.
+        Returns False if it was already received.
+        """
+        block_idx = begin // BLOCK_SIZE
+        if self._blocks_downloaded[block_idx]:
+            return False
+        self._blocks_downloaded[block_idx] = True
+        self._blocks_requested[block_idx] = False
+        return True
+
+    def restore_blocks(self, blocks_downloaded, data):
+        """
+        Loads the blocks marked in `blocks_downloaded` from `data`, the piece
+        as read back from disk (fast resume).
         """
-        for block_idx, block in enumerate(self.blocks):
-            if block.begin == begin:
-                block.data = data
-                self._blocks_downloaded[block_idx] = True
+        if self._buffer is None:
+            self._buffer = bytearray(self._length)
+            self._view = memoryview(self._buffer)
+        for block_idx in blocks_downloaded.search(bitarray('1')):
+            begin = block_idx * BLOCK_SIZE
+            end = begin + self.block_length(block_idx)
+            self._view[begin:end] = data[begin:end]
+        self._blocks_downloaded |= blocks_downloaded
+        self._blocks_requested &= ~blocks_downloaded
+        self._blocks_saved |= blocks_downloaded
+
+    @property
+    def blocks_downloaded(self):
+        return self._blocks_downloaded
+
+    @property
+    def blocks_saved(self):
+        return self._blocks_saved
 
     def mark_as_downloaded(self):
-        if self._downloaded:
-            raise ValueError('The piece is already downloaded')
-        self._downloaded = True
+        self._table.mark_as_downloaded(self._index)
 
     def flush(self):
-        [block.flush() for block in self.blocks]
+        # The buffer is kept, the blocks are simply received again over it.
+        self._blocks_downloaded.setall(False)
+        self._blocks_requested.setall(False)
+        self._blocks_saved.setall(False)
 
     @property
-    def data(self) -> bytes:
+    def data(self) -> memoryview:
         """
-        Returns Piece data
+        Returns Piece data, a view of the assembly buffer (no copy).
         """
-        return b''.join([block.data for block in self.blocks])
+        return self._view
 
     @property
     def piece_hash(self):
-        return self._piece_hash
+        return self._table.piece_hash(self._index)
 
     @property
     def index(self):
@@ -71,9 +244,17 @@ class PieceInfo:
     def length(self):
         return self._length
 
+    @property
+    def selected(self):
+        return self._table.selected[self._index]
+
+    @selected.setter
+    def selected(self, value):
+        self._table.selected[self._index] = value
+
     @property
     def is_complete(self):
-        return self._downloaded or self._blocks_downloaded.all()
+        return self._table.downloaded[self._index] or self._blocks_downloaded.all()
 
     @property
     def best_peer(self):
@@ -81,11 +262,9 @@ class PieceInfo:
 
 
 class BlockInfo(object):
+    __slots__ = ('piece', 'begin', 'length')
+
     def __init__(self, piece, begin, length):
         self.piece = piece
         self.begin = begin
         self.length = length
-        self.data = None
-
-    def flush(self):
-        self.data = None
@@ -0,0 +1,244 @@
+import random
+
+from bitarray import bitarray
+from bitarray.util import any_and, ones, zeros
+
+from budget import PIECES
+
+RAREST_FIRST = 'rarest-first'
+RANDOM_FIRST = 'random-first'
+SEQUENTIAL = 'sequential'
+
+# RANDOM_FIRST picks at random until this many pieces are downloaded, then rarest first
+RANDOM_FIRST_COUNT = 4
+
+
+class PiecePicker:
+    """
+    Decides which blocks to request from a peer.
+
+    Started pieces are finished first. New pieces are picked among the wanted
+    pieces (covering selected files and not downloaded) nobody started yet.
+
+    Availability is kept as bitmaps rather than per-piece counts: peers
+    having every piece are only counted in self.seeds, the others are
+    counted in buckets, one bitmap of the pieces per number of such peers
+    having them. Bitfields move the pieces between the buckets with one
+    bitwise operation per bucket, have messages move one piece, and the
+    rarest piece a peer has is found in the lowest bucket intersecting its
+    pieces, so nothing loops over the pieces in Python.
+
+    Instance Variables:
+        self._pieces        -- The PieceTable of the torrent.
+        self._policy        -- RAREST_FIRST, RANDOM_FIRST or SEQUENTIAL.
+        self.seeds          -- The number of connected peers having every piece.
+        self._buckets       -- self._buckets[n] is the bitmap of the pieces n other peers have.
+        self._wanted        -- Bitmap of the pieces selected and not downloaded.
+        self._unstarted     -- Bitmap of the wanted pieces not started yet.
+        self._unstarted_count -- The number of bits set in self._unstarted.
+        self._partial       -- Started pieces with blocks left to request.
+        self._requested     -- Started pieces with every block requested or received.
+        self._budget        -- The MemoryBudget charged for the pieces started, None for no limit.
+    """
+    def __init__(self, pieces, policy=RAREST_FIRST, random_first_count=RANDOM_FIRST_COUNT, budget=None):
+        if policy not in (RAREST_FIRST, RANDOM_FIRST, SEQUENTIAL):
+            raise ValueError('Unknown piece picking policy %s' % policy)
+        self._pieces = pieces
+        self._policy = policy
+        self._random_first_count = random_first_count
+        self._budget = budget
+
+        self.seeds = 0
+        self._buckets = [ones(len(pieces))]
+        self._wanted = pieces.selected & ~pieces.downloaded
+        self._unstarted = bitarray(self._wanted)
+        self._partial = set()
+        self._requested = set()
+        # Pieces already in flight, e.g. restored from resume data, are finished first
+        for piece in pieces.active:
+            if self._unstarted[piece.index]:
+                self._unstarted[piece.index] = False
+                self._partial.add(piece.index)
+                if budget is not None:
+                    budget.acquire(PIECES, piece.length)
+        self._unstarted_count = self._unstarted.count()
+
+    def _raise(self, piece_owned):
+        # From the top, so that no piece moves twice
+        buckets = self._buckets
+        for count in range(len(buckets) - 1, -1, -1):
+            if any_and(buckets[count], piece_owned):
+                moved = buckets[count] & piece_owned
+                buckets[count] ^= moved
+                if count + 1 == len(buckets):
+                    buckets.append(moved)
+                else:
+                    buckets[count + 1] |= moved
+
+    def _lower(self, piece_owned):
+        buckets = self._buckets
+        for count in range(1, len(buckets)):
+            if any_and(buckets[count], piece_owned):
+                moved = buckets[count] & piece_owned
+                buckets[count] ^= moved
+                buckets[count - 1] |= moved
+        while len(buckets) > 1 and not buckets[-1].any():
+            buckets.pop()
+
+    def _count(self, index):
+        for count, bucket in enumerate(self._buckets):
+            if bucket[index]:
+                return count
+
+    def add_peer(self, piece_owned):
+        """
+        Counts the pieces of a peer that sent its bitfield.
+        """
+        if piece_owned.all():
+            self.seeds += 1
+        else:
+            self._raise(piece_owned)
+
+    def remove_peer(self, piece_owned):
+        """
+        Uncounts the pieces of a peer that disconnected, or whose bitfield is replaced.
+        """
+        if piece_owned.all():
+            self.seeds -= 1
+        else:
+            self._lower(piece_owned)
+
+    def add_have(self, index, piece_owned=None):
+        """
+        Counts piece `index` of a peer that announced it. Given the pieces of
+        the peer, with `index` set already, a peer completing becomes a seed.
+        """
+        count = self._count(index)
+        self._buckets[count][index] = False
+        if count + 1 == len(self._buckets):
+            self._buckets.append(zeros(len(self._pieces)))
+        self._buckets[count + 1][index] = True
+        if piece_owned is not None and piece_owned.all():
+            self._lower(piece_owned)
+            self.seeds += 1
+
+    def availability(self, index):
+        return self.seeds + self._count(index)
+
+    def is_interesting(self, piece_owned):
+        return any_and(piece_owned, self._wanted)
+
+    def is_wanted(self, index):
+        return self._wanted[index]
+
+    @property
+    def all_requested(self):
+        """
+        Whether every block left is requested already, i.e. the endgame.
+        """
+        return self._unstarted_count == 0 and not self._partial
+
+    @property
+    def started(self):
+        """
+        The pieces started and not verified yet.
+        """
+        return self._partial | self._requested
+
+    @property
+    def complete(self):
+        return not self._wanted.any()
+
+    def pick(self, piece_owned, count):
+        """
+        Marks up to `count` blocks the peer has as requested and returns
+        them as a list of (index, begin, length). No new piece is started
+        when the memory budget is used up.
+        """
+        blocks = []
+        for index in list(self._partial):
+            if piece_owned[index]:
+                self._take_blocks(index, count - len(blocks), blocks)
+                if len(blocks) == count:
+                    return blocks
+
+        if not self._unstarted_count:
+            return blocks
+        for index in self._candidates(piece_owned):
+            # Started pieces are finished, new ones wait for memory
+            if self._budget is not None and not self._budget.try_acquire(PIECES, self._pieces.piece_length(index)):
+                break
+            self._start(index)
+            self._take_blocks(index, count - len(blocks), blocks)
+            if len(blocks) == count:
+                break
+        return blocks
+
+    def _take_blocks(self, index, count, blocks):
+        piece = self._pieces[index]
+        while count:
+            block = piece.next_block()
+            if block is None:
+                self._partial.discard(index)
+                self._requested.add(index)
+                return
+            blocks.append((index, ) + block)
+            count -= 1
+
+    def _start(self, index):
+        self._unstarted[index] = False
+        self._unstarted_count -= 1
+        self._partial.add(index)
+
+    def _candidates(self, piece_owned):
+        """
+        Yields the unstarted pieces the peer has, in the order of the policy.
+        """
+        candidates = self._unstarted & piece_owned
+        if self._policy == SEQUENTIAL:
+            yield from candidates.search(1)
+            return
+
+        if self._policy == RANDOM_FIRST and self._pieces.downloaded_count < self._random_first_count:
+            start = random.randrange(len(candidates)) if len(candidates) else 0
+            yield from candidates.search(1, start)
+            yield from candidates.search(1, 0, start)
+            return
+
+        # Rarest first. Pieces only seeds have are in bucket 0.
+        for bucket in self._buckets:
+            if any_and(bucket, candidates):
+                yield from (bucket & candidates).search(1)
+
+    def abort_block(self, index, begin):
+        """
+        Makes a requested block available again.
+        """
+        piece = self._pieces.get_active(index)
+        if piece is None:
+            return
+        piece.abort_block(begin)
+        if index in self._requested:
+            self._requested.discard(index)
+            self._partial.add(index)
+
+    def piece_done(self, index):
+        self._wanted[index] = False
+        self._partial.discard(index)
+        self._requested.discard(index)
+
+    def piece_lost(self, index):
+        """
+        The verified piece could not be written, it is wanted again.
+        """
+        if self._pieces.selected[index] and not self._wanted[index]:
+            self._wanted[index] = True
+            self._unstarted[index] = True
+            self._unstarted_count += 1
+
+    def piece_failed(self, index):
+        """
+        The piece failed the hash check and was flushed, download it again.
+        """
+        self._requested.discard(index)
+        self._partial.add(index)
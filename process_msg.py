@@ -1,154 +1,165 @@
-import struct
-import logging
-import socket
-
-
-class Peer_state_machine():
-    def __init__(self):
-        self.handshake = True
-        self.choked = True
-        self.sentInterested = False
-
-
-HEADER_SIZE = 28 # This is just the pstrlen+pstr+reserved
-
-def checkValidPeer(peer, infoHash):
-    """
-    Check to see if the info hash from the peer matches with the one we have
-    from the .torrent file.
-    """
-    peerInfoHash = peer.bufferRead[HEADER_SIZE:HEADER_SIZE + len(infoHash)]
-
-    if peerInfoHash == infoHash:
-        peer.bufferRead = peer.bufferRead[HEADER_SIZE + len(infoHash) + 20:]
-        peer.handshake = True
-        logging.debug("Handshake Valid")
-        return True
-    else:
-        return False
-
-
-def convertBytesToDecimal(headerBytes, power):
-    size = 0
-    for ch in headerBytes:
-        size += int((ch))*256**power
-        power -= 1
-    return size
-
-
-def constructRequest(index, offset, length):
-    request = struct.pack('>IcIII', 13, b'\x06',index,offset,length)
-    return request
-
-
-def send_request(s, info):
-    # if len(peer.bufferWrite) > 0:
-    #     return True
-    #
-    # for i in range(10):
-    #     nextBlock = peerMngr.findNextBlock(peer)
-    #     if not nextBlock:
-    #         return
-    #
-    #     index, offset, length = nextBlock
-    bufferWrite = constructRequest(0, 0, 16384)
-    s.send(bufferWrite)
-
-def send_interested(s):
-    bufferWrite = struct.pack('>Ic', 1, b'\x02')
-    s.send(bufferWrite)
-
-def handleHave(peer, payload):
-    index = convertBytesToDecimal(payload, 3)
-    logging.debug("Handling Have")
-    peer.bitField[index] = True
-
-
-
-def process_message(msg,peer_state):
-    while len(msg) > 3:
-        if not peer_state.handshake:
-            if not checkValidPeer(peer, None):
-                return False
-            elif len(msg) < 4:
-                return True
-
-        if len(msg) == 4 and msg[0:4] == '\x00\x00\x00\x00':
-            # Keep alive
-            return True
-
-        msgSize = convertBytesToDecimal(msg[0:4], 3)
-        msgCode = int(ord(msg[4:5]))
-        payload = msg[5:4+msgSize]
-
-        if len(payload) < msgSize-1:
-            # Message is not complete. Return
-            return False
-
-        #the next message?
-        msg = msg[msgSize + 4:]
-
-        if msgCode == 0:
-            # Choked
-            peer_state.choked = True
-            print('choking do nothing')
-            continue
-        elif msgCode == 1:
-            # Unchoked! send request
-            print("Unchoked! Finding block")
-            peer_state.choked = False
-            send_request(s,None)
-        elif msgCode == 4:
-            handleHave(peer, payload)
-        elif msgCode == 5:
-            # setBitField(payload)
-            pass
-        elif msgCode == 7:
-            index = convertBytesToDecimal(payload[0:4], 3)
-            offset = convertBytesToDecimal(payload[4:8], 3)
-            data = payload[8:]
-            if 0:# if index != peerMngr.curPiece.pieceIndex:
-                return True ##丢弃这个piece
-            print("Bitfield initalized. "
-                          "Sending peer we are interested...")
-            send_interested(s)
-            peer_state.sentInterested = True
-
-
-
-
-    return True
-
-
-def test_send_recv(msg, host, port, recv_len):
-    """ Sends a handshake to peer, returns the data we get back. """
-
-    s = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
-    s.connect((host, port))
-    s.send(msg)
-
-    data = s.recv(recv_len)
-    # s.close()
-
-    print(data)
-    return data,s
-
-if __name__ == '__main__':
-
-    trackerFile = 'gd76-07-18remastered.torrent'
-    peer_mngr = PeerManager(trackerFile)
-    peer_mngr.run_no_threads()
-    peer = peer_mngr.peers[0]
-    msg,s = netfunc.send_recv_handshake(peer_mngr.handshake, '97.81.134.19', 14907)
-    peer_state = Peer_state_machine()
-    a = 0
-    while True:
-
-        msg = s.recv(1024)
-        ret = process_message(msg,peer_state)
-        if peer_state.choked == True:
-            continue
-
-    # s.close()
-
-
+import asyncio
+import struct
+
+from errors import PeerError
+
+PROTOCOL_NAME = b'BitTorrent protocol'
+HANDSHAKE_LENGTH = 68
+# Large enough for the bitfield of a torrent with millions of pieces
+MAX_MESSAGE_LENGTH = 2 ** 21
+
+# Message ids
+CHOKE = 0
+UNCHOKE = 1
+INTERESTED = 2
+NOT_INTERESTED = 3
+HAVE = 4
+BITFIELD = 5
+REQUEST = 6
+PIECE = 7
+CANCEL = 8
+PORT = 9
+
+KEEP_ALIVE_MSG = b'\x00\x00\x00\x00'
+
+_HANDSHAKE = struct.Struct('>B19s8s20s20s')
+_LENGTH = struct.Struct('>I')
+_HEADER = struct.Struct('>IB')
+_HAVE = struct.Struct('>IBI')
+_REQUEST = struct.Struct('>IBIII')
+_PIECE_HEADER = struct.Struct('>IBII')
+
+# Payload layouts
+INDEX = struct.Struct('>I')        # have
+BLOCK = struct.Struct('>III')      # request, cancel: index, begin, length
+PIECE_BLOCK = struct.Struct('>II')  # piece: index, begin, then the block data
+
+
+def pack_handshake(info_hash, peer_id, reserved=bytes(8)):
+    return _HANDSHAKE.pack(len(PROTOCOL_NAME), PROTOCOL_NAME, reserved, info_hash, peer_id)
+
+
+def parse_handshake(data, info_hash=None):
+    """
+    Validates a handshake, returns (reserved, info_hash, peer_id).
+    If `info_hash` is given the handshake must be for that torrent.
+    """
+    pstrlen, pstr, reserved, their_hash, peer_id = _HANDSHAKE.unpack(data)
+    if pstrlen != len(PROTOCOL_NAME) or pstr != PROTOCOL_NAME:
+        raise PeerError('Unknown protocol in handshake')
+    if info_hash is not None and their_hash != info_hash:
+        raise PeerError('Handshake for another torrent')
+    return reserved, their_hash, peer_id
+
+
+def pack_piece_header(index, begin, length):
+    """
+    The start of a piece message carrying `length` bytes, the block data follows it.
+    """
+    return _PIECE_HEADER.pack(9 + length, PIECE, index, begin)
+
+
+async def read_handshake(reader, info_hash=None):
+    return parse_handshake(await reader.readexactly(HANDSHAKE_LENGTH), info_hash)
+
+
+async def read_message(reader):
+    """
+    Reads the next length-prefixed frame, waiting for partial frames to complete.
+    Returns (message id, payload); (None, b'') for a keep-alive.
+    The payload is a memoryview of the frame, it is not copied again.
+    """
+    length, = _LENGTH.unpack(await reader.readexactly(4))
+    if length == 0:
+        return None, b''
+    if length > MAX_MESSAGE_LENGTH:
+        raise PeerError('Message of %s bytes is too long' % length)
+    data = await reader.readexactly(length)
+    return data[0], memoryview(data)[1:]
+
+
+class MessageWriter(object):
+    """
+    Encodes outgoing messages and batches them: everything queued during one
+    loop iteration goes out with a single write.
+
+    Instance Variables:
+        self._writer    -- Anything with write() and is_closing(), a StreamWriter or a transport.
+        self._buffer    -- Encoded messages waiting for the flush.
+        self._scheduled -- Whether a flush is already scheduled on the loop.
+        self._held      -- Whether flushes wait for release(), while the connection sends a file.
+    """
+    def __init__(self, writer):
+        self._writer = writer
+        self._loop = asyncio.get_event_loop()
+        self._buffer = []
+        self._scheduled = False
+        self._held = False
+
+    def _send(self, data):
+        self._buffer.append(data)
+        if not self._scheduled:
+            self._scheduled = True
+            self._loop.call_soon(self.flush)
+
+    def flush(self):
+        self._scheduled = False
+        if not self._buffer or self._held:
+            return
+        data = b''.join(self._buffer)
+        self._buffer.clear()
+        if not self._writer.is_closing():
+            self._writer.write(data)
+
+    def hold(self):
+        """
+        Keeps the messages queued until release(), nothing else may be written
+        to the connection while loop.sendfile() uses it.
+        """
+        self.flush()
+        self._held = True
+
+    def release(self):
+        self._held = False
+        self.flush()
+
+    def send_now(self, *data):
+        """
+        Writes `data` right after the messages queued, without joining it into the batch.
+        """
+        self.flush()
+        if not self._writer.is_closing():
+            for chunk in data:
+                self._writer.write(chunk)
+
+    def keep_alive(self):
+        self._send(KEEP_ALIVE_MSG)
+
+    def choke(self):
+        self._send(_HEADER.pack(1, CHOKE))
+
+    def unchoke(self):
+        self._send(_HEADER.pack(1, UNCHOKE))
+
+    def interested(self):
+        self._send(_HEADER.pack(1, INTERESTED))
+
+    def not_interested(self):
+        self._send(_HEADER.pack(1, NOT_INTERESTED))
+
+    def have(self, index):
+        self._send(_HAVE.pack(5, HAVE, index))
+
+    def bitfield(self, data):
+        self._send(_HEADER.pack(1 + len(data), BITFIELD))
+        self._send(data)
+
+    def request(self, index, begin, length):
+        self._send(_REQUEST.pack(13, REQUEST, index, begin, length))
+
+    def cancel(self, index, begin, length):
+        self._send(_REQUEST.pack(13, CANCEL, index, begin, length))
+
+    def piece(self, index, begin, data):
+        self._send(_PIECE_HEADER.pack(9 + len(data), PIECE, index, begin))
+        self._send(data)
@@ -0,0 +1,81 @@
+import asyncio
+import time
+
+# The burst of a bucket given none, as seconds of its rate
+BURST_TIME = 0.5
+# Bursts are at least two blocks, so a block never waits for a bucket that is full
+MIN_BURST = 2 ** 15
+
+
+class TokenBucket(object):
+    """
+    Limits a byte rate, allowing bursts of `burst` bytes.
+
+    Buckets form a tree: the global bucket is the parent of the torrent
+    buckets, which are the parents of the peer buckets, and every transfer
+    is charged to its bucket and all its ancestors. A charge is taken even
+    when the tokens run out; the bucket goes into debt and the caller waits
+    until the debt is refilled. Since later charges wait behind the debt of
+    the earlier ones, the peers sharing a bucket get the bandwidth in the
+    order they asked for it, one block at a time, and none can starve the
+    others. A rate of 0 means no limit.
+
+    Instance Variables:
+        self.rate       -- Bytes per second, 0 for no limit.
+        self.burst      -- The tokens the bucket holds at most.
+        self.parent     -- The TokenBucket also charged for everything charged here, None for none.
+        self._tokens    -- The bytes that can go now, negative while in debt.
+        self._updated   -- Monotonic time of the last refill.
+    """
+    def __init__(self, rate=0, burst=None, parent=None):
+        self.parent = parent
+        self._updated = time.monotonic()
+        self._tokens = 0
+        self.rate = 0
+        self.set_rate(rate, burst)
+        self._tokens = self.burst if self.rate else 0
+
+    def set_rate(self, rate, burst=None):
+        """
+        Changes the limit, the transfers waiting already keep their delay.
+        """
+        self._refill(time.monotonic())
+        self.rate = rate or 0
+        self.burst = burst if burst is not None else max(MIN_BURST, int(self.rate * BURST_TIME))
+        self._tokens = min(self._tokens, self.burst) if self.rate else 0
+
+    def _refill(self, now):
+        if self.rate:
+            self._tokens = min(self.burst, self._tokens + (now - self._updated) * self.rate)
+        self._updated = now
+
+    def _take(self, size, now):
+        if not self.rate:
+            return 0
+        self._refill(now)
+        self._tokens -= size
+        return -self._tokens / self.rate if self._tokens < 0 else 0
+
+    def charge(self, size):
+        """
+        Takes `size` bytes from this bucket and its ancestors. Returns the
+        seconds to wait before the transfer keeps under every limit.
+        """
+        now = time.monotonic()
+        delay = 0
+        bucket = self
+        while bucket is not None:
+            delay = max(delay, bucket._take(size, now))
+            bucket = bucket.parent
+        return delay
+
+    async def consume(self, size):
+        """
+        Charges `size` bytes and waits until they may go.
+        """
+        delay = self.charge(size)
+        if delay > 0:
+            await asyncio.sleep(delay)
+
+    def __repr__(self):
+        return 'TokenBucket(%s B/s, burst %s, tokens %d)' % (self.rate, self.burst, self._tokens)
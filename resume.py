@@ -0,0 +1,201 @@
+import asyncio
+import logging
+import os
+
+from bitarray import bitarray
+
+from bencode import bdecode, bencode
+from errors import BTFailure
+from piece import BLOCK_SIZE
+from storage import Storage
+from torrent import DownloadInfo
+from verify import check_existing
+
+RESUME_DIR_NAME = '.resume'
+RESUME_SAVE_INTERVAL = 60
+
+_ONE = bitarray('1')
+
+
+def resume_path(resume_dir, info_hash):
+    return os.path.join(resume_dir, info_hash.hex() + '.resume')
+
+
+def file_stats(storage: Storage):
+    """
+    The (size, mtime in ns) of each file of the torrent, None for missing files.
+    """
+    stats = []
+    for path in storage.paths:
+        try:
+            st = os.stat(path)
+        except FileNotFoundError:
+            stats.append(None)
+        else:
+            stats.append((st.st_size, st.st_mtime_ns))
+    return stats
+
+
+def _to_bitarray(data, length):
+    bits = bitarray(endian='big')
+    bits.frombytes(bytes(data))
+    if len(bits) < length:
+        raise ValueError('Bitfield too short')
+    del bits[length:]
+    return bits
+
+
+class ResumeData(object):
+    """
+    Fast-resume state of a torrent, stored bencoded in a file named after the info_hash.
+
+    Instance Variables:
+        self.info_hash  -- The torrent the state belongs to.
+        self.pieces     -- Bitmap of the pieces verified and written to disk.
+        self.files      -- The (size, mtime_ns) of each file when saved, None if it was missing.
+        self.partial    -- {index: (block bitmap, {begin: block data})} of the pieces partially downloaded.
+                           The blocks not written with an earlier state are written to disk with this
+                           one so they can be read back.
+    """
+    def __init__(self, info_hash, pieces, files=None, partial=None):
+        self.info_hash = info_hash
+        self.pieces = pieces
+        self.files = files
+        self.partial = partial if partial is not None else {}
+
+    @classmethod
+    def capture(cls, download_info: DownloadInfo, written):
+        """
+        Snapshot of the state, taken on the loop. `written` is the bitmap of the pieces
+        that reached the disk, the file writer may still hold other verified pieces.
+        """
+        partial = {}
+        for piece in download_info.pieces.active:
+            if piece.blocks_downloaded.any() and not piece.is_complete:
+                # Only the blocks received since the last save are copied
+                new_blocks = piece.blocks_downloaded & ~piece.blocks_saved
+                data = {}
+                for block_idx in new_blocks.search(_ONE):
+                    begin = block_idx * BLOCK_SIZE
+                    data[begin] = bytes(piece.data[begin:begin + piece.block_length(block_idx)])
+                piece.blocks_saved[:] = piece.blocks_downloaded
+                partial[piece.index] = (bitarray(piece.blocks_downloaded), data)
+        return cls(download_info.info_hash, bitarray(written), partial=partial)
+
+    def forget_blocks(self, download_info: DownloadInfo):
+        """
+        The write failed, the next capture copies the blocks of this one again.
+        """
+        for index, (_, data) in self.partial.items():
+            piece = download_info.pieces.get_active(index)
+            if piece is None:
+                continue
+            for begin in data:
+                piece.blocks_saved[begin // BLOCK_SIZE] = False
+
+    def write(self, storage: Storage, path):
+        """
+        Writes the new blocks of the partial pieces, then the state. Runs on the disk thread.
+        """
+        for index, (_, data) in self.partial.items():
+            offset = index * storage.piece_length
+            for begin, block in data.items():
+                storage.write(offset + begin, block)
+        self.files = file_stats(storage)
+
+        state = {
+            b'info-hash': self.info_hash,
+            b'piece-count': len(self.pieces),
+            b'pieces': self.pieces.tobytes(),
+            b'files': [list(stat) if stat is not None else [] for stat in self.files],
+            b'partial': [[index, len(blocks), blocks.tobytes()]
+                         for index, (blocks, _) in sorted(self.partial.items())],
+        }
+        os.makedirs(os.path.dirname(path) or '.', exist_ok=True)
+        tmp_path = path + '.tmp'
+        with open(tmp_path, 'wb') as file:
+            file.write(bencode(state))
+        os.replace(tmp_path, path)
+
+    @classmethod
+    def read(cls, path, download_info: DownloadInfo):
+        """
+        Loads the state saved for `download_info`, None if there is none or it is unusable.
+        """
+        try:
+            with open(path, 'rb') as file:
+                state = bdecode(file.read())
+            if state[b'info-hash'] != download_info.info_hash:
+                raise ValueError('Resume data of another torrent')
+            piece_count = len(download_info.pieces)
+            if state[b'piece-count'] != piece_count:
+                raise ValueError('Piece count mismatch')
+            pieces = _to_bitarray(state[b'pieces'], piece_count)
+            files = [tuple(stat) if stat else None for stat in state[b'files']]
+            if len(files) != len(download_info.files):
+                raise ValueError('File count mismatch')
+            partial = {}
+            for index, block_count, blocks in state[b'partial']:
+                partial[index] = (_to_bitarray(blocks, block_count), {})
+        except FileNotFoundError:
+            return None
+        except (BTFailure, KeyError, TypeError, ValueError) as e:
+            logging.error("Ignore resume data %s: %s" % (path, e))
+            return None
+        return cls(download_info.info_hash, pieces, files, partial)
+
+
+async def restore(download_info: DownloadInfo, storage: Storage, path):
+    """
+    Applies the state saved at `path` to the piece table, before the download
+    starts. Pieces touching files whose size or mtime changed since are
+    rechecked instead of trusted. Returns False if there was no usable state.
+    """
+    resume = ResumeData.read(path, download_info)
+    if resume is None:
+        return False
+
+    loop = asyncio.get_event_loop()
+    pieces = download_info.pieces
+    piece_length = download_info.piece_length
+    current = await loop.run_in_executor(storage.executor, file_stats, storage)
+
+    changed = bitarray(len(pieces))
+    changed.setall(False)
+    for file, saved, now in zip(download_info.files, resume.files, current):
+        if saved != now and file.length:
+            first = file.offset // piece_length
+            last = (file.offset + file.length - 1) // piece_length
+            changed[first:last + 1] = True
+
+    pieces.downloaded |= resume.pieces & ~changed
+    recheck = list(changed.search(_ONE))
+    if recheck:
+        logging.info("Recheck %s pieces of changed files" % len(recheck))
+        await check_existing(download_info, storage, recheck)
+
+    for index, (blocks, _) in resume.partial.items():
+        if not 0 <= index < len(pieces) or changed[index] or pieces.downloaded[index]:
+            continue
+        piece = pieces[index]
+        if len(blocks) != len(piece.blocks_downloaded):
+            pieces.release(index)
+            continue
+        data = await loop.run_in_executor(storage.executor, storage.read, index * piece_length, piece.length)
+        # The file may end after the last block written
+        last_block = blocks.find(1, right=True)
+        if last_block < 0 or len(data) < last_block * BLOCK_SIZE + piece.block_length(last_block):
+            pieces.release(index)
+            continue
+        piece.restore_blocks(blocks, data)
+    return True
+
+
+async def save(download_info: DownloadInfo, storage: Storage, written, path):
+    resume = ResumeData.capture(download_info, written)
+    loop = asyncio.get_event_loop()
+    try:
+        await loop.run_in_executor(storage.executor, resume.write, storage, path)
+    except OSError as e:
+        logging.error("Failed to save resume data %s: %s" % (path, e))
+        resume.forget_blocks(download_info)
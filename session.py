@@ -0,0 +1,169 @@
+import asyncio
+import logging
+
+from concurrent.futures import ThreadPoolExecutor
+
+import aiohttp
+
+from budget import MemoryBudget
+from connection_manager import ConnectionManager
+from download import TorrentDownload, HANDSHAKE_TIMEOUT
+from errors import PeerError
+from hasher import PieceVerifier
+import metrics
+from peer import Peer
+from peer_protocol import PeerProtocol
+from piece_picker import RAREST_FIRST
+from process_msg import read_handshake
+from ratelimit import TokenBucket
+from torrent import TorrentInfo, peer_id
+from tracker import HTTP_CONNECTIONS, DNS_CACHE_TTL
+from udp_tracker import UDPTrackerClient
+
+LISTEN_PORT = 6881
+
+
+class Session(object):
+    """
+    Runs many torrents in one process.
+
+    The torrents share one listening socket, peers connecting to it are
+    handed to the torrent named by the info hash of their handshake. They
+    also share our peer id, the connection limits, the memory budget, the
+    hashing threads, the disk thread and the tracker clients.
+
+    The metrics of every torrent are in metrics.REGISTRY; given a
+    `metrics_port`, the session also serves them on localhost for Prometheus.
+
+    Instance Variables:
+        self.download_dir   -- The default directory of the downloaded files.
+        self.resume_dir     -- Directory of the resume data, None for one in the download directory.
+        self.host           -- The address listened on.
+        self.port           -- The port listened on, the one bound once started.
+        self.my_peer_id     -- Our peer id, for every torrent.
+        self.manager        -- The ConnectionManager of the connection limits.
+        self.budget         -- The MemoryBudget of the piece data.
+        self.upload_limit   -- The TokenBucket of the upload over all torrents, set_rate() changes it.
+        self.download_limit -- The TokenBucket of the download over all torrents.
+        self.buffered_protocol -- Whether the connections use PeerProtocol, receiving the blocks in place.
+        self.metrics_port   -- The port of the metrics endpoint, None for none, the one bound once started.
+        self.torrents       -- {info hash: TorrentDownload} of the torrents added.
+        self._verifier      -- The PieceVerifier hashing the pieces.
+        self._executor      -- The disk thread, one for every Storage so their I/O is not interleaved.
+        self._http_session  -- The aiohttp session of the HTTP trackers.
+        self._udp           -- The UDPTrackerClient of the UDP trackers.
+        self._server        -- The listening asyncio server, once started.
+        self._metrics_server -- The asyncio server of the metrics endpoint, once started.
+        self._lag_monitor   -- Task measuring the event loop lag, once started.
+    """
+    def __init__(self, download_dir, host='0.0.0.0', port=LISTEN_PORT, resume_dir=None, manager=None,
+                 budget=None, upload_rate=0, download_rate=0, buffered_protocol=False, metrics_port=None):
+        self.download_dir = download_dir
+        self.resume_dir = resume_dir
+        self.host = host
+        self.port = port
+        self.my_peer_id = peer_id()
+        self.manager = manager if manager is not None else ConnectionManager()
+        self.budget = budget if budget is not None else MemoryBudget()
+        self.upload_limit = TokenBucket(upload_rate)
+        self.download_limit = TokenBucket(download_rate)
+        self.buffered_protocol = buffered_protocol
+        self.metrics_port = metrics_port
+        self.torrents = {}
+        self._verifier = PieceVerifier()
+        self._executor = ThreadPoolExecutor(max_workers=1, thread_name_prefix='disk')
+        self._http_session = None
+        self._udp = UDPTrackerClient()
+        self._server = None
+        self._metrics_server = None
+        self._lag_monitor = None
+
+    async def start(self):
+        self._http_session = aiohttp.ClientSession(
+            connector=aiohttp.TCPConnector(limit=HTTP_CONNECTIONS, ttl_dns_cache=DNS_CACHE_TTL))
+        if self.buffered_protocol:
+            loop = asyncio.get_event_loop()
+            self._server = await loop.create_server(lambda: PeerProtocol(self._accept), self.host, self.port)
+        else:
+            self._server = await asyncio.start_server(self._accept, self.host, self.port)
+        self.port = self._server.sockets[0].getsockname()[1]
+        logging.info("Listening on port %s" % self.port)
+        self._lag_monitor = asyncio.ensure_future(metrics.monitor_loop_lag())
+        if self.metrics_port is not None:
+            self._metrics_server = await metrics.start_http_server(port=self.metrics_port)
+            self.metrics_port = self._metrics_server.sockets[0].getsockname()[1]
+
+    async def _accept(self, reader, writer):
+        try:
+            _, info_hash, their_peer_id = await asyncio.wait_for(read_handshake(reader), HANDSHAKE_TIMEOUT)
+        except (asyncio.TimeoutError, asyncio.IncompleteReadError, ConnectionError, PeerError) as e:
+            logging.debug("Incoming handshake failed: %r" % e)
+            writer.close()
+            return
+        torrent = self.torrents.get(info_hash)
+        if torrent is None:
+            logging.debug("Incoming connection for unknown torrent %s" % info_hash.hex())
+            writer.close()
+            return
+        host, port = writer.get_extra_info('peername')[:2]
+        torrent.add_incoming(Peer(host, port), reader, writer, their_peer_id)
+
+    async def add(self, torrent_file, download_dir=None, policy=RAREST_FIRST, paused=False,
+                  upload_rate=0, download_rate=0):
+        """
+        Adds a torrent and starts it unless `paused`. Returns its TorrentDownload,
+        raises ValueError if it was added already. The rates limit the torrent
+        within the session limits, 0 for none.
+        """
+        torrent_info = TorrentInfo.from_file(torrent_file, download_dir or self.download_dir, self.my_peer_id)
+        info_hash = torrent_info.download_info.info_hash
+        if info_hash in self.torrents:
+            raise ValueError("Torrent %s was added already" % info_hash.hex())
+        torrent_info.paused = paused
+        torrent = TorrentDownload(torrent_info, policy, resume_dir=self.resume_dir, manager=self.manager,
+                                  budget=self.budget, verifier=self._verifier, executor=self._executor,
+                                  http_session=self._http_session, udp=self._udp, port=self.port,
+                                  upload_limit=self.upload_limit, download_limit=self.download_limit,
+                                  upload_rate=upload_rate, download_rate=download_rate,
+                                  buffered_protocol=self.buffered_protocol)
+        self.torrents[info_hash] = torrent
+        try:
+            await torrent.start()
+        except BaseException:
+            del self.torrents[info_hash]
+            raise
+        return torrent
+
+    async def remove(self, info_hash):
+        torrent = self.torrents.pop(info_hash)
+        await torrent.close()
+
+    async def pause(self, info_hash):
+        await self.torrents[info_hash].pause()
+
+    def resume(self, info_hash):
+        self.torrents[info_hash].resume()
+
+    async def close(self):
+        if self._server is not None:
+            self._server.close()
+        if self._metrics_server is not None:
+            self._metrics_server.close()
+            self._metrics_server = None
+        if self._lag_monitor is not None:
+            self._lag_monitor.cancel()
+            self._lag_monitor = None
+        results = await asyncio.gather(*[self.remove(info_hash) for info_hash in list(self.torrents)],
+                                       return_exceptions=True)
+        for result in results:
+            if isinstance(result, Exception):
+                logging.error("Failed to stop a torrent: %r" % result)
+        if self._server is not None:
+            # Waits for the connections too, they were closed with their torrents
+            await self._server.wait_closed()
+            self._server = None
+        if self._http_session is not None:
+            await self._http_session.close()
+        self._udp.close()
+        self._verifier.shutdown()
+        self._executor.shutdown(wait=True)
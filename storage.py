@@ -0,0 +1,207 @@
+import asyncio
+import bisect
+import logging
+import os
+
+from collections import OrderedDict
+from concurrent.futures import ThreadPoolExecutor
+
+from torrent import DownloadInfo
+
+MAX_OPEN_FILES = 128
+try:
+    IOV_MAX = os.sysconf('SC_IOV_MAX')
+except (AttributeError, ValueError, OSError):
+    IOV_MAX = 1024
+
+
+def _preadinto(fd, view, offset):
+    if hasattr(os, 'preadv'):
+        return os.preadv(fd, [view], offset)
+    data = os.pread(fd, len(view), offset)
+    view[:len(data)] = data
+    return len(data)
+
+
+def file_path(download_info: DownloadInfo, download_dir, file):
+    """
+    Where `file` of the torrent lives on disk: <dir>/<name> for a single file
+    torrent, <dir>/<name>/<path...> otherwise.
+    """
+    for elem in file.path:
+        if elem in ('', '.', '..') or os.sep in elem or (os.altsep and os.altsep in elem):
+            raise ValueError("Unsafe path %s in torrent" % "/".join(file.path))
+    if download_info.single_file:
+        return os.path.join(download_dir, *file.path)
+    return os.path.join(download_dir, download_info.suggested_name, *file.path)
+
+
+class Storage(object):
+    """
+    Maps offsets in the torrent to the files of the torrent, so that a piece or
+    block crossing file boundaries is split over the right files.
+
+    Files are opened on first use and kept in an LRU cache of at most
+    `max_open_files` descriptors. Reads and writes use pread/pwrite, the cache
+    is not thread safe: asynchronous callers go through self.executor, the
+    disk thread.
+
+    Instance Variables:
+        self._files     -- The files of the torrent (FileInfo).
+        self._paths     -- The path on disk of each file.
+        self._offsets   -- The offset of each file in the torrent, for bisect.
+        self._fds       -- OrderedDict {file index: fd}, least recently used first.
+        self.max_open_files -- The size of the descriptor cache.
+        self.executor   -- Single thread executor doing the disk I/O, it may be shared with other torrents.
+        self._own_executor -- Whether the executor is ours to shut down.
+    """
+    def __init__(self, download_info: DownloadInfo, download_dir, max_open_files=MAX_OPEN_FILES, executor=None):
+        self._files = download_info.files
+        self._paths = [file_path(download_info, download_dir, file) for file in self._files]
+        self._offsets = [file.offset for file in self._files]
+        self._total_size = download_info.total_size
+        self.piece_length = download_info.piece_length
+
+        self._fds = OrderedDict()
+        self.max_open_files = max_open_files
+        self.executor = executor if executor is not None else ThreadPoolExecutor(max_workers=1)
+        self._own_executor = executor is None
+
+    @property
+    def paths(self):
+        return self._paths
+
+    def segments(self, offset, length):
+        """
+        Yields (file index, offset in file, length) of the parts of the torrent range.
+        """
+        if offset < 0 or offset + length > self._total_size:
+            raise ValueError("Range %s+%s out of torrent" % (offset, length))
+        index = bisect.bisect_right(self._offsets, offset) - 1
+        while length > 0:
+            file = self._files[index]
+            file_offset = offset - file.offset
+            size = min(length, file.length - file_offset)
+            if size > 0:
+                yield index, file_offset, size
+                offset += size
+                length -= size
+            index += 1
+
+    def _fd(self, index):
+        fd = self._fds.get(index)
+        if fd is not None:
+            self._fds.move_to_end(index)
+            return fd
+
+        while len(self._fds) >= self.max_open_files:
+            _, old_fd = self._fds.popitem(last=False)
+            os.close(old_fd)
+
+        path = self._paths[index]
+        os.makedirs(os.path.dirname(path) or '.', exist_ok=True)
+        fd = os.open(path, os.O_RDWR | os.O_CREAT, 0o644)
+        self._fds[index] = fd
+        return fd
+
+    def create_empty_files(self):
+        """
+        Zero-length files are never written to, create them explicitly.
+        """
+        for index, file in enumerate(self._files):
+            if file.length == 0:
+                self._fd(index)
+
+    def write(self, offset, data):
+        """
+        Writes `data` at `offset` of the torrent.
+        """
+        view = memoryview(data)
+        pos = 0
+        for index, file_offset, size in self.segments(offset, len(view)):
+            fd = self._fd(index)
+            done = 0
+            while done < size:
+                done += os.pwrite(fd, view[pos + done:pos + size], file_offset + done)
+            pos += size
+
+    def writev(self, offset, buffers):
+        """
+        Writes the consecutive `buffers` at `offset` of the torrent with one
+        vectored write per file.
+        """
+        if not hasattr(os, 'pwritev'):
+            for data in buffers:
+                self.write(offset, data)
+                offset += len(data)
+            return
+
+        views = [memoryview(data) for data in buffers]
+        total = sum(len(view) for view in views)
+        i, pos = 0, 0  # current buffer and the position in it
+        for index, file_offset, size in self.segments(offset, total):
+            iov = []
+            left = size
+            while left:
+                chunk = views[i][pos:pos + left]
+                iov.append(chunk)
+                left -= len(chunk)
+                pos += len(chunk)
+                if pos == len(views[i]):
+                    i, pos = i + 1, 0
+            self._pwritev(self._fd(index), iov, file_offset)
+
+    @staticmethod
+    def _pwritev(fd, iov, offset):
+        while iov:
+            written = os.pwritev(fd, iov[:IOV_MAX], offset)
+            offset += written
+            # Drop what was written, partial writes leave a tail of a buffer
+            while written:
+                if written >= len(iov[0]):
+                    written -= len(iov[0])
+                    iov.pop(0)
+                else:
+                    iov[0] = iov[0][written:]
+                    written = 0
+
+    def readinto(self, offset, buffer):
+        """
+        Fills `buffer` with the torrent data at `offset`. Returns the number of bytes read,
+        short if the files are.
+        """
+        view = memoryview(buffer)
+        pos = 0
+        for index, file_offset, size in self.segments(offset, len(view)):
+            fd = self._fd(index)
+            done = 0
+            while done < size:
+                n = _preadinto(fd, view[pos + done:pos + size], file_offset + done)
+                if n == 0:
+                    return pos + done
+                done += n
+            pos += size
+        return pos
+
+    def read(self, offset, length):
+        buffer = bytearray(length)
+        return bytes(memoryview(buffer)[:self.readinto(offset, buffer)])
+
+    def close(self):
+        for fd in self._fds.values():
+            try:
+                os.close(fd)
+            except OSError as e:
+                logging.error("Failed to close file: %s" % e)
+        self._fds.clear()
+        if self._own_executor:
+            self.executor.shutdown(wait=True)
+
+    async def close_async(self):
+        """
+        Closes the files on the disk thread, after the I/O queued before.
+        """
+        if self._own_executor:
+            self.close()
+        else:
+            await asyncio.get_event_loop().run_in_executor(self.executor, self.close)
@@ -0,0 +1,316 @@
+import asyncio
+import hashlib
+import random
+import struct
+import time
+
+from budget import MemoryBudget, PIECES, HASH
+from download import Swarm, DownloadSession
+from hasher import PieceVerifier
+from peer import Peer
+from peer_protocol import PeerProtocol, BLOCK_RECEIVED
+from piece import BLOCK_SIZE
+from piece_picker import PiecePicker
+from process_msg import HAVE, BITFIELD, PIECE
+from torrent import DownloadInfo, TorrentInfo
+
+HANDSHAKE = b'H' * 68
+
+
+class FakeTransport(object):
+    def __init__(self):
+        self.paused = False
+        self.closed = False
+
+    def pause_reading(self):
+        self.paused = True
+
+    def resume_reading(self):
+        self.paused = False
+
+    def close(self):
+        self.closed = True
+
+    def is_closing(self):
+        return self.closed
+
+    def write(self, data):
+        pass
+
+
+def random_stream(rnd, count=400):
+    """
+    A handshake and `count` random messages, with the messages read_message() should return for them.
+    Blocks of pieces whose index is a multiple of 3 are declined by the block_buffer callback.
+    """
+    stream = [HANDSHAKE]
+    expected = []
+    for _ in range(count):
+        kind = rnd.random()
+        if kind < 0.1:
+            stream.append(b'\0\0\0\0')
+            expected.append((None, b''))
+        elif kind < 0.3:
+            payload = struct.pack('>I', rnd.randrange(100))
+            stream.append(struct.pack('>IB', 1 + len(payload), HAVE) + payload)
+            expected.append((HAVE, payload))
+        elif kind < 0.35:
+            # Bitfields larger than the read buffer too
+            payload = rnd.randbytes(rnd.choice([1, 200, 70000]))
+            stream.append(struct.pack('>IB', 1 + len(payload), BITFIELD) + payload)
+            expected.append((BITFIELD, payload))
+        else:
+            index, begin = rnd.randrange(50), rnd.randrange(8) * BLOCK_SIZE
+            block = rnd.randbytes(rnd.choice([BLOCK_SIZE, 100]))
+            stream.append(struct.pack('>IBII', 9 + len(block), PIECE, index, begin) + block)
+            if index % 3:
+                expected.append(('in place', index, begin, block))
+            else:
+                expected.append((PIECE, struct.pack('>II', index, begin) + block))
+    return b''.join(stream), expected
+
+
+def parse_in_chunks(seed):
+    """
+    Feeds a random stream to the protocol in chunks of random sizes, returns what it parsed and what it should have.
+    """
+    rnd = random.Random(seed)
+    data, expected = random_stream(rnd)
+    buffers = []
+
+    def block_buffer(index, begin, length):
+        if index % 3 == 0:
+            return None
+        buffers.append(bytearray(length))
+        return memoryview(buffers[-1])
+
+    protocol = PeerProtocol()
+    protocol.connection_made(FakeTransport())
+    received = []
+
+    async def read_messages():
+        while protocol._messages:
+            message_id, payload = await protocol.read_message()
+            if message_id == BLOCK_RECEIVED:
+                index, begin, length = payload
+                buffer = buffers.pop(0)
+                assert len(buffer) == length
+                received.append(('in place', index, begin, bytes(buffer)))
+            else:
+                received.append((message_id, bytes(payload)))
+
+    async def main():
+        position = 0
+        started = False
+        while position < len(data):
+            if protocol.transport.paused:
+                await read_messages()
+            buffer = protocol.get_buffer(-1)
+            assert len(buffer) > 0
+            size = min(len(buffer), rnd.choice([1, 3, 7, 13, 100, 5000, 100000]), len(data) - position)
+            buffer[:size] = data[position:position + size]
+            position += size
+            protocol.buffer_updated(size)
+            if not started and protocol._filled >= len(HANDSHAKE):
+                assert await protocol.readexactly(len(HANDSHAKE)) == HANDSHAKE
+                protocol.start_messages(block_buffer)
+                started = True
+            if started:
+                await read_messages()
+        await read_messages()
+
+    asyncio.run(main())
+    return received, expected
+
+
+def test_parse_random_chunks():
+    for seed in range(20):
+        received, expected = parse_in_chunks(seed)
+        assert received == expected, seed
+
+
+def make_swarm(tmp_path, piece_count=2, budget=None, verifier=None):
+    piece_length = 2 * BLOCK_SIZE
+    data = random.Random(1).randbytes(piece_count * piece_length)
+    pieces = b''.join(hashlib.sha1(data[i:i + piece_length]).digest() for i in range(0, len(data), piece_length))
+    info = {b'length': len(data), b'name': b'data', b'piece length': piece_length, b'pieces': pieces}
+    download_info = DownloadInfo.from_dict(info)
+    download_info.select_files(download_info.files)
+    torrent = TorrentInfo(download_info, ['http://127.0.0.1/announce'], str(tmp_path))
+    picker = PiecePicker(download_info.pieces, budget=budget)
+    return Swarm(torrent, asyncio.Queue(), picker, verifier=verifier, budget=budget), data
+
+
+def test_copy_does_not_overwrite_block_received_in_place(tmp_path):
+    async def main():
+        swarm, data = make_swarm(tmp_path)
+        block = data[:BLOCK_SIZE]
+        in_place = DownloadSession(swarm, Peer('127.0.0.1', 6881))
+        copying = DownloadSession(swarm, Peer('127.0.0.2', 6881))
+        # Both asked for block 0 of piece 0 in the endgame
+        for session in (in_place, copying):
+            session._outstanding[(0, 0)] = (BLOCK_SIZE, time.time())
+            swarm.endgame.add(0, 0, BLOCK_SIZE, session)
+
+        view = in_place._block_buffer(0, 0, BLOCK_SIZE)
+        assert view is not None
+        view[:100] = block[:100]
+        # A copy from another peer arrives while the rest is being received in place
+        await copying._on_block(0, 0, BLOCK_SIZE, bytes(BLOCK_SIZE))
+        assert (0, 0) not in copying._outstanding
+        assert (0, 0) in in_place._outstanding
+        assert swarm.endgame.wasted_bytes == BLOCK_SIZE
+
+        view[100:] = block[100:]
+        await in_place._on_block_received((0, 0, BLOCK_SIZE))
+        piece = swarm.torrent.download_info.pieces[0]
+        assert piece.blocks_downloaded[0]
+        assert bytes(piece.data[:BLOCK_SIZE]) == block
+        assert not swarm.receiving
+
+    asyncio.run(main())
+
+
+def test_block_requested_again_if_in_place_receiver_fails(tmp_path):
+    async def main():
+        swarm, _ = make_swarm(tmp_path)
+        in_place = DownloadSession(swarm, Peer('127.0.0.1', 6881))
+        copying = DownloadSession(swarm, Peer('127.0.0.2', 6881))
+        in_place._start_connection(FakeTransport())
+        for session in (in_place, copying):
+            session._outstanding[(0, 0)] = (BLOCK_SIZE, time.time())
+            swarm.endgame.add(0, 0, BLOCK_SIZE, session)
+        # The picker handed the block out once
+        assert swarm.picker.pick(_owned(swarm), 1) == [(0, 0, BLOCK_SIZE)]
+
+        assert in_place._block_buffer(0, 0, BLOCK_SIZE) is not None
+        await copying._on_block(0, 0, BLOCK_SIZE, bytes(BLOCK_SIZE))
+        # The connection receiving in place is lost mid-block
+        in_place._close_connection()
+        assert not swarm.receiving
+        assert swarm.picker.pick(_owned(swarm), 1) == [(0, 0, BLOCK_SIZE)]
+
+    asyncio.run(main())
+
+
+def test_close_forgets_every_block_received_in_place(tmp_path):
+    async def main():
+        swarm, _ = make_swarm(tmp_path)
+        session = DownloadSession(swarm, Peer('127.0.0.1', 6881))
+        session._start_connection(FakeTransport())
+        for begin in (0, BLOCK_SIZE):
+            session._outstanding[(0, begin)] = (BLOCK_SIZE, time.time())
+            swarm.endgame.add(0, begin, BLOCK_SIZE, session)
+        # The protocol reads ahead, handing out both targets in one parse
+        assert session._block_buffer(0, 0, BLOCK_SIZE) is not None
+        assert session._block_buffer(0, BLOCK_SIZE, BLOCK_SIZE) is not None
+        assert swarm.receiving == {(0, 0), (0, BLOCK_SIZE)}
+        session._close_connection()
+        assert not swarm.receiving
+
+    asyncio.run(main())
+
+
+def test_block_received_in_place_through_a_choke(tmp_path):
+    async def main():
+        swarm, data = make_swarm(tmp_path)
+        block = data[:BLOCK_SIZE]
+        in_place = DownloadSession(swarm, Peer('127.0.0.1', 6881))
+        copying = DownloadSession(swarm, Peer('127.0.0.2', 6881))
+        in_place._start_connection(FakeTransport())
+        assert swarm.picker.pick(_owned(swarm), 1) == [(0, 0, BLOCK_SIZE)]
+        in_place._outstanding[(0, 0)] = (BLOCK_SIZE, time.time())
+        swarm.endgame.add(0, 0, BLOCK_SIZE, in_place)
+
+        view = in_place._block_buffer(0, 0, BLOCK_SIZE)
+        view[:100] = block[:100]
+        # Choked mid-block, the peer still sends the rest of it
+        in_place._on_choke(b'')
+        assert (0, 0) in in_place._outstanding
+        # Another peer asked for it meanwhile, its copy is dropped
+        copying._outstanding[(0, 0)] = (BLOCK_SIZE, time.time())
+        swarm.endgame.add(0, 0, BLOCK_SIZE, copying)
+        await copying._on_block(0, 0, BLOCK_SIZE, bytes(BLOCK_SIZE))
+
+        view[100:] = block[100:]
+        await in_place._on_block_received((0, 0, BLOCK_SIZE))
+        piece = swarm.torrent.download_info.pieces[0]
+        assert piece.blocks_downloaded[0]
+        assert bytes(piece.data[:BLOCK_SIZE]) == block
+        assert swarm.endgame.wasted_bytes == BLOCK_SIZE
+
+    asyncio.run(main())
+
+
+def test_dropped_copy_without_request_left_goes_back_to_picker(tmp_path):
+    async def main():
+        swarm, _ = make_swarm(tmp_path)
+        copying = DownloadSession(swarm, Peer('127.0.0.2', 6881))
+        assert swarm.picker.pick(_owned(swarm), 1) == [(0, 0, BLOCK_SIZE)]
+        copying._outstanding[(0, 0)] = (BLOCK_SIZE, time.time())
+        swarm.endgame.add(0, 0, BLOCK_SIZE, copying)
+        # Still being received in place, though nobody else has it requested
+        swarm.receiving.add((0, 0))
+        await copying._on_block(0, 0, BLOCK_SIZE, bytes(BLOCK_SIZE))
+        swarm.receiving.discard((0, 0))
+        assert swarm.picker.pick(_owned(swarm), 1) == [(0, 0, BLOCK_SIZE)]
+
+    asyncio.run(main())
+
+
+def test_endgame_does_not_request_block_received_in_place_again(tmp_path):
+    async def main():
+        swarm, _ = make_swarm(tmp_path)
+        in_place = DownloadSession(swarm, Peer('127.0.0.1', 6881))
+        copying = DownloadSession(swarm, Peer('127.0.0.2', 6881))
+        for session in (in_place, copying):
+            session._start_connection(FakeTransport())
+            session.peer.piece_owned = _owned(swarm)
+            session.peer.peer_choking = False
+        in_place._window = 4
+        in_place._request_blocks()
+        assert len(in_place._outstanding) == 4
+        assert in_place._block_buffer(0, 0, BLOCK_SIZE) is not None
+        # The endgame asks the other peer for every block but the one being received in place
+        copying._request_blocks()
+        assert (0, 0) not in copying._outstanding and copying._outstanding
+
+        copying._outstanding[(0, 0)] = (BLOCK_SIZE, time.time())
+        swarm.endgame.add(0, 0, BLOCK_SIZE, copying)
+        await copying._on_block(0, 0, BLOCK_SIZE, bytes(BLOCK_SIZE))
+        assert (0, 0) not in copying._outstanding
+        assert swarm.endgame.wasted_bytes == BLOCK_SIZE
+
+    asyncio.run(main())
+
+
+def test_piece_not_queued_for_hashing_gives_its_memory_back(tmp_path):
+    async def main():
+        budget = MemoryBudget()
+        # No free slot, the submit waits until cancelled
+        swarm, data = make_swarm(tmp_path, budget=budget, verifier=PieceVerifier(max_pending=0))
+        assert swarm.picker.pick(_owned(swarm), 2) == [(0, 0, BLOCK_SIZE), (0, BLOCK_SIZE, BLOCK_SIZE)]
+        piece = swarm.torrent.download_info.pieces[0]
+        piece.save_block(0, data[:BLOCK_SIZE])
+        piece.save_block(BLOCK_SIZE, data[BLOCK_SIZE:2 * BLOCK_SIZE])
+
+        task = asyncio.ensure_future(swarm.verify_piece(piece))
+        await asyncio.sleep(0)
+        assert budget.usage[HASH] == piece.length
+        task.cancel()
+        await asyncio.gather(task, return_exceptions=True)
+        assert budget.usage[HASH] == 0 and budget.usage[PIECES] == piece.length
+        assert not swarm._hashing
+        # Downloaded again, nothing checks it otherwise
+        assert swarm.picker.pick(_owned(swarm), 1) == [(0, 0, BLOCK_SIZE)]
+
+        swarm.close()
+        assert budget.used == 0
+
+    asyncio.run(main())
+
+
+def _owned(swarm):
+    owned = swarm.torrent.download_info.pieces.selected.copy()
+    owned.setall(True)
+    return owned
@@ -0,0 +1,52 @@
+import asyncio
+import hashlib
+import random
+
+from bitarray import bitarray
+
+import resume
+from piece import BLOCK_SIZE
+from storage import Storage
+from torrent import DownloadInfo
+
+PIECE_LENGTH = 4 * BLOCK_SIZE
+
+
+def make_download_info(data):
+    pieces = b''.join(hashlib.sha1(data[i:i + PIECE_LENGTH]).digest() for i in range(0, len(data), PIECE_LENGTH))
+    info = {b'length': len(data), b'name': b'data', b'piece length': PIECE_LENGTH, b'pieces': pieces}
+    download_info = DownloadInfo.from_dict(info)
+    download_info.select_files(download_info.files)
+    return download_info
+
+
+def test_save_copies_only_new_blocks(tmp_path):
+    async def main():
+        data = random.Random(1).randbytes(2 * PIECE_LENGTH)
+        download_info = make_download_info(data)
+        storage = Storage(download_info, str(tmp_path))
+        path = str(tmp_path / 'state.resume')
+        written = bitarray(2)
+        written.setall(False)
+        piece = download_info.pieces[1]
+        for begin in (0, 2 * BLOCK_SIZE):
+            piece.save_block(begin, data[PIECE_LENGTH + begin:PIECE_LENGTH + begin + BLOCK_SIZE])
+        await resume.save(download_info, storage, written, path)
+
+        piece.save_block(BLOCK_SIZE, data[PIECE_LENGTH + BLOCK_SIZE:PIECE_LENGTH + 2 * BLOCK_SIZE])
+        state = resume.ResumeData.capture(download_info, written)
+        blocks, new_blocks = state.partial[1]
+        assert blocks.tolist() == [1, 1, 1, 0]
+        assert list(new_blocks) == [BLOCK_SIZE]
+        assert resume.ResumeData.capture(download_info, written).partial[1][1] == {}
+
+        # The blocks of both saves are read back
+        await asyncio.get_event_loop().run_in_executor(storage.executor, state.write, storage, path)
+        restored = make_download_info(data)
+        assert await resume.restore(restored, storage, path)
+        piece = restored.pieces[1]
+        assert piece.blocks_downloaded.tolist() == [1, 1, 1, 0]
+        assert bytes(piece.data[:3 * BLOCK_SIZE]) == data[PIECE_LENGTH:PIECE_LENGTH + 3 * BLOCK_SIZE]
+        await storage.close_async()
+
+    asyncio.run(main())
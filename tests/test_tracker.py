@@ -0,0 +1,64 @@
+import asyncio
+
+import aiohttp
+
+from tracker import Tracker
+from torrent import DownloadInfo, TorrentInfo
+
+
+def make_tracker(tmp_path):
+    info = {b'length': 10, b'name': b'data', b'piece length': 16384, b'pieces': bytes(20)}
+    torrent = TorrentInfo(DownloadInfo.from_dict(info), ['http://127.0.0.1:1/announce'], str(tmp_path))
+    return Tracker(torrent)
+
+
+def test_close_ends_announce_whose_cancellation_is_lost(tmp_path):
+    async def main():
+        tracker = make_tracker(tmp_path)
+        announcing = asyncio.Event()
+
+        async def announce(endpoint, event):
+            announcing.set()
+            try:
+                await asyncio.sleep(60)
+            except asyncio.CancelledError:
+                # As aiohttp can do when cancelled in the middle of a connect
+                raise aiohttp.ClientConnectionError('Connect call failed')
+
+        tracker._announce = announce
+        tracker.start()
+        await announcing.wait()
+        await asyncio.wait_for(tracker.close(), 5)
+        assert not tracker._tasks
+
+    asyncio.run(main())
+
+
+def test_reannounce_waits_for_backoff(tmp_path):
+    async def main():
+        tracker = make_tracker(tmp_path)
+        announces = []
+
+        async def announce(endpoint, event):
+            announces.append(event)
+            raise aiohttp.ClientConnectionError('Connect call failed')
+
+        tracker._announce = announce
+        tracker.start()
+        await asyncio.sleep(0.01)
+        assert announces == ['started']
+        endpoint, = tracker.endpoints
+        assert endpoint.retry_at is not None
+        # Lost peers ask for more, the tracker that failed is not tried again before its retry time
+        for _ in range(5):
+            tracker.reannounce()
+            await asyncio.sleep(0.01)
+        assert announces == ['started']
+
+        endpoint.retry_at = asyncio.get_event_loop().time()
+        tracker.reannounce()
+        await asyncio.sleep(0.01)
+        assert announces == ['started', 'started']
+        await tracker.close()
+
+    asyncio.run(main())
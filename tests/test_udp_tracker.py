@@ -0,0 +1,203 @@
+import asyncio
+import socket
+import struct
+import time
+
+import pytest
+
+import udp_tracker
+from errors import TrackerError
+from peer import Peer
+from udp_tracker import (UDPTrackerClient, PROTOCOL_ID, ACTION_CONNECT, ACTION_ANNOUNCE, ACTION_SCRAPE,
+                         ACTION_ERROR, EVENT_STARTED)
+
+INFO_HASH = bytes(range(20))
+PEER_ID = b'-HK0001-000000000000'
+
+
+class StandInTracker(asyncio.DatagramProtocol):
+    """
+    A UDP tracker answering from fixed data, which can drop or garble some responses.
+
+    Instance Variables:
+        self.requests       -- The (action, request) received, in order.
+        self.drop           -- {action: number of requests of the action left to ignore}.
+        self.wrong_transaction -- Whether to send a response with a wrong transaction id before the right one.
+        self.error          -- A message to answer the announces with, None to answer them.
+    """
+    def __init__(self, peers, peers6):
+        self.peers = peers
+        self.peers6 = peers6
+        self.requests = []
+        self.drop = {}
+        self.wrong_transaction = False
+        self.error = None
+        self._connection_ids = set()
+        self._next_id = 1000
+
+    def connection_made(self, transport):
+        self.transport = transport
+
+    def datagram_received(self, data, addr):
+        connection_id, action, transaction_id = struct.unpack_from('>QII', data)
+        self.requests.append((action, data))
+        if self.drop.get(action):
+            self.drop[action] -= 1
+            return
+        if action == ACTION_CONNECT:
+            assert connection_id == PROTOCOL_ID
+            self._next_id += 1
+            self._connection_ids.add(self._next_id)
+            response = struct.pack('>IIQ', ACTION_CONNECT, transaction_id, self._next_id)
+        elif connection_id not in self._connection_ids:
+            response = struct.pack('>II', ACTION_ERROR, transaction_id) + b'Unknown connection id'
+        elif action == ACTION_ANNOUNCE and self.error is not None:
+            response = struct.pack('>II', ACTION_ERROR, transaction_id) + self.error.encode()
+        elif action == ACTION_ANNOUNCE:
+            peers = self.peers6 if len(addr) == 4 else self.peers
+            response = struct.pack('>IIIII', ACTION_ANNOUNCE, transaction_id, 1800, 3, 7) + peers
+        else:
+            hashes = data[16:]
+            response = struct.pack('>II', ACTION_SCRAPE, transaction_id) + b''.join(
+                struct.pack('>III', 10 + i, 20 + i, 30 + i) for i in range(len(hashes) // 20))
+        if self.wrong_transaction:
+            self.wrong_transaction = False
+            garbled = bytearray(response)
+            garbled[4:8] = struct.pack('>I', (transaction_id + 1) % 2 ** 32)
+            self.transport.sendto(bytes(garbled), addr)
+        self.transport.sendto(response, addr)
+
+    def actions(self):
+        return [action for action, _ in self.requests]
+
+
+def compact(peers):
+    return b''.join(socket.inet_pton(socket.AF_INET6 if ':' in host else socket.AF_INET, host) +
+                    struct.pack('>H', port) for host, port in peers)
+
+
+PEERS = [('10.0.0.1', 6881), ('192.168.1.20', 51413)]
+PEERS6 = [('2001:db8::1', 6881), ('fe80::42', 6882)]
+
+
+async def start_tracker(host='127.0.0.1'):
+    loop = asyncio.get_event_loop()
+    family = socket.AF_INET6 if ':' in host else socket.AF_INET
+    transport, tracker = await loop.create_datagram_endpoint(
+        lambda: StandInTracker(compact(PEERS), compact(PEERS6)), local_addr=(host, 0), family=family)
+    port = transport.get_extra_info('sockname')[1]
+    url = 'udp://%s:%s/announce' % ('[%s]' % host if family == socket.AF_INET6 else host, port)
+    return transport, tracker, url
+
+
+def run(test, host='127.0.0.1', **client_args):
+    async def main():
+        transport, tracker, url = await start_tracker(host)
+        client = UDPTrackerClient(**client_args)
+        await client.start()
+        try:
+            return await test(client, tracker, url)
+        finally:
+            client.close()
+            transport.close()
+    return asyncio.run(main())
+
+
+def ipv6_available():
+    try:
+        with socket.socket(socket.AF_INET6, socket.SOCK_DGRAM) as sock:
+            sock.bind(('::1', 0))
+        return True
+    except OSError:
+        return False
+
+
+def test_announce():
+    async def test(client, tracker, url):
+        result = await client.announce(url, INFO_HASH, PEER_ID, downloaded=5, left=100, uploaded=7,
+                                       event='started', port=6889)
+        assert tracker.actions() == [ACTION_CONNECT, ACTION_ANNOUNCE]
+        fields = struct.unpack('>QII20s20sQQQIIIiH', tracker.requests[1][1])
+        assert fields[3:9] == (INFO_HASH, PEER_ID, 5, 100, 7, EVENT_STARTED)
+        assert fields[-1] == 6889
+        return result
+
+    interval, leechers, seeders, peers = run(test)
+    assert (interval, leechers, seeders) == (1800, 3, 7)
+    assert peers == [Peer(host, port) for host, port in PEERS]
+
+
+@pytest.mark.skipif(not ipv6_available(), reason='No IPv6 loopback')
+def test_announce_ipv6():
+    async def test(client, tracker, url):
+        return await client.announce(url, INFO_HASH, PEER_ID)
+
+    _, _, _, peers = run(test, host='::1')
+    assert peers == [Peer(host, port) for host, port in PEERS6]
+
+
+def test_scrape():
+    other = bytes(range(20, 40))
+
+    async def test(client, tracker, url):
+        return await client.scrape(url, [INFO_HASH, other])
+
+    assert run(test) == {INFO_HASH: (10, 20, 30), other: (11, 21, 31)}
+
+
+def test_connection_id_reused_until_it_expires(monkeypatch):
+    async def test(client, tracker, url):
+        await client.announce(url, INFO_HASH, PEER_ID)
+        await client.announce(url, INFO_HASH, PEER_ID)
+        assert tracker.actions() == [ACTION_CONNECT, ACTION_ANNOUNCE, ACTION_ANNOUNCE]
+        now = time.monotonic()
+        monkeypatch.setattr(udp_tracker.time, 'monotonic', lambda: now + udp_tracker.CONNECTION_ID_LIFETIME + 1)
+        await client.announce(url, INFO_HASH, PEER_ID)
+        assert tracker.actions()[3:] == [ACTION_CONNECT, ACTION_ANNOUNCE]
+
+    run(test)
+
+
+def test_wrong_transaction_id_ignored():
+    async def test(client, tracker, url):
+        tracker.wrong_transaction = True
+        result = await client.announce(url, INFO_HASH, PEER_ID)
+        # Answered by the right response, not by a retry
+        assert tracker.actions() == [ACTION_CONNECT, ACTION_ANNOUNCE]
+        return result
+
+    assert run(test, retry_base=5)[0] == 1800
+
+
+def test_retry_after_dropped_response():
+    async def test(client, tracker, url):
+        tracker.drop[ACTION_ANNOUNCE] = 1
+        start = time.monotonic()
+        result = await client.announce(url, INFO_HASH, PEER_ID)
+        assert time.monotonic() - start >= 0.05
+        assert tracker.actions() == [ACTION_CONNECT, ACTION_ANNOUNCE, ACTION_ANNOUNCE]
+        return result
+
+    assert run(test, retry_base=0.05)[0] == 1800
+
+
+def test_retry_schedule_gives_up():
+    async def test(client, tracker, url):
+        tracker.drop[ACTION_CONNECT] = 100
+        start = time.monotonic()
+        with pytest.raises(TrackerError):
+            await client.announce(url, INFO_HASH, PEER_ID)
+        # Waits of 0.05, 0.1 and 0.2 seconds
+        assert time.monotonic() - start >= 0.35
+        assert tracker.actions() == [ACTION_CONNECT] * 3
+
+    run(test, retry_base=0.05, max_retries=2)
+
+
+def test_error_response():
+    async def test(client, tracker, url):
+        tracker.error = 'Torrent not registered'
+        with pytest.raises(TrackerError, match='Torrent not registered'):
+            await client.announce(url, INFO_HASH, PEER_ID)
+
+    run(test)
@@ -0,0 +1,47 @@
+import hashlib
+import os
+import random
+
+import verify
+from storage import Storage
+from torrent import DownloadInfo
+
+PIECE_LENGTH = 2 ** 14
+
+
+def test_verify_maps_only_files_of_the_piece(tmp_path, monkeypatch):
+    rnd = random.Random(1)
+    sizes = [rnd.randrange(1, 3 * PIECE_LENGTH) for _ in range(200)]
+    data = rnd.randbytes(sum(sizes))
+    files = [{b'length': size, b'path': [b'f%03d' % i]} for i, size in enumerate(sizes)]
+    pieces = b''.join(hashlib.sha1(data[i:i + PIECE_LENGTH]).digest() for i in range(0, len(data), PIECE_LENGTH))
+    download_info = DownloadInfo.from_dict({b'files': files, b'name': b'data', b'piece length': PIECE_LENGTH,
+                                            b'pieces': pieces})
+    storage = Storage(download_info, str(tmp_path))
+    storage.write(0, data)
+    storage.close()
+    # A bad piece and a file cut short
+    with open(storage.paths[10], 'r+b') as file:
+        file.write(b'x')
+    os.truncate(storage.paths[50], sizes[50] - 1)
+
+    opened = []
+    peak = [0]
+    real_map = verify._map
+
+    def counting_map(path):
+        mapped = real_map(path)
+        opened.append(mapped)
+        peak[0] = max(peak[0], sum(not m.closed for m in opened))
+        return mapped
+
+    monkeypatch.setattr(verify, '_map', counting_map)
+    have = verify.verify(download_info, storage, workers=1)
+
+    offsets = [sum(sizes[:i]) for i in range(len(sizes) + 1)]
+    expected = [True] * len(have)
+    for damaged in (offsets[10], offsets[51] - 1):
+        expected[damaged // PIECE_LENGTH] = False
+    assert have.tolist() == expected
+    assert peak[0] <= 4
+    assert all(mapped.closed for mapped in opened)
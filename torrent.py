@@ -4,16 +4,24 @@ import os
 from time import sleep
 from math import ceil
 
-from bencode import bdecode, bencode
-from util import slice
-from piece import PieceInfo
-
-SHA1_DIGEST_LEN = 20
+from bencode import bdecode_spans, bencode
+from errors import BTFailure
+from piece import PieceTable, SHA1_DIGEST_LEN
 
 
 def read_torrent_file(torrent_file):
+    """
+    Returns the decoded torrent and the SHA1 of its info dictionary, hashed
+    over the bytes exactly as stored in the file rather than re-encoded.
+    """
     with open(torrent_file, 'rb') as file:
-        return bdecode(file.read())
+        data = file.read()
+    dictionary, spans = bdecode_spans(data, (b'info',))
+    if b'info' not in spans:
+        raise BTFailure('Missing info dictionary')
+    begin, end = spans[b'info']
+    info_hash = hashlib.sha1(memoryview(data)[begin:end]).digest()
+    return dictionary, info_hash
 
 
 def peer_id():
@@ -29,22 +37,23 @@ class TorrentInfo:
     Instance Variables:
         self.download_info  -- Detail information.
         self._announce_list -- The urls of trackers for peers list.
-        self.paused         -- .
+        self._my_peer_id    -- Our peer id, the same for every torrent of a session.
+        self.paused         -- Whether the torrent is paused.
         self.download_dir   -- Directory to store downloaded files.
     """
-    def __init__(self, download_info, announce_list, download_dir):
+    def __init__(self, download_info, announce_list, download_dir, my_peer_id=None):
         self.download_info = download_info
         self._announce_list = announce_list
 
-        self._my_peer_id = peer_id()
+        self._my_peer_id = my_peer_id if my_peer_id is not None else peer_id()
         self.paused = False
 
         self.download_dir = download_dir
 
     @classmethod
-    def from_file(cls, filename, download_dir):
-        dictionary = read_torrent_file(filename)
-        download_info = DownloadInfo.from_dict(dictionary[b'info'])
+    def from_file(cls, filename, download_dir, my_peer_id=None):
+        dictionary, info_hash = read_torrent_file(filename)
+        download_info = DownloadInfo.from_dict(dictionary[b'info'], info_hash)
 
         if b'announce-list' in dictionary:
             announce_list = [[url.decode() for url in iter]
@@ -52,7 +61,7 @@ class TorrentInfo:
         else:
             announce_list = [dictionary[b'announce'].decode()]
 
-        return cls(download_info, announce_list, download_dir)
+        return cls(download_info, announce_list, download_dir, my_peer_id)
 
     @property
     def announce_list(self):
@@ -114,40 +123,41 @@ class DownloadInfo:
         self.info_hash      -- SHA1 hash of the bencoded info dictionary.
         self.piece_length   -- Length of each piece.
         self.suggested_name -- Torrent name or single file name.
+        self.single_file    -- Whether the torrent is a single file one (no 'files' list).
         self.files          -- The list of files(FileInfo).
         self._file_tree     -- The file tree in dictionary structure, just shown above.
-        self._pieces        -- The information of pieces.
-        self.downloaded_piece_count -- The number of pieces has downloaded, for pause.
+        self._pieces        -- The piece table (PieceTable).
+        self._total_size    -- The sum of the file lengths.
     """
-    def __init__(self, info_hash, piece_length, piece_hashes, suggested_name, files, private=False):
+    def __init__(self, info_hash, piece_length, piece_hashes, suggested_name, files, private=False,
+                 single_file=False):
         self.info_hash = info_hash
         self.piece_length = piece_length
         self.suggested_name = suggested_name
         self.private = private  # optional  field
+        self.single_file = single_file
 
         self.files = files
         self._file_tree = {}
         self._create_file_tree()
+        self._total_size = sum(file.length for file in files)
 
         assert piece_hashes
-        piece_count = len(piece_hashes)
-        self._pieces = [PieceInfo(index, item, piece_length)\
-                        for index, item in enumerate(piece_hashes[:-1])]
-        last_piece_length = self.total_size - (piece_count - 1) * piece_length
-        self._pieces.append(PieceInfo(piece_count-1, piece_hashes[-1], last_piece_length))
-
-        if ceil(self.total_size / piece_length) != piece_count:
+        piece_count = len(piece_hashes) // SHA1_DIGEST_LEN
+        if ceil(self._total_size / piece_length) != piece_count:
             raise ValueError("Invalid count of piece hashes")
 
-        self.downloaded_piece_count = 0
+        # piece_hashes is the raw 'pieces' string, kept as one buffer
+        self._pieces = PieceTable(piece_hashes, piece_length, self._total_size)
 
     @classmethod
-    def from_dict(cls, dictionary):
-        info_hash = hashlib.sha1(bencode(dictionary)).digest()
+    def from_dict(cls, dictionary, info_hash=None):
+        if info_hash is None:
+            info_hash = hashlib.sha1(bencode(dictionary)).digest()
 
-        if len(dictionary[b"pieces"]) % SHA1_DIGEST_LEN != 0:
+        piece_hashes = dictionary[b"pieces"]
+        if len(piece_hashes) % SHA1_DIGEST_LEN != 0:
             raise ValueError("Invalid length of pieces string")
-        piece_hashes = slice(dictionary[b"pieces"], SHA1_DIGEST_LEN)
 
         if b"files" in dictionary:
             files = list(map(FileInfo.from_dict, dictionary[b"files"]))
@@ -155,7 +165,7 @@ class DownloadInfo:
             files = [FileInfo.from_dict(dictionary)]
 
         return cls(info_hash, dictionary[b"piece length"], piece_hashes, dictionary[b"name"].decode(), files,
-                   private=dictionary.get(b"private", False))
+                   private=dictionary.get(b"private", False), single_file=b"files" not in dictionary)
 
     def _create_file_tree(self):
         offset = 0
@@ -211,21 +221,17 @@ class DownloadInfo:
             piece_begin = offset // self.piece_length
             piece_end = ceil((offset + length) / self.piece_length)
 
-            for index in range(piece_begin, piece_end):
-                self.pieces[index].selected = True
+            self._pieces.selected[piece_begin:piece_end] = True
 
     def reset_run_stat(self):
         pass
 
     def get_real_piece_length(self, index):
-        if index == self.piece_count - 1:
-            return self.total_size - self.piece_length * (self.piece_count - 1)
-        else:
-            return self.piece_length
+        return self._pieces.piece_length(index)
 
     @property
     def total_size(self):
-        return sum(file.length for file in self.files)
+        return self._total_size
 
     @property
     def pieces(self):
@@ -235,12 +241,17 @@ class DownloadInfo:
     def piece_count(self):
         return len(self._pieces)
 
+    @property
+    def downloaded_piece_count(self):
+        """The number of pieces has downloaded, for pause."""
+        return self._pieces.downloaded_count
+
     @property
     def bytes_left(self):
         result = (self.piece_count - self.downloaded_piece_count) * self.piece_length
         last_piece_index = self.piece_count - 1
-        if not self._pieces[last_piece_index].is_complete:
-            result += self._pieces[last_piece_index].length - self.piece_length
+        if not self._pieces.downloaded[last_piece_index]:
+            result += self._pieces.piece_length(last_piece_index) - self.piece_length
         return result
 
     @property
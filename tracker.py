@@ -1,167 +1,434 @@
+import asyncio
 import aiohttp
-import socket
 import logging
-import struct
 import random
 import urllib.parse as urlparse
 
-from peer import Peer
-from util import slice
-from errors import TrackerError
+import metrics
+from peer import Peer, parse_compact_peers
+from util import SleepUneasy
+from errors import BTFailure, TrackerError
 from bencode import bdecode
 from torrent import TorrentInfo
-
-
-def parse_peers_list(data):
-    if isinstance(data, bytes):
-        if len(data) % 6 != 0:
-            raise ValueError('Invalid length of a compact representation of peers')
-        return list(map(Peer.from_compact_form, slice(data, 6)))
+from udp_tracker import UDPTrackerClient
+
+TRACKER_TIMEOUT = 15
+# request_peers() returns once this many peers are known
+MIN_PEERS = 30
+HTTP_CONNECTIONS = 50
+DNS_CACHE_TTL = 300
+
+# Used until a tracker tells its own intervals
+DEFAULT_INTERVAL = 1800
+DEFAULT_MIN_INTERVAL = 60
+# A failed announce is retried after RETRY_INTERVAL * 2 ** (failures - 1) seconds, at most MAX_RETRY_INTERVAL
+RETRY_INTERVAL = 15
+MAX_RETRY_INTERVAL = 1800
+# Time given to the trackers to receive the stopped event on close
+STOP_TIMEOUT = 5
+
+# What a failed announce or scrape raises
+_TRACKER_ERRORS = (TrackerError, aiohttp.ClientError, OSError, BTFailure, KeyError, ValueError)
+
+
+def parse_peers_list(data, ipv6=False):
+    if isinstance(data, (bytes, bytearray, memoryview)):
+        return parse_compact_peers(data, ipv6)
     else:
         return list(map(Peer.from_dict, data))
 
 
+def scrape_url(url):
+    """
+    The scrape url of an HTTP tracker by the usual convention, None if it has none.
+    """
+    parsed = urlparse.urlparse(url)
+    head, _, last = parsed.path.rpartition('/')
+    if not last.startswith('announce'):
+        return None
+    return urlparse.urlunparse(parsed._replace(path=head + '/scrape' + last[len('announce'):]))
+
+
+async def scrape(url, info_hashes, session: aiohttp.ClientSession, udp: UDPTrackerClient, timeout=TRACKER_TIMEOUT):
+    """
+    Asks the tracker at `url` about many torrents at once.
+    Returns {info_hash: (seeders, completed, leechers)} of the torrents it knows.
+    """
+    if url.startswith("udp"):
+        return await udp.scrape(url, list(info_hashes))
+
+    url = scrape_url(url)
+    if url is None:
+        raise TrackerError("Tracker does not support scrape")
+    query = urlparse.urlencode([('info_hash', info_hash) for info_hash in info_hashes])
+    async with session.get(url + ('&' if '?' in url else '?') + query,
+                           timeout=aiohttp.ClientTimeout(total=timeout)) as conn:
+        resp_data = await conn.read()
+    if conn.status >= 400:
+        raise TrackerError("Tracker answered HTTP %s" % conn.status)
+    response = bdecode(resp_data)
+    if b'failure reason' in response:
+        raise TrackerError(response[b'failure reason'].decode(errors='replace'))
+    return {info_hash: (stats.get(b'complete', 0), stats.get(b'downloaded', 0), stats.get(b'incomplete', 0))
+            for info_hash, stats in response.get(b'files', {}).items()}
+
+
+class TrackerEndpoint(object):
+    """
+    The announce schedule of one tracker.
+
+    Instance Variables:
+        self.url            -- The announce url.
+        self.interval       -- Seconds between regular announces, as the tracker asks.
+        self.min_interval   -- Announces are never closer than this.
+        self.tracker_id     -- The 'tracker id' to send back, None if the tracker gave none.
+        self.last_announce  -- Loop time of the last successful announce, None before it.
+        self.failures       -- The number of announces failed in a row.
+        self.retry_at       -- Loop time before which a failed announce is not tried again, None after success.
+        self.attempted      -- Whether the first announce finished, successful or not.
+        self.started        -- Whether the started event was sent, so stopped must be sent too.
+        self.event          -- The event to send with the next announce.
+        self.seeders        -- The seeders in the swarm the last announce reported, None if unknown.
+        self.leechers       -- The leechers in the swarm the last announce reported, None if unknown.
+        self.sleeper        -- The SleepUneasy between announces, interrupted for an early one.
+    """
+    def __init__(self, url):
+        self.url = url
+        self.interval = DEFAULT_INTERVAL
+        self.min_interval = DEFAULT_MIN_INTERVAL
+        self.tracker_id = None
+        self.last_announce = None
+        self.failures = 0
+        self.retry_at = None
+        self.attempted = False
+        self.started = False
+        self.event = 'started'
+        self.seeders = None
+        self.leechers = None
+        self.sleeper = SleepUneasy()
+
+    def __repr__(self):
+        return 'TrackerEndpoint(%s)' % self.url
+
+
 class Tracker:
     """
     Holds the information about tracker and the peer list from tracker.
 
+    Every tracker of every tier (BEP 12) is announced to concurrently: HTTP
+    trackers with their own timeout over one pooled HTTP session, UDP
+    trackers (BEP 15) through one UDPTrackerClient socket. Each tracker is
+    then announced to again every interval it asks for, earlier when
+    reannounce() is called but never before its min interval. Its first
+    announce sends the started event, completed() and close() send the
+    completed and stopped ones.
+
+    request_peers() returns as soon as `min_peers` peers are known, the
+    announces go on in the background and report new peers to the listeners.
+
     Instance Variables:
-        self.tracker_url    -- .
-        self._download_info -- .
+        self.tiers          -- The tiers of tracker urls, each shuffled as BEP 12 asks.
+        self.endpoints      -- The TrackerEndpoint of each url.
+        self._download_info -- The DownloadInfo of the torrent.
         self._peers         -- The peer list from tracker.
-        self._my_peer_id    -- .
+        self._known         -- The (host, port) of the peers in self._peers.
+        self._my_peer_id    -- The peer id sent to trackers.
+        self._stats         -- Callable returning the (uploaded, downloaded, left) bytes to report.
+        self._session       -- The aiohttp session shared by the HTTP announces.
+        self._own_session   -- Whether the session is ours to close.
+        self._udp           -- The UDPTrackerClient of the UDP announces.
+        self._own_udp       -- Whether the UDP client is ours to close.
+        self._tasks         -- The announce loop of each tracker, once started.
+        self._closing       -- Set by close(), ends the announce loops.
+        self._listeners     -- Callbacks called with the list of new peers when a tracker answers.
+        self._changed       -- Set when peers arrive or an announce finishes, for request_peers().
+        self.port           -- The port peers can connect to.
     """
-    def __init__(self, torrent: TorrentInfo):
-        self.tracker_url = self._transfer_url_list(torrent.announce_list)
+    def __init__(self, torrent: TorrentInfo, session=None, udp=None, timeout=TRACKER_TIMEOUT, stats=None,
+                 port=6881):
+        self.tiers = self._transfer_url_list(torrent.announce_list)
+        self.endpoints = [TrackerEndpoint(url) for tier in self.tiers for url in tier]
         self._download_info = torrent.download_info
         self._peers = list()
+        self._known = set()
         self._my_peer_id = torrent.my_peer_id
+        self._stats = stats if stats is not None else lambda: (0, 0, self._download_info.bytes_left)
+        self._session = session
+        self._own_session = session is None
+        self._udp = udp
+        self._own_udp = udp is None
+        self._tasks = []
+        self._closing = False
+        self._listeners = []
+        self._changed = asyncio.Event()
+        self.timeout = timeout
+        self.port = port
 
     @property
     def peers(self):
         return self._peers
 
-    @staticmethod
-    def _transfer_url_list(url_list):
-        if isinstance(url_list[0], str):
-            return url_list
-        elif isinstance(url_list[0], list):
-            tmp_list = list()
-            for ls in url_list:
-                tmp_list.extend(ls)
-            return tmp_list
-
-    def handle_response_http(self, response):
-        if b'failure reason' in response:
-            raise TrackerError(response[b'failure reason'].decode())
+    @property
+    def tracker_url(self):
+        return [url for tier in self.tiers for url in tier]
 
-        self.interval = response[b'interval']
-        self._peers.extend(parse_peers_list(response[b'peers']))
+    @property
+    def interval(self):
+        """
+        {url: announce interval} of the trackers that answered.
+        """
+        return {endpoint.url: endpoint.interval for endpoint in self.endpoints
+                if endpoint.last_announce is not None}
 
+    @staticmethod
+    def _transfer_url_list(url_list):
+        """
+        The announce list as tiers: a list of lists of urls.
+        """
+        tiers = list()
+        for tier in url_list:
+            tier = [tier] if isinstance(tier, str) else list(tier)
+            random.shuffle(tier)
+            if tier:
+                tiers.append(tier)
+        return tiers
+
+    def add_listener(self, callback):
+        self._listeners.append(callback)
 
-    async def request_peers_http(self, url):
+    @property
+    def session(self):
+        if self._session is None:
+            self._session = aiohttp.ClientSession(
+                connector=aiohttp.TCPConnector(limit=HTTP_CONNECTIONS, ttl_dns_cache=DNS_CACHE_TTL))
+        return self._session
+
+    async def udp(self):
+        if self._udp is None:
+            self._udp = UDPTrackerClient()
+        return await self._udp.start()
+
+    def _add_peers(self, peers):
+        new_peers = list()
+        for peer in peers:
+            if (peer.host, peer.port) not in self._known:
+                self._known.add((peer.host, peer.port))
+                new_peers.append(peer)
+        self._peers.extend(new_peers)
+        if new_peers:
+            self._changed.set()
+            for callback in self._listeners:
+                callback(new_peers)
+        return new_peers
+
+    def handle_response_http(self, endpoint: TrackerEndpoint, response):
+        if b'failure reason' in response:
+            raise TrackerError(response[b'failure reason'].decode(errors='replace'))
+        if b'warning message' in response:
+            logging.warning("Tracker %s: %s" % (endpoint.url, response[b'warning message'].decode(errors='replace')))
+
+        endpoint.interval = response[b'interval']
+        endpoint.min_interval = response.get(b'min interval', min(endpoint.interval, DEFAULT_MIN_INTERVAL))
+        if b'tracker id' in response:
+            endpoint.tracker_id = response[b'tracker id']
+        endpoint.seeders = response.get(b'complete')
+        endpoint.leechers = response.get(b'incomplete')
+        peers = parse_peers_list(response.get(b'peers', b''))
+        if b'peers6' in response:
+            # BEP 7
+            peers += parse_peers_list(response[b'peers6'], ipv6=True)
+        return self._add_peers(peers)
+
+    async def request_peers_http(self, endpoint: TrackerEndpoint, event):
+        uploaded, downloaded, left = self._stats()
         params = {
             'info_hash': self._download_info.info_hash,
             'peer_id': self._my_peer_id,
-            'port': 6881,
-            'uploaded': 0,
-            'downloaded': 0,
-            'left': self._download_info.total_size,
+            'port': self.port,
+            'uploaded': uploaded,
+            'downloaded': downloaded,
+            'left': left,
             'compact': 1,
-            'envet': 'started',
         }
+        if event is not None:
+            params['event'] = event
+        if endpoint.tracker_id is not None:
+            params['trackerid'] = endpoint.tracker_id
 
-        url = url + '?' + urlparse.urlencode(params)
+        url = endpoint.url + ('&' if '?' in endpoint.url else '?') + urlparse.urlencode(params)
 
-        async with aiohttp.ClientSession() as session:
-            async with session.get(url) as conn:
-                resp_data = await conn.read()
+        async with self.session.get(url) as conn:
+            resp_data = await conn.read()
 
         if conn.status >= 400:
-            logging.error("Tracker host cannot reachable: %s " % url)
-            return
+            raise TrackerError("Tracker answered HTTP %s" % conn.status)
         resp_data = bdecode(resp_data)
         if not resp_data:
-            logging.error("Tracker returned an empty answer: %s " % url)
-            return
-
-        self.handle_response_http(resp_data)
-
-
-    async def request_peers(self):
-        for url in self.tracker_url:
-            if url.startswith("http"):
-                await self.request_peers_http(url)
-            elif url.startswith("udp"):
+            raise TrackerError("Tracker returned an empty answer")
+        return resp_data
+
+    async def request_peers_udp(self, endpoint: TrackerEndpoint, event):
+        udp = await self.udp()
+        uploaded, downloaded, left = self._stats()
+        interval, leechers, seeders, peers = await udp.announce(
+            endpoint.url, self._download_info.info_hash, self._my_peer_id.encode(),
+            downloaded=downloaded, left=left, uploaded=uploaded, event=event, port=self.port)
+        endpoint.interval = interval
+        endpoint.min_interval = min(interval, DEFAULT_MIN_INTERVAL)
+        endpoint.seeders = seeders
+        endpoint.leechers = leechers
+        return self._add_peers(peers)
+
+    async def _announce(self, endpoint: TrackerEndpoint, event):
+        """
+        Announces once, raises TrackerError, OSError, ... if it failed.
+        """
+        if endpoint.url.startswith("http"):
+            response = await asyncio.wait_for(self.request_peers_http(endpoint, event), self.timeout)
+            return self.handle_response_http(endpoint, response)
+        elif endpoint.url.startswith("udp"):
+            # Retried with the backoff of BEP 15 rather than under self.timeout
+            return await self.request_peers_udp(endpoint, event)
+        raise TrackerError("Unsupported protocol")
+
+    async def _run(self, endpoint: TrackerEndpoint):
+        """
+        The announce loop of one tracker.
+        """
+        loop = asyncio.get_event_loop()
+        while not self._closing:
+            # Early announces still respect the backoff after a failure and the min interval,
+            # the completed event only waits for the backoff
+            if endpoint.retry_at is not None:
+                wait = endpoint.retry_at - loop.time()
+            elif endpoint.last_announce is not None and endpoint.event != 'completed':
+                wait = endpoint.last_announce + endpoint.min_interval - loop.time()
+            else:
+                wait = 0
+            if wait > 0:
+                await endpoint.sleeper.sleep(wait)
                 continue
-                #request_peers_udp(self._download_info.info_hash, url, self._my_peer_id)
 
-        assert len(self.peers) > 0
-        return self.peers
-
-
-    ####################################################################################
-def request_peers_udp(info_hash, url, peer_id):
-    """Still not implemented
-        From others
-    """
-    parsed = urlparse.urlparse(url)
-    ip = socket.gethostbyname(parsed.hostname)
-    if ip == '127.0.0.1':
-        return False
-    sock = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
-    sock.settimeout(8)
-    conn = (ip, parsed.port)
-    msg, trans_id, action = make_connection_id_request()
-    response = send_msg(conn, sock, msg, trans_id, action, 16)
-    conn_id = response[8:]
-    msg, trans_id, action = make_announce_input(info_hash, conn_id, peer_id)
-    response = send_msg(conn, sock, msg, trans_id, action, 20)
-
-    return response[20:]
-
-def make_connection_id_request():
-    conn_id = struct.pack('>Q', 0x41727101980)
-    action = struct.pack('>I', 0)
-    trans_id = struct.pack('>I', random.randint(0, 100000))
-
-    return (conn_id + action + trans_id, trans_id, action)
-
-def make_announce_input(info_hash, conn_id, peer_id):
-    action = struct.pack('>I', 1)
-    trans_id = struct.pack('>I', random.randint(0, 100000))
-
-    downloaded = struct.pack('>Q', 0)
-    left = struct.pack('>Q', 0)
-    uploaded = struct.pack('>Q', 0)
-
-    event = struct.pack('>I', 0)
-    ip = struct.pack('>I', 0)
-    key = struct.pack('>I', 0)
-    num_want = struct.pack('>i', -1)
-    port = struct.pack('>h', 8000)
-
-    msg = (conn_id + action + trans_id + info_hash + peer_id + downloaded +
-           left + uploaded + event + ip + key + num_want + port)
-
-    return msg, trans_id, action
-
-def send_msg(conn, sock, msg, trans_id, action, size):
-    sock.sendto(msg, conn)
-    try:
-        response = sock.recv(2048)
-    except socket.timeout as err:
-        logging.debug(err)
-        logging.debug("Connecting again...")
-        return send_msg(conn, sock, msg, trans_id, action, size)
-    if len(response) < size:
-        logging.debug("Did not get full message. Connecting again...")
-        return send_msg(conn, sock, msg, trans_id, action, size)
-
-    if action != response[0:4] or trans_id != response[4:8]:
-        logging.debug("Transaction or Action ID did not match. Trying again...")
-        return send_msg(conn, sock, msg, trans_id, action, size)
-
-    return response
-
-    ###################################################################################
+            event = endpoint.event
+            started = loop.time()
+            result = None
+            try:
+                new_peers = await self._announce(endpoint, event)
+            except asyncio.TimeoutError:
+                logging.error("Tracker %s timed out" % endpoint.url)
+                endpoint.failures += 1
+                result = 'timeout'
+            except _TRACKER_ERRORS as e:
+                logging.error("Tracker %s failed: %s" % (endpoint.url, e))
+                endpoint.failures += 1
+                result = 'error'
+            else:
+                result = 'ok'
+                logging.info("Tracker %s returned %s new peers" % (endpoint.url, len(new_peers)))
+                endpoint.failures = 0
+                endpoint.last_announce = loop.time()
+                if event == 'started':
+                    endpoint.started = True
+                if endpoint.event == event:
+                    endpoint.event = None
+            finally:
+                endpoint.attempted = True
+                self._changed.set()
+                if result is not None:
+                    metrics.TRACKER_LATENCY.labels(protocol=endpoint.url.split(':', 1)[0],
+                                                   result=result).observe(loop.time() - started)
+
+            # aiohttp may turn the cancellation of a connect into a connection error
+            if self._closing:
+                return
+            if endpoint.failures:
+                # Waited for at the top of the loop, so that reannounce() cannot cut it short
+                endpoint.retry_at = loop.time() + min(MAX_RETRY_INTERVAL,
+                                                      RETRY_INTERVAL * 2 ** (endpoint.failures - 1))
+            else:
+                endpoint.retry_at = None
+                await endpoint.sleeper.sleep(endpoint.interval)
+
+    def start(self):
+        self._closing = False
+        if not self._tasks:
+            self._tasks = [asyncio.ensure_future(self._run(endpoint)) for endpoint in self.endpoints]
+
+    async def request_peers(self, min_peers=MIN_PEERS):
+        """
+        Starts announcing to every tracker at once. Returns the peers known once there
+        are `min_peers` of them, once self.timeout passed and there is any peer, or once
+        every tracker was tried.
+        """
+        self.start()
+        loop = asyncio.get_event_loop()
+        deadline = loop.time() + self.timeout
+        while len(self._peers) < min_peers and not all(endpoint.attempted for endpoint in self.endpoints):
+            # UDP trackers may keep retrying for long, settle for any peer after the timeout
+            if self._peers and loop.time() >= deadline:
+                break
+            self._changed.clear()
+            timeout = deadline - loop.time() if loop.time() < deadline else None
+            try:
+                await asyncio.wait_for(self._changed.wait(), timeout)
+            except asyncio.TimeoutError:
+                pass
+
+        if not self._peers:
+            raise TrackerError("No peers from any tracker")
+        return list(self.peers)
+
+    def reannounce(self):
+        """
+        Asks every tracker for peers now, or as soon as its min interval allows.
+        """
+        for endpoint in self.endpoints:
+            endpoint.sleeper.interrupt()
+
+    def completed(self):
+        """
+        The download completed, tell the trackers that were told it started.
+        """
+        for endpoint in self.endpoints:
+            if endpoint.started:
+                endpoint.event = 'completed'
+                endpoint.sleeper.interrupt()
+
+    async def scrape(self):
+        """
+        Returns {url: (seeders, completed, leechers)} of the trackers that answered the scrape.
+        """
+        info_hash = self._download_info.info_hash
+        udp = await self.udp() if any(url.startswith("udp") for url in self.tracker_url) else None
+
+        async def scrape_one(url):
+            try:
+                return url, (await asyncio.wait_for(scrape(url, [info_hash], self.session, udp, self.timeout),
+                                                    self.timeout)).get(info_hash)
+            except (asyncio.TimeoutError, ) + _TRACKER_ERRORS as e:
+                logging.debug("Scrape of %s failed: %s" % (url, e))
+                return url, None
+
+        results = await asyncio.gather(*[scrape_one(url) for url in self.tracker_url])
+        return {url: result for url, result in results if result is not None}
+
+    async def _stop(self, endpoint: TrackerEndpoint):
+        try:
+            await asyncio.wait_for(self._announce(endpoint, 'stopped'), STOP_TIMEOUT)
+        except (asyncio.TimeoutError, ) + _TRACKER_ERRORS as e:
+            logging.debug("Failed to send stopped to %s: %s" % (endpoint.url, e))
+
+    async def close(self):
+        self._closing = True
+        for task in self._tasks:
+            task.cancel()
+        if self._tasks:
+            await asyncio.gather(*self._tasks, return_exceptions=True)
+        self._tasks = []
+        await asyncio.gather(*[self._stop(endpoint) for endpoint in self.endpoints if endpoint.started])
+        if self._own_session and self._session is not None:
+            await self._session.close()
+        self._session = None
+        if self._own_udp and self._udp is not None:
+            self._udp.close()
+        self._udp = None
@@ -0,0 +1,228 @@
+import asyncio
+import logging
+import random
+import socket
+import struct
+import time
+import urllib.parse as urlparse
+
+from errors import TrackerError
+from peer import parse_compact_peers
+
+PROTOCOL_ID = 0x41727101980
+
+ACTION_CONNECT = 0
+ACTION_ANNOUNCE = 1
+ACTION_SCRAPE = 2
+ACTION_ERROR = 3
+
+EVENT_NONE = 0
+EVENT_COMPLETED = 1
+EVENT_STARTED = 2
+EVENT_STOPPED = 3
+EVENTS = {None: EVENT_NONE, 'completed': EVENT_COMPLETED, 'started': EVENT_STARTED, 'stopped': EVENT_STOPPED}
+
+# A connection id may be used for a minute after it was received
+CONNECTION_ID_LIFETIME = 60
+# Request n is given RETRY_BASE * 2 ** n seconds to be answered, n going up to MAX_RETRIES
+RETRY_BASE = 15
+MAX_RETRIES = 8
+# A scrape request carries at most this many info hashes
+MAX_SCRAPE_HASHES = 74
+
+_HEADER = struct.Struct('>II')  # action, transaction id
+_CONNECT = struct.Struct('>QII')  # protocol id, action, transaction id
+_CONNECT_RESPONSE = struct.Struct('>IIQ')
+_ANNOUNCE = struct.Struct('>QII20s20sQQQIIIiH')
+_ANNOUNCE_RESPONSE = struct.Struct('>IIIII')  # action, transaction id, interval, leechers, seeders
+_SCRAPE_ENTRY = struct.Struct('>III')  # seeders, completed, leechers
+# Size of a compact peer, trackers reached over IPv6 give IPv6 peers
+_PEER_SIZE = {socket.AF_INET: 6, socket.AF_INET6: 18}
+_LOCAL_ADDR = {socket.AF_INET: ('0.0.0.0', 0), socket.AF_INET6: ('::', 0)}
+
+
+def _family(address):
+    return socket.AF_INET6 if len(address) == 4 else socket.AF_INET
+
+
+def parse_url(url):
+    parsed = urlparse.urlparse(url)
+    if parsed.scheme != 'udp' or not parsed.hostname or not parsed.port:
+        raise TrackerError("Invalid UDP tracker url %s" % url)
+    return parsed.hostname, parsed.port
+
+
+class UDPTrackerClient(asyncio.DatagramProtocol):
+    """
+    Talks to UDP trackers (BEP 15) over one socket per address family.
+
+    Requests to every tracker share the socket, responses are matched to
+    requests by their transaction id. The IPv6 socket is only opened for
+    the first tracker reached over IPv6. A request not answered in
+    retry_base * 2 ** n seconds is sent again, with a new connection id
+    if the one used expired, until n reaches max_retries.
+
+    Instance Variables:
+        self._transports    -- {address family: datagram transport} of the sockets open.
+        self._starting      -- {address family: task opening its socket}.
+        self._pending       -- {transaction id: (future, address)} of the requests waiting for a response.
+        self._connections   -- {address: (connection id, expiry time)} of the trackers connected to.
+        self.retry_base     -- The timeout of the first attempt of a request.
+        self.max_retries    -- The number of times a request is sent again before giving up.
+    """
+    def __init__(self, retry_base=RETRY_BASE, max_retries=MAX_RETRIES):
+        self._transports = {}
+        self._starting = {}
+        self._pending = {}
+        self._connections = {}
+        self.retry_base = retry_base
+        self.max_retries = max_retries
+
+    async def start(self, local_addr=None):
+        """
+        Opens the IPv4 socket.
+        """
+        await self._open(socket.AF_INET, local_addr)
+        return self
+
+    async def _open(self, family, local_addr=None):
+        # Concurrent announces share the socket being opened
+        starting = self._starting.get(family)
+        if starting is None:
+            loop = asyncio.get_event_loop()
+            starting = self._starting[family] = asyncio.ensure_future(loop.create_datagram_endpoint(
+                lambda: self, local_addr=local_addr or _LOCAL_ADDR[family], family=family))
+        await starting
+
+    def connection_made(self, transport):
+        self._transports[transport.get_extra_info('socket').family] = transport
+
+    def datagram_received(self, data, addr):
+        if len(data) < _HEADER.size:
+            return
+        _, transaction_id = _HEADER.unpack_from(data)
+        request = self._pending.get(transaction_id)
+        if request is None:
+            return
+        future, address = request
+        if addr[:2] != address[:2]:
+            logging.debug("Response from %s to a request sent to %s" % (addr, address))
+            return
+        if not future.done():
+            future.set_result(data)
+
+    def error_received(self, exc):
+        # ICMP errors, e.g. port unreachable; the request times out and is retried
+        logging.debug("UDP tracker socket error: %s" % exc)
+
+    def connection_lost(self, exc):
+        for family, transport in list(self._transports.items()):
+            if transport.is_closing():
+                del self._transports[family]
+                self._starting.pop(family, None)
+        for future, address in self._pending.values():
+            if _family(address) not in self._transports and not future.done():
+                future.set_exception(TrackerError("UDP tracker socket closed"))
+
+    def close(self):
+        for transport in self._transports.values():
+            transport.close()
+
+    async def _resolve(self, url):
+        """
+        The address of the tracker, an IPv4 one if it has both.
+        """
+        host, port = parse_url(url)
+        loop = asyncio.get_event_loop()
+        infos = await loop.getaddrinfo(host, port, type=socket.SOCK_DGRAM)
+        infos = [info for info in infos if info[0] in _PEER_SIZE]
+        if not infos:
+            raise TrackerError("Cannot resolve %s" % host)
+        infos.sort(key=lambda info: info[0] != socket.AF_INET)
+        return infos[0][4]
+
+    async def _transact(self, address, pack, action, min_size, attempt):
+        """
+        Sends the request pack(transaction id) once and waits for the response,
+        raises asyncio.TimeoutError if it does not come in time.
+        """
+        transport = self._transports.get(_family(address))
+        if transport is None:
+            raise TrackerError("UDP tracker client not started")
+        transaction_id = random.getrandbits(32)
+        while transaction_id in self._pending:
+            transaction_id = random.getrandbits(32)
+        future = asyncio.get_event_loop().create_future()
+        self._pending[transaction_id] = (future, address)
+        try:
+            transport.sendto(pack(transaction_id), address)
+            data = await asyncio.wait_for(future, self.retry_base * 2 ** attempt)
+        finally:
+            del self._pending[transaction_id]
+
+        response_action, _ = _HEADER.unpack_from(data)
+        if response_action == ACTION_ERROR:
+            raise TrackerError(bytes(data[_HEADER.size:]).decode(errors='replace'))
+        if response_action != action or len(data) < min_size:
+            raise TrackerError("Invalid response to action %s" % action)
+        return data
+
+    async def _connection_id(self, address, attempt):
+        connection = self._connections.get(address)
+        if connection is not None and connection[1] > time.monotonic():
+            return connection[0]
+        data = await self._transact(address, lambda tid: _CONNECT.pack(PROTOCOL_ID, ACTION_CONNECT, tid),
+                                    ACTION_CONNECT, _CONNECT_RESPONSE.size, attempt)
+        _, _, connection_id = _CONNECT_RESPONSE.unpack_from(data)
+        self._connections[address] = (connection_id, time.monotonic() + CONNECTION_ID_LIFETIME)
+        return connection_id
+
+    async def _request(self, url, address, pack, action, min_size):
+        """
+        Sends pack(connection id, transaction id) to the tracker with the retries of BEP 15.
+        """
+        if _family(address) not in self._transports:
+            await self._open(_family(address))
+        for attempt in range(self.max_retries + 1):
+            try:
+                connection_id = await self._connection_id(address, attempt)
+                return await self._transact(address, lambda tid: pack(connection_id, tid),
+                                            action, min_size, attempt)
+            except asyncio.TimeoutError:
+                logging.debug("UDP tracker %s timed out, attempt %s" % (url, attempt))
+        raise TrackerError("UDP tracker %s does not answer" % url)
+
+    async def announce(self, url, info_hash, peer_id, downloaded=0, left=0, uploaded=0, event=None,
+                       port=6881, num_want=-1, key=0):
+        """
+        Returns (interval, leechers, seeders, [Peer]).
+        """
+        def pack(connection_id, transaction_id):
+            return _ANNOUNCE.pack(connection_id, ACTION_ANNOUNCE, transaction_id, info_hash, peer_id,
+                                  downloaded, left, uploaded, EVENTS[event], 0, key, num_want, port)
+
+        address = await self._resolve(url)
+        data = await self._request(url, address, pack, ACTION_ANNOUNCE, _ANNOUNCE_RESPONSE.size)
+        _, _, interval, leechers, seeders = _ANNOUNCE_RESPONSE.unpack_from(data)
+        family = _family(address)
+        peers = bytes(data[_ANNOUNCE_RESPONSE.size:])
+        peers = peers[:len(peers) - len(peers) % _PEER_SIZE[family]]
+        return interval, leechers, seeders, parse_compact_peers(peers, family == socket.AF_INET6)
+
+    async def scrape(self, url, info_hashes):
+        """
+        Returns {info_hash: (seeders, completed, leechers)}.
+        """
+        address = await self._resolve(url)
+        result = {}
+        for i in range(0, len(info_hashes), MAX_SCRAPE_HASHES):
+            chunk = info_hashes[i:i + MAX_SCRAPE_HASHES]
+
+            def pack(connection_id, transaction_id):
+                return _CONNECT.pack(connection_id, ACTION_SCRAPE, transaction_id) + b''.join(chunk)
+
+            data = await self._request(url, address, pack, ACTION_SCRAPE,
+                                       _HEADER.size + _SCRAPE_ENTRY.size * len(chunk))
+            for j, info_hash in enumerate(chunk):
+                result[info_hash] = _SCRAPE_ENTRY.unpack_from(data, _HEADER.size + _SCRAPE_ENTRY.size * j)
+        return result
@@ -0,0 +1,138 @@
+import asyncio
+import os
+
+from collections import OrderedDict
+
+import metrics
+from file_saver import FileSaver
+from piece import BLOCK_SIZE
+from storage import Storage
+from torrent import DownloadInfo
+
+# Requests for larger blocks are refused, as most clients do
+MAX_BLOCK_LENGTH = 2 ** 17
+MAX_OPEN_FILES = 64
+# Free read buffers kept for reuse
+MAX_FREE_BUFFERS = 64
+
+
+class BlockReader(object):
+    """
+    Gets the blocks requested by peers, without copying them more than needed.
+
+    Pieces verified but not written yet are served from the write cache.
+    Blocks on disk are sent with loop.sendfile() straight from the files,
+    or else read with pread into reusable buffers on the disk thread. The
+    files sendfile() reads are opened read-only apart from the Storage
+    descriptors, which belong to the disk thread.
+
+    Instance Variables:
+        self._download_info -- The DownloadInfo of the torrent.
+        self._storage       -- The Storage of the torrent.
+        self._file_writer   -- The FileSaver whose cache holds the pieces not on disk yet, None for none.
+        self._files         -- OrderedDict {file index: file object} for sendfile, least recently used first.
+        self._in_use        -- {file index: count} of the sendfile() calls using each file.
+        self._buffers       -- The free read buffers of BLOCK_SIZE bytes.
+    """
+    def __init__(self, download_info: DownloadInfo, storage: Storage, file_writer: FileSaver = None,
+                 max_open_files=MAX_OPEN_FILES):
+        self._download_info = download_info
+        self._storage = storage
+        self._file_writer = file_writer
+        self._files = OrderedDict()
+        self._in_use = {}
+        self._buffers = []
+        self.max_open_files = max_open_files
+
+    def check_request(self, index, begin, length):
+        """
+        Whether the block is in range and we have its piece, raises ValueError if it is malformed.
+        """
+        pieces = self._download_info.pieces
+        if not 0 <= index < len(pieces):
+            raise ValueError("Request for piece %s out of range" % index)
+        if length <= 0 or length > MAX_BLOCK_LENGTH or begin < 0 or begin + length > pieces.piece_length(index):
+            raise ValueError("Invalid request %s+%s in piece %s" % (begin, length, index))
+        return bool(pieces.downloaded[index])
+
+    def cached(self, index, begin, length):
+        """
+        The block as a memoryview of the write cache if its piece is not on disk yet, else None.
+        """
+        if self._file_writer is None:
+            return None
+        data = self._file_writer.cached_piece(index * self._download_info.piece_length)
+        if data is None:
+            return None
+        return memoryview(data)[begin:begin + length]
+
+    def _file(self, index):
+        file = self._files.get(index)
+        if file is not None:
+            self._files.move_to_end(index)
+            return file
+
+        if len(self._files) >= self.max_open_files:
+            for old_index in list(self._files):
+                if not self._in_use.get(old_index):
+                    self._files.pop(old_index).close()
+                    break
+        file = open(self._storage.paths[index], 'rb', buffering=0)
+        self._files[index] = file
+        return file
+
+    async def sendfile(self, transport, index, begin, length):
+        """
+        Sends the block from the files with loop.sendfile(). Raises
+        asyncio.SendfileNotAvailableError before sending anything if the
+        transport or platform cannot, OSError if the files are short.
+        """
+        loop = asyncio.get_event_loop()
+        offset = index * self._download_info.piece_length + begin
+        for file_index, file_offset, size in self._storage.segments(offset, length):
+            self._in_use[file_index] = self._in_use.get(file_index, 0) + 1
+            try:
+                sent = await loop.sendfile(transport, self._file(file_index), file_offset, size, fallback=False)
+            finally:
+                self._in_use[file_index] -= 1
+            if sent != size:
+                raise OSError("File %s is shorter than the torrent" % self._storage.paths[file_index])
+
+    def _buffer(self, length):
+        if length <= BLOCK_SIZE and self._buffers:
+            return self._buffers.pop()
+        return bytearray(max(length, BLOCK_SIZE))
+
+    def release(self, buffer):
+        """
+        Gives a buffer returned by read() back once nothing refers to its data any more.
+        """
+        if len(buffer) == BLOCK_SIZE and len(self._buffers) < MAX_FREE_BUFFERS:
+            self._buffers.append(buffer)
+
+    async def read(self, index, begin, length):
+        """
+        Reads the block on the disk thread. Returns (buffer, memoryview of the block in it),
+        the buffer should be given back with release().
+        """
+        buffer = self._buffer(length)
+        view = memoryview(buffer)[:length]
+        loop = asyncio.get_event_loop()
+        offset = index * self._download_info.piece_length + begin
+        with metrics.Timer(metrics.DISK_LATENCY.labels(op='read')):
+            read = await loop.run_in_executor(self._storage.executor, self._storage.readinto, offset, view)
+        if read != length:
+            raise OSError("Block %s+%s of piece %s is not on disk" % (begin, length, index))
+        return buffer, view
+
+    def close(self):
+        for file in self._files.values():
+            try:
+                file.close()
+            except OSError:
+                pass
+        self._files.clear()
+
+
+def sendfile_supported():
+    return hasattr(os, 'sendfile')
@@ -1,4 +1,5 @@
 import asyncio
+import time
 from functools import reduce
 
 from async_timeout import timeout as async_timeout
@@ -14,22 +15,67 @@ def slice(string, n):
     list of strings, all size n. """
     return [string[i:i + n] for i in range(0, len(string), n)]
 
+class RateMeter():
+    """Transfer rate smoothed over samples of at least `interval` seconds"""
+
+    def __init__(self, interval=1.0):
+        self.interval = interval
+        self.rate = 0.0
+        self.total = 0
+        self._start = time.time()
+        self._bytes = 0
+
+    def add(self, size, now=None):
+        """Counts `size` bytes, returns True if the rate was updated"""
+        self.total += size
+        self._bytes += size
+        return self.update(now)
+
+    def update(self, now=None):
+        """Takes a sample if `interval` passed, so the rate also falls when nothing moves"""
+        now = time.time() if now is None else now
+        elapsed = now - self._start
+        if elapsed < self.interval:
+            return False
+        sample = self._bytes / elapsed
+        if self.rate:
+            self.rate += (sample - self.rate) / 2
+        else:
+            self.rate = sample
+        self._start = now
+        self._bytes = 0
+        return True
+
+
 class PerfectInterval():
     """Remove processing time from intervals"""
 
     def __init__(self):
         self._last_timestamp = 0
+        self._last_seconds = 0
 
     def __call__(self, seconds):
         now = asyncio.get_event_loop().time()
         if self._last_timestamp <= 0:
             self._last_timestamp = int(now)
+            self._last_seconds = seconds
             return seconds
         else:
-            expected = self._last_timestamp + seconds
+            # When this call was due, after the previous interval
+            expected = self._last_timestamp + self._last_seconds
             diff = now - expected
+            if diff > seconds:
+                # Too late to catch up, start over
+                self.reset()
+                return self(seconds)
             interval = max(seconds - diff, 0)
             self._last_timestamp = expected
+            self._last_seconds = seconds
+            return interval
+
+    def reset(self):
+        """Start over, e.g. after an interval was cut short"""
+        self._last_timestamp = 0
 
 
 class SleepUneasy():
@@ -40,7 +86,8 @@ class SleepUneasy():
         self._perfint = PerfectInterval()
 
     async def sleep(self, seconds):
-        """Sleep for `seconds` or until `interrupt` is called"""
+        """Sleep for `seconds` or until `interrupt` is called.
+        Returns True if interrupted"""
         self._interrupt.clear()
         # Remove processing time from seconds
         seconds = self._perfint(seconds)
@@ -48,9 +95,12 @@ class SleepUneasy():
             async with async_timeout(seconds):
                 await self._interrupt.wait()
         except asyncio.TimeoutError:
-            pass  # Interval passed without interrupt
+            return False  # Interval passed without interrupt
         finally:
             self._interrupt.clear()
+        # The next interval starts now, not when this one should have ended
+        self._perfint.reset()
+        return True
 
     def interrupt(self):
         """Stop sleeping"""
@@ -0,0 +1,172 @@
+import asyncio
+import hashlib
+import logging
+import mmap
+import os
+import sys
+import time
+
+from concurrent.futures import ThreadPoolExecutor, as_completed
+
+from bitarray import bitarray
+
+from hasher import HASH_WORKERS
+from storage import Storage
+from torrent import DownloadInfo, TorrentInfo
+
+# Each task hashes a contiguous run of pieces of about this size, so every
+# worker streams through the files sequentially.
+TASK_BYTES = 64 * 2 ** 20
+
+
+def _map(path):
+    """
+    Read-only map of the file at `path`, None if it is missing or empty.
+    """
+    try:
+        with open(path, 'rb') as file:
+            size = os.fstat(file.fileno()).st_size
+            mapped = mmap.mmap(file.fileno(), 0, access=mmap.ACCESS_READ) if size else None
+    except FileNotFoundError:
+        return None
+    if mapped is not None and hasattr(mapped, 'madvise'):
+        mapped.madvise(mmap.MADV_SEQUENTIAL)
+    return mapped
+
+
+class _MappedFiles(object):
+    """
+    Read-only maps of the files a run of pieces reads, made on first use. The
+    pieces are read in order, so the files before a piece are unmapped when it
+    starts: each worker maps only the files of about one piece at a time.
+
+    Instance Variables:
+        self._paths     -- The path on disk of each file.
+        self._maps      -- {file index: mmap, None for a missing or empty file}.
+    """
+    def __init__(self, paths):
+        self._paths = paths
+        self._maps = {}
+
+    def get(self, index):
+        if index not in self._maps:
+            self._maps[index] = _map(self._paths[index])
+        return self._maps[index]
+
+    def close_before(self, index):
+        for file_index in [file_index for file_index in self._maps if file_index < index]:
+            mapped = self._maps.pop(file_index)
+            if mapped is not None:
+                mapped.close()
+
+    def close(self):
+        self.close_before(len(self._paths))
+
+
+def _runs(indexes, pieces_per_task):
+    """
+    Groups sorted piece indexes into runs of consecutive pieces of at most pieces_per_task.
+    """
+    run = []
+    for index in indexes:
+        if run and (index != run[-1] + 1 or len(run) == pieces_per_task):
+            yield run
+            run = []
+        run.append(index)
+    if run:
+        yield run
+
+
+def _hash_run(download_info: DownloadInfo, storage: Storage, run):
+    """
+    Returns the pieces of `run` whose data on disk matches their hash.
+    """
+    pieces = download_info.pieces
+    passed = []
+    maps = _MappedFiles(storage.paths)
+    try:
+        for index in run:
+            segments = list(storage.segments(index * download_info.piece_length, pieces.piece_length(index)))
+            maps.close_before(segments[0][0])
+            if _piece_matches(maps, segments, pieces.piece_hash(index)):
+                passed.append(index)
+    finally:
+        maps.close()
+    return passed
+
+
+def _piece_matches(maps, segments, piece_hash):
+    """
+    Whether the files hold the whole piece made of `segments` and it matches `piece_hash`.
+    """
+    sha = hashlib.sha1()
+    for file_index, file_offset, size in segments:
+        mapped = maps.get(file_index)
+        if mapped is None or file_offset + size > len(mapped):
+            return False
+        with memoryview(mapped) as view:
+            sha.update(view[file_offset:file_offset + size])
+    return sha.digest() == piece_hash
+
+
+def verify(download_info: DownloadInfo, storage: Storage, indexes=None, workers=HASH_WORKERS, progress=None):
+    """
+    Hashes the pieces `indexes` (all of them by default) from the files on disk
+    in parallel, each worker reading memory-mapped files sequentially and
+    mapping only the files of the piece it hashes.
+    progress(pieces checked, pieces to check) is called as runs complete.
+    Returns the have-bitfield.
+    """
+    piece_count = len(download_info.pieces)
+    indexes = sorted(indexes) if indexes is not None else range(piece_count)
+    total = len(indexes)
+    have = bitarray(piece_count)
+    have.setall(False)
+
+    pieces_per_task = max(1, TASK_BYTES // download_info.piece_length)
+    with ThreadPoolExecutor(max_workers=workers, thread_name_prefix='verify') as executor:
+        futures = {executor.submit(_hash_run, download_info, storage, run): len(run)
+                   for run in _runs(indexes, pieces_per_task)}
+        checked = 0
+        for future in as_completed(futures):
+            for index in future.result():
+                have[index] = True
+            checked += futures[future]
+            if progress is not None:
+                progress(checked, total)
+    return have
+
+
+async def check_existing(download_info: DownloadInfo, storage: Storage, indexes=None, progress=None):
+    """
+    Verifies the data already on disk without blocking the loop and marks the
+    pieces that pass as downloaded. Returns the number of pieces that passed.
+    """
+    loop = asyncio.get_event_loop()
+    have = await loop.run_in_executor(None, lambda: verify(download_info, storage, indexes, progress=progress))
+    for index in have.search(bitarray('1')):
+        download_info.pieces.mark_as_downloaded(index)
+    return have.count()
+
+
+def _print_progress(start):
+    def progress(checked, total):
+        elapsed = max(time.time() - start, 1e-6)
+        sys.stderr.write('\r%d/%d pieces (%.1f%%), %.1f pieces/s' %
+                         (checked, total, 100.0 * checked / max(total, 1), checked / elapsed))
+        sys.stderr.flush()
+    return progress
+
+
+if __name__ == "__main__":
+    if len(sys.argv) < 2:
+        print("usage: verify.py <torrent file> [download dir]")
+        sys.exit(2)
+    logging.basicConfig(level=logging.INFO)
+    torrent_info = TorrentInfo.from_file(sys.argv[1], download_dir=sys.argv[2] if len(sys.argv) > 2 else '.')
+    storage = Storage(torrent_info.download_info, torrent_info.download_dir)
+    have = verify(torrent_info.download_info, storage, progress=_print_progress(time.time()))
+    storage.close()
+    sys.stderr.write('\n')
+    print('%d of %d pieces complete' % (have.count(), len(have)))
+    print(have.to01())